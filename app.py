@@ -1,5 +1,6 @@
+import functools
+import logging
 import os
-import secrets
 
 import jinja2
 from commons import value_to_bool
@@ -9,29 +10,59 @@ from litestar.config.cors import CORSConfig
 from litestar.config.csrf import CSRFConfig
 from litestar.contrib.jinja import JinjaTemplateEngine
 from litestar.datastructures import ResponseHeader
-from litestar.middleware.rate_limit import RateLimitConfig
 from litestar.middleware.session.client_side import CookieBackendConfig
 from litestar.openapi import OpenAPIConfig
 from litestar.openapi.plugins import SwaggerRenderPlugin
 from litestar.plugins.flash import FlashPlugin, FlashConfig
 from litestar.static_files import StaticFilesConfig
 from litestar.template import TemplateConfig
-from litestar.types import Receive, Scope, Send
+from litestar.types import ASGIApp, Receive, Scope, Send
 from piccolo.apps.user.tables import BaseUser
 from piccolo.engine import engine_finder
 from piccolo_admin.endpoints import create_admin, TableConfig, OrderBy
+from piccolo_api.crud.hooks import Hook, HookType
 
 from home import endpoints, controllers
-from home.exception_handlers import RedirectForAuth, redirect_for_auth
-from home.tables import RequestMade
+from home.deployment import derive_secret
+from home.dns_listener import start_dns, stop_dns
+from home.engines import DatabaseUnavailable
+from home.exception_handlers import (
+    RedirectForAuth,
+    redirect_for_auth,
+    database_unavailable,
+)
+from home.tables import CallbackToken, DnsQuery, RequestMade
+from home.util import TimedTemplate
+from home.live import publish_requests
+from home.metrics import MetricsMiddleware
+from home.middleware import EnsureAuth
+from home.page_cache import listing_cache
+from home.pubsub import (
+    start_pubsub,
+    stop_pubsub,
+    pubsub,
+    REQUESTS_CHANNEL,
+    SESSIONS_CHANNEL,
+    TOKENS_CHANNEL,
+)
+from home.rate_limit import RateLimitMiddleware
+from home.retention import start_retention, stop_retention
+from home.stream_listener import start_stream_listeners, stop_stream_listeners
+from home.tokens import start_token_index, stop_token_index, token_index
+from home.write_queue import start_write_queue, stop_write_queue, request_queue
 
 load_dotenv()
+log = logging.getLogger(__name__)
 IS_PRODUCTION = not value_to_bool(os.environ.get("DEBUG"))
 
 
-# mounting Piccolo Admin
-@asgi("/b/admin/", is_mount=True)
-async def admin(scope: "Scope", receive: "Receive", send: "Send") -> None:
+@functools.cache
+def build_admin(allowed_hosts: tuple[str, ...], production: bool) -> ASGIApp:
+    """The Piccolo Admin app, built once for each configuration it is given.
+
+    Building it sets up every route, table config and its OpenAPI
+    schema, which is far too much work to repeat per request.
+    """
     user_tc = TableConfig(BaseUser, menu_group="User Management")
     requests_tc = TableConfig(
         RequestMade,
@@ -41,20 +72,62 @@ async def admin(scope: "Scope", receive: "Receive", send: "Send") -> None:
             RequestMade.id,
             RequestMade.type,
             RequestMade.domain,
+            RequestMade.token,
             RequestMade.url,
             RequestMade.query_params,
             RequestMade.made_at,
         ],
     )
 
-    await create_admin(
-        tables=[user_tc, requests_tc],
-        allowed_hosts=os.environ.get("SERVING_DOMAIN", "").split(","),
-        production=IS_PRODUCTION,
+    tokens_tc = TableConfig(
+        CallbackToken,
+        menu_group="Main",
+        visible_columns=[
+            CallbackToken.id,
+            CallbackToken.label,
+            CallbackToken.domain,
+            CallbackToken.path_prefix,
+            CallbackToken.owner,
+        ],
+        hooks=[
+            Hook(hook_type=hook_type, callable=token_index.changed)
+            for hook_type in (
+                HookType.pre_save,
+                HookType.pre_patch,
+                HookType.pre_delete,
+            )
+        ],
+    )
+
+    dns_tc = TableConfig(
+        DnsQuery,
+        menu_group="Main",
+        order_by=[OrderBy(DnsQuery.id, ascending=False)],
+        visible_columns=[
+            DnsQuery.id,
+            DnsQuery.qtype,
+            DnsQuery.qname,
+            DnsQuery.source,
+            DnsQuery.token,
+            DnsQuery.made_at,
+        ],
+    )
+
+    return create_admin(
+        tables=[user_tc, requests_tc, tokens_tc, dns_tc],
+        allowed_hosts=list(allowed_hosts),
+        production=production,
         sidebar_links={"Site root": "/"},
         site_name="Blurp Admin",
         auto_include_related=True,
-    )(scope, receive, send)
+    )
+
+
+# mounting Piccolo Admin
+@asgi("/b/admin/", is_mount=True)
+async def admin(scope: "Scope", receive: "Receive", send: "Send") -> None:
+    allowed_hosts = tuple(os.environ.get("SERVING_DOMAIN", "").split(","))
+    await build_admin(allowed_hosts, IS_PRODUCTION)(scope, receive, send)
 
 
 async def open_database_connection_pool():
@@ -62,7 +135,10 @@ async def open_database_connection_pool():
         engine = engine_finder()
         await engine.start_connection_pool()
     except Exception:
-        print("Unable to connect to the database")
+        log.exception(
+            "Unable to open the database connection pool, "
+            "falling back to a connection per query"
+        )
 
 
 async def close_database_connection_pool():
@@ -70,7 +146,7 @@ async def close_database_connection_pool():
         engine = engine_finder()
         await engine.close_connection_pool()
     except Exception:
-        print("Unable to connect to the database")
+        log.exception("Unable to close the database connection pool")
 
 
 cors_config = CORSConfig(
@@ -79,7 +155,7 @@ cors_config = CORSConfig(
     allow_methods=["*"],
     allow_credentials=False,
 )
-CSRF_TOKEN = os.environ.get("CSRF_TOKEN", secrets.token_hex(32))
+CSRF_TOKEN = os.environ.get("CSRF_TOKEN", derive_secret("csrf").hex())
 csrf_config = CSRFConfig(
     secret=CSRF_TOKEN,
     # Aptly named so it doesnt clash
@@ -95,24 +171,35 @@ csrf_config = CSRFConfig(
         "/b/logout",
     ],
 )
-rate_limit_config = RateLimitConfig(
-    rate_limit=("second", 5), exclude=["/b/admin", "/b/docs"]
-)
 ENVIRONMENT = jinja2.Environment(
     loader=jinja2.FileSystemLoader(
         searchpath=os.path.join(os.path.dirname(__file__), "home", "templates")
     ),
     autoescape=True,
 )
+ENVIRONMENT.template_class = TimedTemplate
 template_config = TemplateConfig(
     directory="home/templates", engine=JinjaTemplateEngine.from_environment(ENVIRONMENT)
 )
+request_queue.listeners.append(publish_requests)
+request_queue.listeners.append(listing_cache.on_insert)
+# Catches inserts, logouts, password and token changes in other workers
+pubsub.add_handler(REQUESTS_CHANNEL, listing_cache.on_message)
+pubsub.add_handler(SESSIONS_CHANNEL, EnsureAuth.on_message)
+pubsub.add_handler(TOKENS_CHANNEL, token_index.on_message)
 flash_plugin = FlashPlugin(config=FlashConfig(template_config=template_config))
-session_config = CookieBackendConfig(secret=secrets.token_bytes(16))
+session_config = CookieBackendConfig(secret=derive_secret("session", 16))
 app = Litestar(
     route_handlers=[
         admin,
         endpoints.view_authed_request,
+        endpoints.view_authed_request_body,
+        endpoints.view_requests_page,
+        endpoints.list_requests,
+        endpoints.list_dns_queries,
+        endpoints.export_requests,
+        endpoints.live_requests,
+        endpoints.view_metrics,
         endpoints.catch_all,
         controllers.LogoutController,
         controllers.LoginController,
@@ -122,8 +209,24 @@ app = Litestar(
     static_files_config=[
         StaticFilesConfig(directories=["static"], path="/static/"),
     ],
-    on_startup=[open_database_connection_pool],
-    on_shutdown=[close_database_connection_pool],
+    on_startup=[
+        open_database_connection_pool,
+        start_pubsub,
+        start_token_index,
+        start_write_queue,
+        start_dns,
+        start_stream_listeners,
+        start_retention,
+    ],
+    on_shutdown=[
+        stop_retention,
+        stop_stream_listeners,
+        stop_dns,
+        stop_write_queue,
+        stop_token_index,
+        stop_pubsub,
+        close_database_connection_pool,
+    ],
     debug=not IS_PRODUCTION,
     openapi_config=OpenAPIConfig(
         title="Blurp API",
@@ -133,7 +236,7 @@ app = Litestar(
     ),
     cors_config=cors_config,
     csrf_config=csrf_config,
-    middleware=[rate_limit_config.middleware, session_config.middleware],
+    middleware=[MetricsMiddleware, RateLimitMiddleware, session_config.middleware],
     plugins=[flash_plugin],
     response_headers=[
         ResponseHeader(
@@ -173,7 +276,8 @@ app = Litestar(
         ),
         ResponseHeader(
             name="content-security-policy",
-            value="default-src 'none'; frame-ancestors 'none'; object-src 'none';"
+            value="default-src 'none'; connect-src 'self'; frame-ancestors 'none';"
+            " object-src 'none';"
             " base-uri 'none'; script-src 'nonce-{}' 'strict-dynamic'; style-src "
             "'nonce-{}' 'strict-dynamic'; require-trusted-types-for 'script'",
             description="Security header",
@@ -182,5 +286,6 @@ app = Litestar(
     ],
     exception_handlers={
         RedirectForAuth: redirect_for_auth,
+        DatabaseUnavailable: database_unavailable,
     },
 )
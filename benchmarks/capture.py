@@ -0,0 +1,431 @@
+"""Load test the capture path.
+
+Runs a mix of callouts against a fresh database, either straight into
+the ASGI app in this process or over HTTP to a local uvicorn, and
+writes the results as JSON so two runs can be compared.
+
+    python -m benchmarks.capture run --database sqlite -o before.json
+    python -m benchmarks.capture run --database postgres --target uvicorn -o after.json
+    python -m benchmarks.capture compare before.json after.json
+
+Postgres runs use the usual POSTGRES_* variables, and drop then recreate
+the database named by --postgres-database on every run.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, NamedTuple
+
+import httpx
+import orjson
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Payload(NamedTuple):
+    method: str
+    path: str
+    headers: dict[str, str]
+    body: bytes
+
+
+def _small_get(rng: random.Random) -> Payload:
+    return Payload(
+        "GET",
+        f"/{rng.getrandbits(32):08x}?id={rng.randint(0, 10_000)}",
+        {"user-agent": "curl/8.5.0", "accept": "*/*"},
+        b"",
+    )
+
+
+def _large_post(rng: random.Random) -> Payload:
+    record = {"id": 0, "name": "x" * 64, "tags": ["a", "b", "c"], "ok": True}
+    body = orjson.dumps([dict(record, id=i) for i in range(2500)])
+    return Payload(
+        "POST",
+        f"/hook/{rng.getrandbits(32):08x}",
+        {"content-type": "application/json", "user-agent": "python-requests/2.32"},
+        body,
+    )
+
+
+def _binary(rng: random.Random) -> Payload:
+    return Payload(
+        "PUT",
+        "/upload",
+        {"content-type": "application/octet-stream"},
+        rng.randbytes(16 * 1024),
+    )
+
+
+def _many_headers(rng: random.Random) -> Payload:
+    headers = {f"x-custom-{i}": f"value-{rng.getrandbits(64):016x}" for i in range(60)}
+    headers["cookie"] = "; ".join(f"c{i}={i}" for i in range(20))
+    return Payload("GET", "/", headers, b"")
+
+
+PAYLOADS = {
+    "small_get": _small_get,
+    "large_post": _large_post,
+    "binary": _binary,
+    "many_headers": _many_headers,
+}
+DEFAULT_MIX = "small_get=70,large_post=10,binary=10,many_headers=10"
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in PAYLOADS:
+            raise argparse.ArgumentTypeError(f"Unknown payload {name!r}")
+
+        weights[name] = int(weight or 1)
+
+    return weights
+
+
+class DatabaseTimer:
+    """Adds up the time spent in every query the engine runs"""
+
+    def __init__(self):
+        self.seconds: float = 0
+        self.queries: int = 0
+
+    def install(self, engine) -> None:
+        # Engines use __slots__, so the methods are wrapped on the class
+        engine_class = type(engine)
+        for name in ("run_querystring", "run_ddl"):
+            setattr(engine_class, name, self._wrap(getattr(engine_class, name)))
+
+    def _wrap(self, method):
+        async def timed(engine, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(engine, *args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - start
+                self.queries += 1
+
+        return timed
+
+
+def benchmark_environment(args, scratch: str) -> dict[str, str]:
+    env = dict(
+        os.environ,
+        SECRET_KEY="benchmark",
+        BLOB_STORE_PATH=os.path.join(scratch, "blobs"),
+        WRITE_QUEUE_SPILL_PATH=os.path.join(scratch, "spill.ndjson"),
+        RATE_LIMIT_CAPTURE_RATE="1e9",
+        RATE_LIMIT_CAPTURE_BURST="1e9",
+        WEB_WORKERS=str(args.workers),
+    )
+    if args.database == "sqlite":
+        env.pop("POSTGRES_HOST", None)
+        env["PICCOLO_CONF"] = "benchmarks.piccolo_conf_sqlite"
+        env["BENCH_SQLITE_PATH"] = os.path.join(scratch, "bench.sqlite")
+    else:
+        env["POSTGRES_DB"] = args.postgres_database
+        if not env.get("POSTGRES_HOST"):
+            sys.exit("Set POSTGRES_HOST and friends to benchmark against Postgres")
+
+    return env
+
+
+def prepare_database(args, env: dict[str, str]) -> None:
+    if args.database == "postgres":
+        import asyncpg
+
+        async def recreate():
+            connection = await asyncpg.connect(
+                host=env["POSTGRES_HOST"],
+                port=int(env.get("POSTGRES_PORT", 5432)),
+                user=env["POSTGRES_USER"],
+                password=env.get("POSTGRES_PASSWORD"),
+                database="postgres",
+            )
+            try:
+                name = args.postgres_database.replace('"', '""')
+                await connection.execute(f'DROP DATABASE IF EXISTS "{name}"')
+                await connection.execute(f'CREATE DATABASE "{name}"')
+            finally:
+                await connection.close()
+
+        asyncio.run(recreate())
+
+    for app in ("user", "session_auth", "all"):
+        subprocess.run(
+            [sys.executable, "-m", "piccolo.main", "migrations", "forwards", app],
+            cwd=ROOT,
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+
+async def drive(
+    client: httpx.AsyncClient, args, weights: dict[str, int]
+) -> list[tuple[str, float, int]]:
+    """Send every request, returning (payload, seconds, status) for each"""
+    rng = random.Random(args.seed)
+    names = rng.choices(list(weights), weights=list(weights.values()), k=args.requests)
+    # Built up front so payload generation isn't part of the timings
+    payloads = [(name, PAYLOADS[name](rng)) for name in names]
+    results: list[tuple[str, float, int]] = []
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in payloads:
+        queue.put_nowait(item)
+
+    async def worker():
+        while not queue.empty():
+            name, payload = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                response = await client.request(
+                    payload.method,
+                    payload.path,
+                    headers=payload.headers,
+                    content=payload.body,
+                )
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 0
+
+            results.append((name, time.perf_counter() - start, status))
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return results
+
+
+async def run_in_process(args, weights) -> tuple[list, float, DatabaseTimer | None]:
+    sys.path.insert(0, ROOT)
+    from litestar.testing import AsyncTestClient
+    from piccolo.engine import engine_finder
+
+    from app import app
+
+    timer = DatabaseTimer()
+    timer.install(engine_finder())
+    async with AsyncTestClient(app) as client:
+        start = time.perf_counter()
+        results = await drive(client, args, weights)
+        elapsed = time.perf_counter() - start
+
+    # Leaving the client runs shutdown, which drains the write queue
+    return results, elapsed, timer
+
+
+async def run_against_url(args, weights, url: str) -> tuple[list, float, None]:
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        start = time.perf_counter()
+        results = await drive(client, args, weights)
+        elapsed = time.perf_counter() - start
+
+    return results, elapsed, None
+
+
+def start_uvicorn(args, env: dict[str, str]) -> tuple[subprocess.Popen, str]:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ],
+        cwd=ROOT,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{url}/b/requests", timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+
+    process.terminate()
+    sys.exit("uvicorn did not start")
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarise(results: list[tuple[str, float, int]], elapsed: float) -> dict:
+    latencies = sorted(seconds for _, seconds, _ in results)
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, _, status in results if not 200 <= status < 400),
+        "requests_per_second": len(results) / elapsed if elapsed else 0,
+        "latency_ms": {
+            "mean": 1000 * sum(latencies) / len(latencies) if latencies else 0,
+            "p50": 1000 * percentile(latencies, 0.50),
+            "p90": 1000 * percentile(latencies, 0.90),
+            "p99": 1000 * percentile(latencies, 0.99),
+            "max": 1000 * latencies[-1] if latencies else 0,
+        },
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict[str, Any]:
+    weights = parse_mix(args.mix)
+    scratch = tempfile.mkdtemp(prefix="blurp-bench-")
+    try:
+        env = benchmark_environment(args, scratch)
+        prepare_database(args, env)
+        if args.target == "inprocess":
+            os.environ.clear()
+            os.environ.update(env)
+            results, elapsed, timer = asyncio.run(run_in_process(args, weights))
+        else:
+            process, url = start_uvicorn(args, env)
+            try:
+                results, elapsed, timer = asyncio.run(
+                    run_against_url(args, weights, url)
+                )
+            finally:
+                process.terminate()
+                process.wait(30)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    by_payload = defaultdict(list)
+    for result in results:
+        by_payload[result[0]].append(result)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "database": args.database,
+            "target": args.target,
+            "workers": args.workers,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "mix": weights,
+            "seed": args.seed,
+        },
+        "overall": summarise(results, elapsed),
+        "payloads": {
+            name: summarise(items, elapsed) for name, items in by_payload.items()
+        },
+    }
+    # Only measurable when the app runs in this process
+    report["overall"]["db_ms_per_request"] = (
+        1000 * timer.seconds / len(results) if timer and results else None
+    )
+    report["overall"]["queries_per_request"] = (
+        timer.queries / len(results) if timer and results else None
+    )
+    return report
+
+
+def _flatten(report: dict, prefix: str = "") -> dict[str, float]:
+    values = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            values.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{key}"] = value
+
+    return values
+
+
+def compare(before: dict, after: dict) -> str:
+    old = _flatten({"overall": before["overall"], "payloads": before["payloads"]})
+    new = _flatten({"overall": after["overall"], "payloads": after["payloads"]})
+    lines = [f"{'metric':<48} {'before':>12} {'after':>12} {'change':>9}"]
+    for key in sorted(old.keys() & new.keys()):
+        change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0
+        lines.append(f"{key:<48} {old[key]:>12.2f} {new[key]:>12.2f} {change:>+8.1f}%")
+
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run a benchmark")
+    run_parser.add_argument(
+        "--database", choices=["sqlite", "postgres"], default="sqlite"
+    )
+    run_parser.add_argument(
+        "--target", choices=["inprocess", "uvicorn"], default="inprocess"
+    )
+    run_parser.add_argument("--workers", type=int, default=1)
+    run_parser.add_argument("--requests", type=int, default=5000)
+    run_parser.add_argument("--concurrency", type=int, default=50)
+    run_parser.add_argument("--mix", default=DEFAULT_MIX)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--postgres-database", default="blurp_bench")
+    run_parser.add_argument("-o", "--output", help="Write the JSON report here")
+
+    compare_parser = commands.add_parser("compare", help="Compare two reports")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        with open(args.before, "rb") as before, open(args.after, "rb") as after:
+            print(compare(orjson.loads(before.read()), orjson.loads(after.read())))
+        return
+
+    if args.target == "inprocess" and args.workers != 1:
+        parser.error("--workers needs --target uvicorn")
+
+    report = run(args)
+    output = orjson.dumps(report, option=orjson.OPT_INDENT_2)
+    if args.output:
+        with open(args.output, "wb") as file:
+            file.write(output)
+
+    print(output.decode())
+
+
+if __name__ == "__main__":
+    main()
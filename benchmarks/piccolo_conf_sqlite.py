@@ -0,0 +1,15 @@
+"""Points Piccolo at a throwaway SQLite database for benchmark runs"""
+
+import os
+
+from piccolo.engine.sqlite import SQLiteEngine
+
+from home.engines import SQLITE_READ_CONNECTIONS, SQLITE_TUNED, TunedSQLiteEngine
+from piccolo_conf import APP_REGISTRY  # noqa
+
+if SQLITE_TUNED:
+    DB = TunedSQLiteEngine(
+        path=os.environ["BENCH_SQLITE_PATH"], read_connections=SQLITE_READ_CONNECTIONS
+    )
+else:
+    DB = SQLiteEngine(path=os.environ["BENCH_SQLITE_PATH"])
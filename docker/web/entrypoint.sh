@@ -1,5 +1,6 @@
 #!/usr/bin/env bash
 
 EXPOSED_PORT="${PORT:-2300}"
+WORKERS="${WEB_WORKERS:-1}"
 /code/migrate.sh
-uv run uvicorn app:app --proxy-headers --host 0.0.0.0 --port "$EXPOSED_PORT" --log-config=log_conf.yaml
\ No newline at end of file
+uv run uvicorn app:app --proxy-headers --host 0.0.0.0 --port "$EXPOSED_PORT" --workers "$WORKERS" --log-config=log_conf.yaml
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""A content addressed, on disk store for large request bodies.
+
+Files are named after the sha256 of their contents, so the same
+payload sent any number of times is only ever stored once.
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+
+from dotenv import load_dotenv
+
+load_dotenv()
+BLOB_STORE_PATH: str = os.environ.get("BLOB_STORE_PATH", "blobs")
+BODY_SPILL_THRESHOLD: int = int(os.environ.get("BODY_SPILL_THRESHOLD", 64 * 1024))
+
+_DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def path_for(self, digest: str) -> str:
+        if not _DIGEST_PATTERN.match(digest):
+            raise ValueError(f"{digest!r} is not a sha256 digest")
+
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path_for(digest))
+
+    def _write(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            # Counts as a fresh write, so the sweep's grace period
+            # covers the row about to refer to it
+            os.utime(path)
+            return digest
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write then rename so readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        return digest
+
+    def remove(self, digest: str) -> None:
+        try:
+            os.remove(self.path_for(digest))
+        except FileNotFoundError:
+            pass
+
+    def list_older_than(self, timestamp: float) -> list[str]:
+        """Digests of every blob last written before timestamp"""
+        digests = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not _DIGEST_PATTERN.match(filename):
+                    continue
+
+                if os.path.getmtime(os.path.join(directory, filename)) < timestamp:
+                    digests.append(filename)
+
+        return digests
+
+    async def put(self, data: bytes) -> str:
+        """Store data, returning the digest it can be found under"""
+        return await asyncio.to_thread(self._write, data)
+
+
+blob_store = BlobStore(BLOB_STORE_PATH)
@@ -0,0 +1,248 @@
+"""Capture side helpers for the catch all route.
+
+Most callouts come from scanners or SSRF targets which never read
+what we send back, so rendering the home page for them is wasted work.
+Browsers that ask for HTML still get the full page.
+"""
+
+import ipaddress
+import os
+from typing import Any, NamedTuple
+
+import commons
+from dotenv import load_dotenv
+from litestar import Request, Response, MediaType
+from litestar.status_codes import HTTP_200_OK
+
+from home import page_cache
+from home.blob_store import blob_store, BODY_SPILL_THRESHOLD
+from home.middleware import EnsureAuth
+from home.util import TTLCache
+
+load_dotenv()
+# One of: empty, static, cached, page
+CAPTURE_RESPONSE: str = os.environ.get("CAPTURE_RESPONSE", "empty").lower()
+CAPTURE_RESPONSE_BODY: str = os.environ.get("CAPTURE_RESPONSE_BODY", "")
+CAPTURE_RESPONSE_CONTENT_TYPE: str = os.environ.get(
+    "CAPTURE_RESPONSE_CONTENT_TYPE", MediaType.TEXT
+)
+CAPTURE_RESPONSE_CACHE_TTL: float = float(
+    os.environ.get("CAPTURE_RESPONSE_CACHE_TTL", 5)
+)
+MAX_BODY_SIZE: int = int(os.environ.get("MAX_BODY_SIZE", 1024 * 1024))
+
+ONLY_SHOW_CURRENT_DOMAIN: bool = commons.value_to_bool(
+    os.environ.get("ONLY_SHOW_CURRENT_DOMAIN")
+)
+IGNORE_FROM_SELF: bool = commons.value_to_bool(os.environ.get("IGNORE_FROM_SELF"))
+# Comma separated addresses or CIDR ranges our own users browse from,
+# callouts from anywhere else are captured without a session lookup
+IGNORE_FROM_SELF_NETWORKS: list[ipaddress.IPv4Network | ipaddress.IPv6Network] = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.environ.get("IGNORE_FROM_SELF_NETWORKS", "").split(",")
+    if network.strip()
+]
+
+# page key -> html, with page_cache.NONCE_PLACEHOLDER for the nonce
+_cached_pages: TTLCache[str, str] = TTLCache(
+    max_size=page_cache.LISTING_CACHE_SIZE, ttl=CAPTURE_RESPONSE_CACHE_TTL
+)
+
+
+def escape_nul(value: str) -> str:
+    """value with any NULs spelt out as ``\\x00``.
+
+    Postgres text can't hold them, and a row it refuses is a
+    callout lost, so anything a client sent goes through this.
+    """
+    return value.replace("\x00", "\\x00")
+
+
+def may_be_own_user(request: Request) -> bool:
+    """Whether a request could belong to a logged in user, without
+    touching the database.
+
+    Only requests passing this are worth resolving a session for.
+    """
+    if not request.cookies.get(EnsureAuth.cookie_name):
+        return False
+
+    if not IGNORE_FROM_SELF_NETWORKS:
+        return True
+
+    if request.client is None:
+        return False
+
+    try:
+        address = ipaddress.ip_address(request.client.host)
+    except ValueError:
+        return False
+
+    return any(address in network for network in IGNORE_FROM_SELF_NETWORKS)
+
+
+def wants_html(request: Request) -> bool:
+    """Whether this looks like a browser that will display the home page"""
+    return "text/html" in request.headers.get("accept", "")
+
+
+def page_key(request: Request) -> str:
+    """Which cached copy of the page this request would see"""
+    if ONLY_SHOW_CURRENT_DOMAIN:
+        return request.headers.get("host", "")
+
+    return ""
+
+
+def should_render_page(request: Request) -> bool:
+    if CAPTURE_RESPONSE == "page":
+        return True
+
+    if wants_html(request):
+        return True
+
+    if CAPTURE_RESPONSE == "cached":
+        return get_cached_page(page_key(request)) is None
+
+    return False
+
+
+def get_cached_page(key: str) -> str | None:
+    return _cached_pages.get(key)
+
+
+def set_cached_page(key: str, html: str) -> None:
+    _cached_pages.set(key, html)
+
+
+def minimal_response(request: Request) -> Response:
+    """The response given to callouts which don't get the full page"""
+    if CAPTURE_RESPONSE == "static":
+        return Response(
+            content=CAPTURE_RESPONSE_BODY,
+            media_type=CAPTURE_RESPONSE_CONTENT_TYPE,
+            status_code=HTTP_200_OK,
+        )
+
+    if CAPTURE_RESPONSE == "cached":
+        html = get_cached_page(page_key(request))
+        if html is not None:
+            return page_cache.respond(html)
+
+    return Response(content=b"", media_type=MediaType.TEXT, status_code=HTTP_200_OK)
+
+
+# Checked in order, the first matching prefix wins
+_MAGIC_NUMBERS: list[tuple[bytes, str]] = [
+    (b"\x1f\x8b", "gzip"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"BZh", "bzip2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"PK\x03\x04", "zip"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF8", "gif"),
+    (b"%PDF", "pdf"),
+]
+
+
+class CapturedBody(NamedTuple):
+    data: bytes
+    size: int
+    truncated: bool
+    encoding: str
+
+
+def detect_encoding(data: bytes, truncated: bool = False) -> str:
+    """Best effort guess at what a request body contains.
+
+    Returns one of the known binary formats, ``utf-8`` for text
+    or ``binary`` when nothing else fits.
+    """
+    if not data:
+        return ""
+
+    for magic, name in _MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return name
+
+    if b"\x00" in data:
+        # Valid UTF-8, but not something a Text column will hold
+        return "binary"
+
+    try:
+        data.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as e:
+        # Cutting a body short can split a multibyte character
+        if (
+            truncated
+            and e.start >= len(data) - 3
+            and e.reason == "unexpected end of data"
+        ):
+            return "utf-8"
+
+    return "binary"
+
+
+async def read_body(request: Request, limit: int = MAX_BODY_SIZE) -> CapturedBody:
+    """Read at most ``limit`` bytes of the request body.
+
+    Chunks are pulled straight off the ASGI receive channel so
+    an oversized body is never held in memory in full.
+    """
+    chunks: list[bytes] = []
+    received: int = 0
+    truncated: bool = False
+    async for chunk in request.stream():
+        if not chunk:
+            continue
+
+        remaining = limit - received
+        if len(chunk) > remaining:
+            chunks.append(chunk[:remaining])
+            received += remaining
+            truncated = True
+            break
+
+        chunks.append(chunk)
+        received += len(chunk)
+
+    data = b"".join(chunks)
+    size = received
+    if truncated:
+        content_length = request.headers.get("content-length", "")
+        size = int(content_length) if content_length.isdigit() else received
+
+    return CapturedBody(
+        data=data,
+        size=size,
+        truncated=truncated,
+        encoding=detect_encoding(data, truncated),
+    )
+
+
+async def body_columns(body: CapturedBody, content_type: str = "") -> dict[str, Any]:
+    """The RequestMade body columns for body.
+
+    Text goes in body and anything else in body_raw, unless it is
+    large enough to be kept in the blob store instead.
+    """
+    is_text = body.encoding in ("", "utf-8")
+    body_hash = ""
+    if len(body.data) > BODY_SPILL_THRESHOLD:
+        body_hash = await blob_store.put(body.data)
+
+    return {
+        "body": (
+            body.data.decode("utf-8", errors="replace")
+            if is_text and not body_hash
+            else ""
+        ),
+        "body_raw": body.data if not (is_text or body_hash) else b"",
+        "body_hash": body_hash,
+        "body_content_type": escape_nul(content_type),
+        "body_encoding": body.encoding,
+        "body_size": body.size,
+        "body_truncated": body.truncated,
+    }
@@ -0,0 +1,5 @@
+from .check_plans import check_plans
+from .export_requests import export_requests
+from .import_requests import import_requests
+
+__all__ = ["check_plans", "export_requests", "import_requests"]
@@ -0,0 +1,151 @@
+import json
+import sys
+
+from piccolo.engine import engine_finder
+
+from home.search import SEARCH_INDEX, SEARCH_TABLE, search_filter
+from home.tables import RequestMade
+
+
+def _hot_queries() -> dict[str, str]:
+    """The queries the site runs on every page view, in the shape it runs them"""
+    return {
+        "latest requests": str(
+            RequestMade.select(RequestMade.uuid, RequestMade.url)
+            .order_by(RequestMade.id, ascending=False)
+            .limit(25)
+        ),
+        "latest requests for a domain": str(
+            RequestMade.select(RequestMade.uuid, RequestMade.url)
+            .where(RequestMade.domain == "example.com")
+            .order_by(RequestMade.id, ascending=False)
+            .limit(25)
+        ),
+        "latest requests for a token": str(
+            RequestMade.select(RequestMade.uuid, RequestMade.url)
+            .where(RequestMade.token == 1)
+            .order_by(RequestMade.id, ascending=False)
+            .limit(25)
+        ),
+        "admin listing by time": str(
+            RequestMade.select(RequestMade.id)
+            .order_by(RequestMade.made_at, ascending=False)
+            .limit(25)
+        ),
+        "search for a canary token": str(
+            RequestMade.select(RequestMade.uuid, RequestMade.url)
+            .where(search_filter("canary-token"))
+            .order_by(RequestMade.id, ascending=False)
+            .limit(25)
+        ),
+        "request by uuid": str(
+            RequestMade.select(RequestMade.id).where(
+                RequestMade.uuid == "00000000-0000-0000-0000-000000000000"
+            )
+        ),
+    }
+
+
+# Queries which are no good unless answered from one particular index,
+# as (postgres index, sqlite table)
+REQUIRED_INDEXES: dict[str, tuple[str, str]] = {
+    "search for a canary token": (SEARCH_INDEX, SEARCH_TABLE),
+}
+
+
+def _postgres_indexes(plan: dict) -> list[str]:
+    found = [plan["Index Name"]] if "Index Name" in plan else []
+    for child in plan.get("Plans", []):
+        found.extend(_postgres_indexes(child))
+
+    return found
+
+
+async def _postgres_family(engine, relation: str) -> set[str]:
+    """A table or index, and each partition's copy of it, which is what
+    plans name"""
+    response = await engine.run_ddl(
+        "SELECT child.relname FROM pg_inherits JOIN pg_class AS child "
+        "ON child.oid = pg_inherits.inhrelid "
+        f"WHERE pg_inherits.inhparent = to_regclass('{relation}')"
+    )
+    return {relation, *(row["relname"] for row in response)}
+
+
+def _postgres_seq_scans(plan: dict) -> list[str]:
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name", "?"))
+
+    for child in plan.get("Plans", []):
+        found.extend(_postgres_seq_scans(child))
+
+    return found
+
+
+async def find_table_scans() -> dict[str, bool]:
+    """Whether each hot path query would scan the whole of RequestMade"""
+    engine = engine_finder()
+    tablename = RequestMade._meta.tablename
+    scans = {}
+    if engine.engine_type == "postgres":
+        tables = await _postgres_family(engine, tablename)
+
+    for name, query in _hot_queries().items():
+        if engine.engine_type == "postgres":
+            async with engine.transaction():
+                # Small tables are cheaper to scan, so force the planner
+                # to show whether an index path exists at all
+                await engine.run_ddl("SET LOCAL enable_seqscan = off")
+                response = await engine.run_ddl(f"EXPLAIN (FORMAT JSON) {query}")
+
+            plan = response[0]["QUERY PLAN"]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+
+            scanned = bool(tables.intersection(_postgres_seq_scans(plan[0]["Plan"])))
+            if name in REQUIRED_INDEXES:
+                wanted = await _postgres_family(engine, REQUIRED_INDEXES[name][0])
+                indexes = _postgres_indexes(plan[0]["Plan"])
+                scanned = scanned or not wanted.intersection(indexes)
+
+        else:
+            response = await engine.run_ddl(f"EXPLAIN QUERY PLAN {query}")
+            details = [row["detail"] for row in response]
+            # A bare scan walks the table in rowid order, which is only
+            # fine when nothing is filtered or sorted on top of it
+            scanned = any("TEMP B-TREE" in detail for detail in details) or (
+                " WHERE " in query
+                and any(
+                    detail.startswith(f"SCAN {tablename}") and "USING" not in detail
+                    for detail in details
+                )
+            )
+            if name in REQUIRED_INDEXES:
+                table = REQUIRED_INDEXES[name][1]
+                scanned = scanned or not any(
+                    detail.startswith(f"SCAN {table} VIRTUAL TABLE INDEX")
+                    for detail in details
+                )
+
+        scans[name] = scanned
+
+    return scans
+
+
+async def check_plans():
+    """
+    Check the hot path queries on RequestMade can use an index.
+
+    Exits non-zero if any of them would fall back to scanning the
+    whole table, which is what happens when an index goes missing,
+    or if search isn't answered from its trigram index.
+    """
+    scans = await find_table_scans()
+    for name, scanned in scans.items():
+        print(f"{'FAIL' if scanned else 'ok  '} {name}")
+
+    failures = sum(scans.values())
+    if failures:
+        print(f"{failures} queries scan {RequestMade._meta.tablename}")
+        sys.exit(1)
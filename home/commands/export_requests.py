@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import datetime
+import sys
+
+from home import export
+
+
+def _parse_time(value: str) -> datetime.datetime | None:
+    if not value:
+        return None
+
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+
+    return moment
+
+
+async def export_requests(
+    format: str = "ndjson",
+    output: str = "-",
+    domain: str = "",
+    since: str = "",
+    until: str = "",
+):
+    """
+    Export captured requests as NDJSON or CSV.
+
+    :param format:
+        Either ndjson or csv.
+    :param output:
+        The file to write to, defaults to stdout.
+    :param domain:
+        Only export requests made to this domain.
+    :param since:
+        Only export requests made at or after this ISO 8601 time, UTC
+        unless it says otherwise.
+    :param until:
+        Only export requests made before this ISO 8601 time.
+    """
+    if format not in export.EXPORT_FORMATS:
+        sys.exit(f"format must be one of {', '.join(export.EXPORT_FORMATS)}")
+
+    chunks = export.export(
+        format,
+        domain=domain or None,
+        since=_parse_time(since),
+        until=_parse_time(until),
+    )
+    file = sys.stdout.buffer if output == "-" else open(output, "wb")
+    try:
+        async for chunk in chunks:
+            file.write(chunk)
+    finally:
+        if file is not sys.stdout.buffer:
+            file.close()
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import sys
+
+from home import importer
+
+
+async def import_requests(
+    path: str,
+    batch_size: int = importer.IMPORT_BATCH_SIZE,
+    restart: bool = False,
+):
+    """
+    Import captured requests from an NDJSON file, such as one written
+    by export_requests. Requests that are already stored are skipped.
+
+    :param path:
+        The file to import.
+    :param batch_size:
+        How many requests to insert at a time.
+    :param restart:
+        Start from the top of the file, instead of where an interrupted
+        import of it stopped.
+    """
+
+    def report_invalid(line: int, error: str) -> None:
+        print(f"Skipping line {line}: {error}", file=sys.stderr)
+
+    def report_progress(result: importer.ImportResult) -> None:
+        print(
+            f"Read {result.read} lines, inserted {result.inserted}",
+            file=sys.stderr,
+        )
+
+    result = await importer.import_file(
+        path,
+        batch_size=int(batch_size),
+        resume=not restart,
+        on_invalid=report_invalid,
+        on_progress=report_progress,
+    )
+    print(
+        f"Imported {result.inserted} of {result.read} lines, "
+        f"{result.invalid} were invalid"
+    )
@@ -45,7 +45,12 @@ class LogoutController(Controller):
             # Meh this is fine, just redirect it to home
             return Redirect("/")
 
+        user_id = await cls._session_table.get_user_id(cookie)
         await cls._session_table.remove_session(token=cookie)
+        EnsureAuth.forget_session(cookie)
+        if user_id:
+            # Other workers may still have this session cached
+            await EnsureAuth.invalidate_user(user_id)
 
         response: Redirect = Redirect(cls._redirect_to, status_code=HTTP_303_SEE_OTHER)
 
@@ -102,6 +102,8 @@ class PasswordController(Controller):
             return Redirect("/passwords/change")
 
         await user.update_password(user.id, new_password)
+        # Other sessions stay valid but must not keep the old password hash
+        await EnsureAuth.invalidate_user(user.id)
         alert(
             request,
             "Successfully changed password, please reauthenticate.",
@@ -0,0 +1,65 @@
+"""Settings every worker process has to agree on.
+
+With more than one uvicorn worker, anything signed or encrypted by one
+worker must be readable by the others, so secrets are derived from a
+single key rather than generated per process.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import tempfile
+
+from dotenv import load_dotenv
+
+load_dotenv()
+log = logging.getLogger(__name__)
+WEB_WORKERS: int = int(os.environ.get("WEB_WORKERS", 1))
+MULTI_WORKER: bool = WEB_WORKERS > 1
+SECRET_KEY_FILE: str = os.environ.get("SECRET_KEY_FILE", ".secret_key")
+
+
+def _load_or_create_key_file(path: str) -> bytes:
+    try:
+        with open(path, "rb") as file:
+            return bytes.fromhex(file.read().decode().strip())
+    except FileNotFoundError:
+        pass
+
+    # Write it elsewhere then hard link it into place, which fails if
+    # another worker got there first. Either way we read back the winner.
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(secrets.token_hex(32))
+
+        os.link(temp_path, path)
+        log.info("Generated a new secret key in %s", path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(temp_path)
+
+    with open(path, "rb") as file:
+        return bytes.fromhex(file.read().decode().strip())
+
+
+def _secret_key() -> bytes:
+    key = os.environ.get("SECRET_KEY")
+    if key:
+        return key.encode()
+
+    return _load_or_create_key_file(SECRET_KEY_FILE)
+
+
+SECRET_KEY: bytes = _secret_key()
+
+
+def derive_secret(purpose: str, length: int = 32) -> bytes:
+    """A secret for purpose which is the same in every worker"""
+    return hmac.new(SECRET_KEY, purpose.encode(), hashlib.sha256).digest()[:length]
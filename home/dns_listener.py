@@ -0,0 +1,397 @@
+"""An authoritative DNS listener for the SERVING_DOMAIN zones.
+
+A lookup of a canary name is often the only callout a blind SSRF
+or injection makes, so every query for one of our zones is recorded
+as a DnsQuery. Answers are built straight from the query packet and
+rows go through dns_queue without waiting on it, so the database is
+never between a query and its answer.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import struct
+import uuid
+from typing import NamedTuple
+
+import commons
+from dotenv import load_dotenv
+
+from home.metrics import DNS_QUERIES, DNS_TCP_REJECTED
+from home.tables import DnsQuery
+from home.tokens import normalise_host, token_index
+from home.write_queue import dns_queue
+
+load_dotenv()
+log = logging.getLogger(__name__)
+DNS_ENABLED: bool = commons.value_to_bool(os.environ.get("DNS_ENABLED", False))
+DNS_HOST: str = os.environ.get("DNS_HOST", "0.0.0.0")
+DNS_PORT: int = int(os.environ.get("DNS_PORT", 53))
+
+
+def _split_env(name: str, default: str = "") -> list[str]:
+    values = os.environ.get(name, default).split(",")
+    return [value.strip() for value in values if value.strip()]
+
+
+# Comma separated, every name under these is answered and recorded
+DNS_ZONES: list[str] = [
+    normalise_host(zone)
+    for zone in _split_env("DNS_ZONES", os.environ.get("SERVING_DOMAIN", ""))
+]
+# Comma separated addresses every name in the zones resolves to
+DNS_ANSWER_A: list[str] = _split_env("DNS_ANSWER_A")
+DNS_ANSWER_AAAA: list[str] = _split_env("DNS_ANSWER_AAAA")
+# Zero stops resolvers caching answers, so repeat lookups reach us too
+DNS_TTL: int = int(os.environ.get("DNS_TTL", 0))
+# How long a TCP client may sit idle before being hung up on
+DNS_TCP_TIMEOUT: float = 10
+# Any more TCP connections than this are closed straight away
+DNS_TCP_MAX_CONNECTIONS: int = int(os.environ.get("DNS_TCP_MAX_CONNECTIONS", 64))
+
+# Without EDNS a UDP answer has to fit in this
+MAX_UDP_SIZE: int = 512
+CLASS_IN: int = 1
+CLASS_ANY: int = 255
+TYPE_A: int = 1
+TYPE_AAAA: int = 28
+TYPE_ANY: int = 255
+QTYPE_NAMES: dict[int, str] = {
+    1: "A",
+    2: "NS",
+    5: "CNAME",
+    6: "SOA",
+    12: "PTR",
+    15: "MX",
+    16: "TXT",
+    28: "AAAA",
+    33: "SRV",
+    64: "SVCB",
+    65: "HTTPS",
+    255: "ANY",
+    257: "CAA",
+}
+
+RCODE_NOERROR: int = 0
+RCODE_FORMERR: int = 1
+RCODE_NOTIMP: int = 4
+RCODE_REFUSED: int = 5
+
+FLAG_QR: int = 0x8000
+FLAG_OPCODE: int = 0x7800
+FLAG_AA: int = 0x0400
+FLAG_TC: int = 0x0200
+FLAG_RD: int = 0x0100
+
+# How each byte of a label is written out. Anything which could be
+# mistaken for a dot, or that a Text column won't hold, is escaped
+_LABEL_CHARS: list[str] = [
+    chr(byte) if 0x21 <= byte <= 0x7E and chr(byte) not in ".\\" else f"\\x{byte:02x}"
+    for byte in range(256)
+]
+
+_HEADER = struct.Struct("!HHHHHH")
+# An answer's name is always a pointer back to the question at offset 12
+_ANSWER = struct.Struct("!HHHIH")
+
+
+class DnsFormatError(ValueError):
+    pass
+
+
+class Question(NamedTuple):
+    qname: str
+    qtype: int
+    qclass: int
+    # Offset of the first byte after the question
+    end: int
+
+
+def qtype_name(qtype: int) -> str:
+    return QTYPE_NAMES.get(qtype, f"TYPE{qtype}")
+
+
+def parse_question(packet: bytes) -> Question:
+    """The first question in a query packet, its name lower cased.
+
+    Bytes outside printable ASCII, dots and backslashes within a
+    label are written as ``\\xNN``.
+    """
+    labels = []
+    offset = _HEADER.size
+    try:
+        while True:
+            length = packet[offset]
+            offset += 1
+            if length == 0:
+                break
+
+            # Compression pointers and the extended label types
+            # have no business in the question of a query
+            if length & 0xC0:
+                raise DnsFormatError("Unsupported label type")
+
+            label = packet[offset : offset + length]
+            if len(label) != length:
+                raise DnsFormatError("Truncated label")
+
+            labels.append(label)
+            offset += length
+            if offset > 255 + _HEADER.size:
+                raise DnsFormatError("Name too long")
+
+        qtype, qclass = struct.unpack_from("!HH", packet, offset)
+    except (IndexError, struct.error) as e:
+        raise DnsFormatError("Truncated question") from e
+
+    qname = ".".join(
+        "".join(map(_LABEL_CHARS.__getitem__, label)) for label in labels
+    ).lower()
+    return Question(qname, qtype, qclass, offset + 4)
+
+
+def _answer(rtype: int, ttl: int, rdata: bytes) -> bytes:
+    return _ANSWER.pack(0xC00C, rtype, CLASS_IN, ttl, len(rdata)) + rdata
+
+
+class DnsResponder:
+    """Answers queries for names in zones, and records them.
+
+    Every name in a zone resolves to the configured addresses, names
+    outside them are refused without being recorded.
+    """
+
+    def __init__(self, zones: list[str], a: list[str], aaaa: list[str], ttl: int = 0):
+        # Longest first, so the most specific zone wins
+        self.zones = sorted(set(zones), key=len, reverse=True)
+        a_answers = [
+            _answer(TYPE_A, ttl, socket.inet_pton(socket.AF_INET, address))
+            for address in a
+        ]
+        aaaa_answers = [
+            _answer(TYPE_AAAA, ttl, socket.inet_pton(socket.AF_INET6, address))
+            for address in aaaa
+        ]
+        # qtype -> (answer count, answer section)
+        self._answers: dict[int, tuple[int, bytes]] = {
+            TYPE_A: (len(a_answers), b"".join(a_answers)),
+            TYPE_AAAA: (len(aaaa_answers), b"".join(aaaa_answers)),
+            TYPE_ANY: (
+                len(a_answers) + len(aaaa_answers),
+                b"".join(a_answers + aaaa_answers),
+            ),
+        }
+
+    def zone_for(self, qname: str) -> str | None:
+        for zone in self.zones:
+            if qname == zone or qname.endswith(f".{zone}"):
+                return zone
+
+        return None
+
+    def respond(
+        self, packet: bytes, source: str, protocol: str, max_size: int = 65535
+    ) -> bytes | None:
+        """The answer to packet, or None if it deserves no answer at all"""
+        if len(packet) < _HEADER.size:
+            return None
+
+        query_id, flags, qdcount = struct.unpack_from("!HHH", packet)
+        # Never answer answers, that way lies a loop
+        if flags & FLAG_QR:
+            return None
+
+        flags = FLAG_QR | (flags & (FLAG_OPCODE | FLAG_RD))
+        if flags & FLAG_OPCODE:
+            return _HEADER.pack(query_id, flags | RCODE_NOTIMP, 0, 0, 0, 0)
+
+        try:
+            if qdcount != 1:
+                raise DnsFormatError("Expected exactly one question")
+
+            question = parse_question(packet)
+        except DnsFormatError:
+            return _HEADER.pack(query_id, flags | RCODE_FORMERR, 0, 0, 0, 0)
+
+        echoed = packet[_HEADER.size : question.end]
+        zone = self.zone_for(question.qname)
+        if zone is None or question.qclass not in (CLASS_IN, CLASS_ANY):
+            return _HEADER.pack(query_id, flags | RCODE_REFUSED, 1, 0, 0, 0) + echoed
+
+        self.record(question, zone, source, protocol)
+        count, answers = self._answers.get(question.qtype, (0, b""))
+        response = (
+            _HEADER.pack(query_id, flags | FLAG_AA | RCODE_NOERROR, 1, count, 0, 0)
+            + echoed
+            + answers
+        )
+        if len(response) > max_size:
+            # Tells the resolver to ask again over TCP
+            return (
+                _HEADER.pack(query_id, flags | FLAG_AA | FLAG_TC, 1, 0, 0, 0) + echoed
+            )
+
+        return response
+
+    def record(self, question: Question, zone: str, source: str, protocol: str):
+        qtype = qtype_name(question.qtype)
+        DNS_QUERIES.inc(qtype=qtype)
+        dns_queue.put_nowait(
+            DnsQuery(
+                qname=question.qname,
+                qtype=qtype,
+                source=source,
+                protocol=protocol,
+                made_at=datetime.datetime.now(datetime.timezone.utc),
+                uuid=uuid.uuid4(),
+                zone=zone,
+                token=token_index.match(question.qname, ""),
+            )
+        )
+
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, responder: DnsResponder):
+        self.responder = responder
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport  # type: ignore[assignment]
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        try:
+            response = self.responder.respond(data, addr[0], "udp", MAX_UDP_SIZE)
+        except Exception:
+            log.exception("Failed to answer a DNS query from %s", addr[0])
+            return
+
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+    def error_received(self, exc: Exception) -> None:
+        # Usually an ICMP unreachable for an earlier answer, nothing to do
+        log.debug("DNS socket error: %s", exc)
+
+
+class DnsListener:
+    """Serves a DnsResponder over both UDP and TCP.
+
+    Ports are bound with SO_REUSEPORT so every worker can listen on
+    the same one, and the kernel spreads queries between them.
+    """
+
+    def __init__(
+        self,
+        responder: DnsResponder,
+        host: str,
+        port: int,
+        *,
+        max_connections: int = DNS_TCP_MAX_CONNECTIONS,
+    ):
+        self.responder = responder
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self._transport: asyncio.DatagramTransport | None = None
+        self._server: asyncio.Server | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def running(self) -> bool:
+        return self._transport is not None
+
+    @property
+    def active(self) -> int:
+        return len(self._tasks)
+
+    async def start(self) -> None:
+        if self._transport is not None:
+            return
+
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UdpProtocol(self.responder),
+            local_addr=(self.host, self.port),
+            reuse_port=True,
+        )
+        self._server = await asyncio.start_server(
+            self._handle_tcp, self.host, self.port, reuse_port=True
+        )
+
+    async def stop(self) -> None:
+        if self._transport is None:
+            return
+
+        self._transport.close()
+        self._transport = None
+        self._server.close()
+        for task in list(self._tasks):
+            task.cancel()
+
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _handle_tcp(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        if self.active >= self.max_connections:
+            DNS_TCP_REJECTED.inc()
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        source = writer.get_extra_info("peername")[0]
+        try:
+            # Each message is prefixed with its length, and a client
+            # may send several before hanging up
+            while True:
+                (length,) = struct.unpack(
+                    "!H",
+                    await asyncio.wait_for(reader.readexactly(2), DNS_TCP_TIMEOUT),
+                )
+                packet = await asyncio.wait_for(
+                    reader.readexactly(length), DNS_TCP_TIMEOUT
+                )
+                response = self.responder.respond(packet, source, "tcp")
+                if response is None:
+                    break
+
+                writer.write(struct.pack("!H", len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            log.exception("Failed to answer a DNS query from %s", source)
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+
+dns_listener = DnsListener(
+    DnsResponder(DNS_ZONES, DNS_ANSWER_A, DNS_ANSWER_AAAA, DNS_TTL),
+    DNS_HOST,
+    DNS_PORT,
+    max_connections=DNS_TCP_MAX_CONNECTIONS,
+)
+
+
+async def start_dns():
+    if not DNS_ENABLED:
+        return
+
+    if not DNS_ZONES:
+        log.warning("DNS_ENABLED is set but there are no zones to answer for")
+        return
+
+    await dns_queue.start()
+    await dns_listener.start()
+
+
+async def stop_dns():
+    await dns_listener.stop()
+    await dns_queue.stop()
@@ -1,30 +1,56 @@
+import asyncio
+import datetime
+import hmac
+import logging
 import os
 import uuid
+from typing import AsyncGenerator
+from urllib.parse import urlencode
 
 import commons
 import humanize
 import orjson
 from dotenv import load_dotenv
-from litestar import get, MediaType, route, Request
-from litestar.exceptions import NotFoundException
-from litestar.response import Template
+from litestar import get, MediaType, route, Request, Response
+from litestar.exceptions import (
+    NotFoundException,
+    NotAuthorizedException,
+    ValidationException,
+)
+from litestar.response import Template, File, ServerSentEvent, Stream
+from litestar.response.sse import ServerSentEventMessage
+from litestar.status_codes import HTTP_200_OK
 
-from home.middleware import EnsureAuth
-from home.tables import RequestMade
-from home.util import get_csp
+from home import capture, export, listing, metrics, page_cache, search
+from home.blob_store import blob_store
+from home.dns_listener import dns_listener
+from home.middleware import EnsureAuth, RequireUser
+from home.page_cache import listing_cache
+from home.pubsub import pubsub, REQUESTS_CHANNEL
+from home.tables import CallbackToken, RequestMade
+from home.tokens import normalise_host, token_index
+from home.util import get_csp, render_template
+from home.util.flash import alert
+from home.write_queue import request_queue
 
 load_dotenv()
+log = logging.getLogger(__name__)
 HIDE_QUERY_PARAMS = commons.value_to_bool(os.environ.get("HIDE_QUERY_PARAMS"))
 HIDE_URLS: bool = commons.value_to_bool(os.environ.get("HIDE_URLS"))
-IGNORE_FROM_SELF: bool = commons.value_to_bool(os.environ.get("IGNORE_FROM_SELF"))
+BODY_PREVIEW_SIZE: int = 4096
+# Lets the server notice closed live feeds while no requests arrive
+LIVE_KEEPALIVE_INTERVAL: float = 15
 
 
 @get("/b/requests/{request_uuid: str}", middleware=[EnsureAuth])
 async def view_authed_request(request_uuid: uuid.UUID) -> Template:
     csp, nonce = get_csp()
-    request_made: RequestMade = await RequestMade.objects().get(
-        RequestMade.uuid == request_uuid
-    )
+    with metrics.DB_QUERY_SECONDS.time(query="request_by_uuid"):
+        request_made: RequestMade = (
+            await RequestMade.objects()
+            .get(RequestMade.uuid == request_uuid)
+            .output(load_json=True)
+        )
     if request_made is None:
         raise NotFoundException
 
@@ -34,7 +60,7 @@ async def view_authed_request(request_uuid: uuid.UUID) -> Template:
             "title": f"Request {request_made.uuid}",
             "csp_nonce": nonce,
             "request_made": request_made,
-            "headers": orjson.loads(request_made.headers),
+            "body_preview": request_made.body_raw[:BODY_PREVIEW_SIZE].hex(" "),
             "made_at": humanize.naturaldate(request_made.made_at),
             "made_at_time": humanize.naturaltime(request_made.made_at),
         },
@@ -43,6 +69,36 @@ async def view_authed_request(request_uuid: uuid.UUID) -> Template:
     )
 
 
+@get("/b/requests/{request_uuid: str}/body", middleware=[EnsureAuth])
+async def view_authed_request_body(request_uuid: uuid.UUID) -> File | Response:
+    request_made = (
+        await RequestMade.select(
+            RequestMade.body,
+            RequestMade.body_raw,
+            RequestMade.body_hash,
+        )
+        .where(RequestMade.uuid == request_uuid)
+        .first()
+    )
+    if request_made is None:
+        raise NotFoundException
+
+    # Always a download, these bodies are attacker controlled
+    filename = f"{request_uuid}.bin"
+    if request_made["body_hash"]:
+        return File(
+            path=blob_store.path_for(request_made["body_hash"]),
+            filename=filename,
+            media_type="application/octet-stream",
+        )
+
+    return Response(
+        content=request_made["body_raw"] or request_made["body"].encode("utf-8"),
+        media_type="application/octet-stream",
+        headers={"content-disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @route(
     ["", "/{full_path:path}"],
     http_method=[
@@ -55,41 +111,308 @@ async def view_authed_request(request_uuid: uuid.UUID) -> Template:
         "PUT",
         "PATCH",
     ],
+    # Callouts never carry our CSRF token, and capture.read_body
+    # enforces its own limit rather than rejecting large bodies
+    exclude_from_csrf=True,
+    request_max_body_size=None,
+    # Callouts get their own, far more generous, limits
+    rate_limit="capture",
 )
-async def catch_all(request: Request, full_path: str = "/") -> Template:
-    request.scope["user"] = await EnsureAuth.get_user_from_connection(
-        request, fail_on_not_set=False
-    )
-    csp, nonce = get_csp()
-    if not (IGNORE_FROM_SELF and request.user is not None):
+async def catch_all(request: Request, full_path: str = "/") -> Template | Response:
+    render_page = capture.should_render_page(request)
+    maybe_self = capture.IGNORE_FROM_SELF and capture.may_be_own_user(request)
+    if maybe_self or render_page:
+        request.scope["user"] = await EnsureAuth.get_user_from_connection(
+            request, fail_on_not_set=False
+        )
+    else:
+        request.scope["user"] = None
+
+    if not (maybe_self and request.user is not None):
         headers_list: list[tuple[bytes, bytes]] = request.headers.to_header_list()
-        headers_dict = {
-            k.decode("latin-1"): v.decode("latin-1") for k, v in headers_list
-        }
+        # Pairs rather than a dict, so repeated headers are all kept
+        header_pairs = [
+            (
+                capture.escape_nul(k.decode("latin-1")),
+                capture.escape_nul(v.decode("latin-1")),
+            )
+            for k, v in headers_list
+        ]
+        domain = capture.escape_nul(request.headers["host"])
+        body = await capture.read_body(request)
+        token = token_index.match(domain, full_path)
+        metrics.CAPTURED.inc(method=request.method, domain=domain)
+        metrics.BODY_BYTES.observe(body.size)
         request_made: RequestMade = RequestMade(
-            headers=orjson.dumps(headers_dict).decode("utf-8"),
-            body=(await request.body()).decode("utf-8"),
-            url=full_path,
-            query_params=request.url.query,
+            headers=orjson.dumps(header_pairs).decode("utf-8"),
+            **await capture.body_columns(body, request.headers.get("content-type", "")),
+            url=capture.escape_nul(full_path),
+            query_params=capture.escape_nul(request.url.query),
             type=request.method,
-            domain=request.headers["host"],
+            domain=domain,
+            token=token,
         )
-        await request_made.save()
+        await request_queue.put(request_made)
+
+    if not render_page:
+        return capture.minimal_response(request)
+
+    # Make sure the listing includes anything still sat in the queue,
+    # though if that fails the page still shows what is already stored
+    try:
+        await request_queue.flush()
+    except Exception:
+        log.exception("Failed to flush queued requests before rendering")
+
+    if capture.wants_html(request) or capture.CAPTURE_RESPONSE == "page":
+        return await home_page(request)
+
+    # A callout in cached mode which found the cache cold
+    capture.set_cached_page(capture.page_key(request), await home_page_html(request))
+    return capture.minimal_response(request)
+
+
+@get("/b/requests", middleware=[EnsureAuth])
+async def view_requests_page(
+    request: Request,
+    before: int | None = None,
+    after: int | None = None,
+    q: str | None = None,
+    token: int | None = None,
+) -> Template | Response:
+    if q is not None:
+        try:
+            q = search.validate_term(q)
+        except ValueError as e:
+            alert(request, str(e), level="error")
+            q = None
+
+    if before is None and after is None and q is None and token is None:
+        return await home_page(request)
+
+    token_label = None
+    if token is not None:
+        token_row = (
+            await CallbackToken.select(CallbackToken.label)
+            .where(CallbackToken.id == token)
+            .first()
+        )
+        if token_row is None:
+            raise NotFoundException
+
+        token_label = token_row["label"]
+
+    page = await listing.fetch_page(
+        before=before,
+        after=after,
+        domain=listing_domain(request),
+        search=q,
+        token=token,
+    )
+    return listing_template(page, search=q, token=token, token_label=token_label)
+
+
+@get("/b/api/requests", middleware=[EnsureAuth])
+async def list_requests(
+    request: Request,
+    before: int | None = None,
+    after: int | None = None,
+    limit: int = 25,
+    domain: str | None = None,
+    method: str | None = None,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+    url_prefix: str | None = None,
+    q: str | None = None,
+    token: int | None = None,
+    header_name: str | None = None,
+    header_value: str | None = None,
+    fields: str | None = None,
+) -> dict:
+    try:
+        columns = listing.parse_fields(fields)
+        if q is not None:
+            q = search.validate_term(q)
+        if header_value is not None and not header_name:
+            raise ValueError("header_value needs a header_name")
+    except ValueError as e:
+        raise ValidationException(str(e)) from e
+
+    page = await listing.fetch_page(
+        before=before,
+        after=after,
+        limit=limit,
+        domain=listing_domain(request) or domain,
+        method=method,
+        since=since,
+        until=until,
+        url_prefix=url_prefix,
+        search=q,
+        token=token,
+        header_name=header_name,
+        header_value=header_value,
+        fields=columns,
+    )
+    return {"requests": page.rows, "older": page.older, "newer": page.newer}
 
-    request_query = RequestMade.objects().order_by(RequestMade.id, ascending=False)
-    if commons.value_to_bool(os.environ.get("ONLY_SHOW_CURRENT_DOMAIN", False)) is True:
-        request_query = request_query.where(
-            RequestMade.domain == request.headers["host"]
+
+@get("/b/api/dns", middleware=[EnsureAuth])
+async def list_dns_queries(
+    request: Request,
+    before: int | None = None,
+    limit: int = 25,
+    zone: str | None = None,
+    token: int | None = None,
+) -> dict:
+    host = listing_domain(request)
+    if host is not None:
+        host = normalise_host(host)
+        if dns_listener.responder.zone_for(host) is None:
+            return {"queries": [], "older": None, "newer": None}
+
+    page = await listing.fetch_dns_page(
+        before=before, limit=limit, zone=zone, host=host, token=token
+    )
+    return {"queries": page.rows, "older": page.older, "newer": page.newer}
+
+
+@get("/b/api/requests/export", middleware=[RequireUser])
+async def export_requests(
+    request: Request,
+    format: str = "ndjson",
+    domain: str | None = None,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+) -> Stream:
+    if format not in export.EXPORT_FORMATS:
+        raise ValidationException(f"format must be one of {export.EXPORT_FORMATS}")
+
+    return Stream(
+        export.export(
+            format, domain=listing_domain(request) or domain, since=since, until=until
+        ),
+        media_type="text/csv" if format == "csv" else "application/x-ndjson",
+        headers={"content-disposition": f'attachment; filename="requests.{format}"'},
+    )
+
+
+@get("/b/live", middleware=[EnsureAuth])
+async def live_requests(request: Request) -> ServerSentEvent:
+    domain = listing_domain(request)
+
+    async def events() -> AsyncGenerator[ServerSentEventMessage, None]:
+        async with pubsub.subscribe(REQUESTS_CHANNEL) as messages:
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        messages.get(), LIVE_KEEPALIVE_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    yield ServerSentEventMessage(comment="keepalive")
+                    continue
+
+                for summary in message["requests"]:
+                    if domain is not None and summary["domain"] != domain:
+                        continue
+
+                    yield ServerSentEventMessage(
+                        data=orjson.dumps(
+                            {"uuid": summary["uuid"], "label": request_label(summary)}
+                        ).decode(),
+                        event="request",
+                    )
+
+    return ServerSentEvent(events())
+
+
+@get("/b/metrics", include_in_schema=False)
+async def view_metrics(request: Request) -> Response:
+    if not metrics.METRICS_TOKEN:
+        raise NotFoundException
+
+    expected = f"Bearer {metrics.METRICS_TOKEN}"
+    if not hmac.compare_digest(request.headers.get("authorization", ""), expected):
+        raise NotAuthorizedException
+
+    return Response(
+        content=metrics.render(),
+        media_type="text/plain; version=0.0.4",
+        status_code=HTTP_200_OK,
+    )
+
+
+def request_label(summary: dict) -> str:
+    """The link text home.jinja would show for this request"""
+    if HIDE_URLS:
+        made_at = datetime.datetime.fromisoformat(summary["made_at"])
+        return f"{summary['type']} - {made_at.strftime('%-I:%M:%S %p, %d-%m-%Y %Z')}"
+
+    label = f"{summary['type']} {summary['url']}"
+    if not HIDE_QUERY_PARAMS and summary["query_params"]:
+        label += f"?{summary['query_params']}"
+
+    return label
+
+
+def listing_domain(request: Request) -> str | None:
+    """The domain listings are restricted to, if any"""
+    if capture.ONLY_SHOW_CURRENT_DOMAIN:
+        return request.headers["host"]
+
+    return None
+
+
+async def home_page(request: Request) -> Template | Response:
+    """The newest page of requests, served from listing_cache if possible"""
+    if not listing_cache.cacheable(request):
+        return listing_template(
+            await listing.fetch_page(domain=listing_domain(request))
         )
 
-    requests = await request_query.limit(25)
+    return page_cache.respond(await home_page_html(request))
+
 
+async def home_page_html(request: Request) -> str:
+    """The newest page of requests rendered with a nonce placeholder"""
+    domain = listing_domain(request)
+    key = listing_cache.key(request, domain)
+    html = listing_cache.get(key)
+    if html is None:
+        generation = listing_cache.generation
+        template = listing_template(await listing.fetch_page(domain=domain))
+        template.context["csp_nonce"] = page_cache.NONCE_PLACEHOLDER
+        html = render_template(request, template)
+        if listing_cache.cacheable(request):
+            listing_cache.set(key, html, generation)
+
+    return html
+
+
+def listing_template(
+    page: listing.Page,
+    search: str | None = None,
+    token: int | None = None,
+    token_label: str | None = None,
+) -> Template:
+    csp, nonce = get_csp()
+    # Carried over to the newer and older links
+    filters = {
+        name: value
+        for name, value in (("q", search), ("token", token))
+        if value is not None
+    }
     return Template(
         template_name="home.jinja",
         context={
             "title": "Incoming requests",
             "csp_nonce": nonce,
-            "requests": requests,
+            "requests": page.rows,
+            "older": page.older,
+            "newer": page.newer,
+            "search": search,
+            "token": token,
+            "token_label": token_label,
+            "filter_params": f"&{urlencode(filters)}" if filters else "",
             "show_query_params": not HIDE_QUERY_PARAMS,
             "hide_urls": HIDE_URLS,
         },
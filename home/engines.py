@@ -0,0 +1,406 @@
+"""Database engines tuned for how Blurp uses them.
+
+Piccolo's SQLiteEngine opens a new connection per query in the
+default rollback journal mode, so a burst of callouts ends up
+queueing on the database lock and failing with "database is
+locked". TunedSQLiteEngine switches to WAL, where readers never
+block the writer, and funnels every write in this process through
+one connection and one task. Writes that arrive together are
+committed together, and reads are spread over a small pool of
+connections of their own.
+
+TunedPostgresEngine takes its pool settings from the environment,
+gives up waiting on a busy pool rather than queueing forever, and
+inserts batches with one statement whatever their size, so asyncpg
+prepares it once per connection and reuses it from then on.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, NamedTuple
+
+import aiosqlite
+import asyncpg
+import commons
+from dotenv import load_dotenv
+from piccolo.engine.postgres import PostgresEngine, PostgresTransaction
+from piccolo.engine.sqlite import SQLiteEngine, TransactionType, dict_factory
+from piccolo.querystring import QueryString
+from piccolo.table import Table
+
+from home.metrics import DB_POOL_TIMEOUTS, DB_POOL_WAIT_SECONDS
+
+load_dotenv()
+log = logging.getLogger(__name__)
+SQLITE_TUNED: bool = commons.value_to_bool(os.environ.get("SQLITE_TUNED", True))
+SQLITE_PATH: str = os.environ.get("SQLITE_PATH", "piccolo.sqlite")
+# One of: OFF, NORMAL, FULL. NORMAL can only lose the last few
+# commits on power loss under WAL, never corrupt the database.
+SQLITE_SYNCHRONOUS: str = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+SQLITE_CACHE_SIZE_KB: int = int(os.environ.get("SQLITE_CACHE_SIZE_KB", 64_000))
+SQLITE_MMAP_SIZE: int = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+# How long to wait on another process holding the write lock
+SQLITE_BUSY_TIMEOUT: float = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 30))
+SQLITE_READ_CONNECTIONS: int = int(os.environ.get("SQLITE_READ_CONNECTIONS", 4))
+# Per worker, asyncpg opens min_size up front and grows to max_size
+POSTGRES_POOL_MIN_SIZE: int = int(os.environ.get("POSTGRES_POOL_MIN_SIZE", 2))
+POSTGRES_POOL_MAX_SIZE: int = int(os.environ.get("POSTGRES_POOL_MAX_SIZE", 10))
+# How long a query waits for a free connection before giving up
+POSTGRES_POOL_TIMEOUT: float = float(os.environ.get("POSTGRES_POOL_TIMEOUT", 5))
+# Idle connections above min_size are closed after this many seconds
+POSTGRES_POOL_MAX_IDLE: float = float(os.environ.get("POSTGRES_POOL_MAX_IDLE", 300))
+# Prepared statements kept per connection, zero when behind pgbouncer
+POSTGRES_STATEMENT_CACHE_SIZE: int = int(
+    os.environ.get("POSTGRES_STATEMENT_CACHE_SIZE", 100)
+)
+# Zero leaves statements to run as long as they need
+POSTGRES_COMMAND_TIMEOUT: float = float(os.environ.get("POSTGRES_COMMAND_TIMEOUT", 60))
+
+# The most queued writes committed in one transaction
+WRITE_GROUP_SIZE: int = 256
+
+
+class DatabaseUnavailable(Exception):
+    """No database connection came free in time"""
+
+
+class _Write(NamedTuple):
+    query: str
+    args: list[Any]
+    query_type: str
+    table: type[Table] | None
+    future: asyncio.Future
+
+
+class TunedSQLiteEngine(SQLiteEngine):
+    """A SQLiteEngine for running under load.
+
+    Until start_connection_pool is called, as with the piccolo CLI,
+    this behaves like SQLiteEngine apart from the pragmas. Afterwards
+    SELECTs outside a transaction go to the read connections and every
+    other statement is handed to the writer task. Transactions keep
+    their own connection, but take the write lock as they begin.
+    """
+
+    def __init__(
+        self,
+        path: str = "piccolo.sqlite",
+        read_connections: int = 4,
+        **connection_kwargs,
+    ) -> None:
+        connection_kwargs.setdefault("timeout", SQLITE_BUSY_TIMEOUT)
+        super().__init__(path=path, **connection_kwargs)
+        self.read_connections = read_connections
+        self._readers: asyncio.Queue[aiosqlite.Connection] | None = None
+        self._writer: aiosqlite.Connection | None = None
+        self._writes: asyncio.Queue[_Write] | None = None
+        self._writer_task: asyncio.Task | None = None
+        self._wal_enabled: bool = False
+
+    async def get_connection(self) -> aiosqlite.Connection:
+        connection = await aiosqlite.connect(**self.connection_kwargs)
+        connection.row_factory = dict_factory  # type: ignore
+        if not self._wal_enabled:
+            # Sticks to the database file, so only needs doing once
+            await connection.execute("PRAGMA journal_mode = WAL")
+            self._wal_enabled = True
+
+        for pragma in (
+            "PRAGMA foreign_keys = 1",
+            f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}",
+            f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}",
+            f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}",
+            "PRAGMA temp_store = MEMORY",
+        ):
+            await connection.execute(pragma)
+
+        return connection
+
+    async def _run_in_new_connection(
+        self,
+        query: str,
+        args: list[Any] | None = None,
+        query_type: str = "generic",
+        table=None,
+    ):
+        connection = await self.get_connection()
+        try:
+            return await self._execute(connection, query, args or [], query_type, table)
+        finally:
+            await connection.close()
+
+    async def _execute(
+        self,
+        connection: aiosqlite.Connection,
+        query: str,
+        args: list[Any],
+        query_type: str = "generic",
+        table: type[Table] | None = None,
+    ) -> list[dict[str, Any]]:
+        async with connection.execute(query, args) as cursor:
+            response = await cursor.fetchall()
+            if query_type == "insert" and self.get_version_sync() < 3.35:
+                # Too old for RETURNING, so the key is looked up instead
+                pk = await self._get_inserted_pk(cursor, table)
+                return [{table._meta.primary_key._meta.db_column_name: pk}]
+
+            return response
+
+    ###########################################################################
+
+    @property
+    def pooled(self) -> bool:
+        return self._writer_task is not None
+
+    async def start_connection_pool(self, **kwargs) -> None:
+        if self.pooled:
+            return
+
+        self._writer = await self.get_connection()
+        self._writes = asyncio.Queue()
+        self._readers = asyncio.Queue()
+        for _ in range(self.read_connections):
+            self._readers.put_nowait(await self.get_connection())
+
+        self._writer_task = asyncio.create_task(self._write_loop())
+
+    async def close_connection_pool(self) -> None:
+        if not self.pooled:
+            return
+
+        # Let everything already queued be written first
+        await self._writes.put(None)  # type: ignore[arg-type]
+        task, self._writer_task = self._writer_task, None
+        await task
+
+        await self._writer.close()
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+
+        self._writer = self._writes = self._readers = None
+
+    def transaction(
+        self,
+        transaction_type: TransactionType = TransactionType.immediate,
+        allow_nested: bool = True,
+    ):
+        """Immediate by default, as a deferred transaction which reads
+        then writes can't wait for the lock and fails straight away"""
+        return super().transaction(transaction_type, allow_nested)
+
+    async def run_querystring(self, querystring: QueryString, in_pool: bool = False):
+        if not self.pooled or self.current_transaction.get():
+            return await super().run_querystring(querystring, in_pool)
+
+        query_id = self.get_query_id()
+        if self.log_queries:
+            self.print_query(query_id=query_id, query=querystring.__str__())
+
+        query, args = querystring.compile_string(engine_type=self.engine_type)
+        if query.lstrip()[:6].upper() == "SELECT":
+            response = await self._read(query, args)
+        else:
+            response = await self._write(
+                query, args, querystring.query_type, querystring.table
+            )
+
+        if self.log_responses:
+            self.print_response(query_id=query_id, response=response)
+
+        return response
+
+    async def run_ddl(self, ddl: str, in_pool: bool = False):
+        if not self.pooled or self.current_transaction.get():
+            return await super().run_ddl(ddl, in_pool)
+
+        return await self._write(ddl, [])
+
+    async def _read(self, query: str, args: list[Any]) -> list[dict[str, Any]]:
+        connection = await self._readers.get()
+        try:
+            return await self._execute(connection, query, args)
+        finally:
+            self._readers.put_nowait(connection)
+
+    async def _write(
+        self,
+        query: str,
+        args: list[Any],
+        query_type: str = "generic",
+        table: type[Table] | None = None,
+    ) -> list[dict[str, Any]]:
+        future = asyncio.get_running_loop().create_future()
+        self._writes.put_nowait(_Write(query, args, query_type, table, future))
+        return await future
+
+    async def _write_loop(self) -> None:
+        while True:
+            write = await self._writes.get()
+            if write is None:
+                return
+
+            writes = [write]
+            while len(writes) < WRITE_GROUP_SIZE and not self._writes.empty():
+                write = self._writes.get_nowait()
+                if write is None:
+                    # Put the shutdown marker back for after this group
+                    self._writes.put_nowait(write)
+                    break
+
+                writes.append(write)
+
+            try:
+                await self._commit(writes)
+            except Exception as e:
+                log.exception("Failed to commit %s writes", len(writes))
+                for write in writes:
+                    if not write.future.done():
+                        write.future.set_exception(e)
+
+    async def _commit(self, writes: list[_Write]) -> None:
+        writes = [write for write in writes if not write.future.cancelled()]
+        if len(writes) == 1:
+            # Nothing to group with, so autocommit saves a round trip
+            write = writes[0]
+            try:
+                write.future.set_result(await self._execute(self._writer, *write[:4]))
+            except Exception as e:
+                write.future.set_exception(e)
+            return
+
+        results: list[tuple[_Write, Any, Exception | None]] = []
+        await self._writer.execute("BEGIN IMMEDIATE")
+        try:
+            for write in writes:
+                # A savepoint each, so one failing write doesn't
+                # take the others in its group down with it
+                await self._writer.execute("SAVEPOINT write")
+                try:
+                    response = await self._execute(self._writer, *write[:4])
+                except Exception as e:
+                    await self._writer.execute("ROLLBACK TO write")
+                    results.append((write, None, e))
+                else:
+                    results.append((write, response, None))
+
+                await self._writer.execute("RELEASE write")
+
+            await self._writer.execute("COMMIT")
+        except BaseException:
+            await self._writer.execute("ROLLBACK")
+            raise
+
+        # Only once committed, so a caller never sees a write that may yet vanish
+        for write, response, error in results:
+            if write.future.done():
+                continue
+
+            if error is not None:
+                write.future.set_exception(error)
+            else:
+                write.future.set_result(response)
+
+
+class _TimedPostgresTransaction(PostgresTransaction):
+    async def get_connection(self):
+        if self.engine.pool:
+            return await self.engine._acquire()
+
+        return await super().get_connection()
+
+
+class TunedPostgresEngine(PostgresEngine):
+    """A PostgresEngine with its pool configured from the environment.
+
+    Queries wait at most POSTGRES_POOL_TIMEOUT for a pooled
+    connection, then raise DatabaseUnavailable, which the app turns
+    into a 503 rather than leaving the request hanging.
+    """
+
+    def __init__(self, config: dict[str, Any], **kwargs) -> None:
+        config = {
+            "statement_cache_size": POSTGRES_STATEMENT_CACHE_SIZE,
+            "command_timeout": POSTGRES_COMMAND_TIMEOUT or None,
+            **config,
+        }
+        super().__init__(config=config, **kwargs)
+
+    async def start_connection_pool(self, **kwargs) -> None:
+        await super().start_connection_pool(
+            **{
+                "min_size": POSTGRES_POOL_MIN_SIZE,
+                "max_size": POSTGRES_POOL_MAX_SIZE,
+                "max_inactive_connection_lifetime": POSTGRES_POOL_MAX_IDLE,
+                **kwargs,
+            }
+        )
+
+    async def _acquire(self) -> asyncpg.Connection:
+        if not self.pool:
+            raise ValueError("A pool isn't currently running.")
+
+        start = time.perf_counter()
+        try:
+            return await self.pool.acquire(timeout=POSTGRES_POOL_TIMEOUT)
+        except asyncio.TimeoutError as e:
+            DB_POOL_TIMEOUTS.inc()
+            raise DatabaseUnavailable(
+                f"No database connection free after {POSTGRES_POOL_TIMEOUT}s"
+            ) from e
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        """A pooled connection, or a new one when no pool is running"""
+        if not self.pool:
+            connection = await self.get_new_connection()
+            try:
+                yield connection
+            finally:
+                await connection.close()
+            return
+
+        connection = await self._acquire()
+        try:
+            yield connection
+        finally:
+            await self.pool.release(connection)
+
+    async def _run_in_pool(self, query: str, args=None):
+        async with self.acquire() as connection:
+            return await connection.fetch(query, *(args or []))
+
+    def transaction(self, allow_nested: bool = True) -> PostgresTransaction:
+        return _TimedPostgresTransaction(engine=self, allow_nested=allow_nested)
+
+    async def insert_rows(self, table: type[Table], rows: list[Table]) -> None:
+        """Insert rows with one statement, however many there are.
+
+        Each column is sent as an array and unnested back into rows,
+        so the statement text never changes and stays prepared.
+        """
+        columns = table._meta.non_default_columns
+        names = ", ".join(f'"{column._meta.db_column_name}"' for column in columns)
+        arrays = ", ".join(
+            f"${position}::{column.column_type}[]"
+            for position, column in enumerate(columns, start=1)
+        )
+        query = (
+            f'INSERT INTO "{table._meta.tablename}" ({names}) '
+            f"SELECT * FROM unnest({arrays})"
+        )
+        values = [
+            [getattr(row, column._meta.name) for row in rows] for column in columns
+        ]
+        if self.current_transaction.get():
+            await self.current_transaction.get().connection.execute(query, *values)
+            return
+
+        async with self.acquire() as connection:
+            await connection.execute(query, *values)
@@ -1,7 +1,10 @@
 from litestar import Response, MediaType
+from litestar.status_codes import HTTP_503_SERVICE_UNAVAILABLE
 from litestar.exceptions import NotFoundException
 from litestar.response import Redirect, Template
 
+from home.engines import DatabaseUnavailable
+
 
 class RedirectForAuth(Exception):
     """Mark this authentication failure as a request to receive it"""
@@ -13,3 +16,13 @@ class RedirectForAuth(Exception):
 def redirect_for_auth(_, exc: RedirectForAuth) -> Response[Redirect]:
     """Where auth is required, redirect for it"""
     return Redirect(f"/b/login?next_route={exc.next_route}")
+
+
+def database_unavailable(_, exc: DatabaseUnavailable) -> Response:
+    """Every database connection is busy, so ask the client to come back"""
+    return Response(
+        {"detail": "The database is busy, try again shortly"},
+        status_code=HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"retry-after": "1"},
+        media_type=MediaType.JSON,
+    )
@@ -0,0 +1,133 @@
+"""Bulk export of captured requests as NDJSON or CSV.
+
+Rows are read in id order a chunk at a time, so exporting millions
+of requests holds no more than one chunk in memory.
+"""
+
+from __future__ import annotations
+
+import base64
+import csv
+import datetime
+import io
+import uuid
+from typing import AsyncIterator, Any
+
+import orjson
+
+from home.tables import RequestMade
+
+EXPORT_CHUNK_SIZE: int = 1000
+EXPORT_FORMATS = ("ndjson", "csv")
+EXPORT_COLUMNS = [
+    RequestMade.id,
+    RequestMade.uuid,
+    RequestMade.made_at,
+    RequestMade.type,
+    RequestMade.domain,
+    RequestMade.url,
+    RequestMade.query_params,
+    RequestMade.headers,
+    RequestMade.body,
+    RequestMade.body_raw,
+    RequestMade.body_encoding,
+    RequestMade.body_size,
+    RequestMade.body_truncated,
+    RequestMade.body_hash,
+    RequestMade.body_content_type,
+]
+EXPORT_FIELDS = [column._meta.name for column in EXPORT_COLUMNS]
+
+
+async def iter_rows(
+    *,
+    domain: str | None = None,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> AsyncIterator[list[dict[str, Any]]]:
+    """Yield every matching row, oldest first, one chunk at a time"""
+    last_id = 0
+    while True:
+        query = (
+            RequestMade.select(*EXPORT_COLUMNS)
+            .output(load_json=True)
+            .where(RequestMade.id > last_id)
+            .order_by(RequestMade.id)
+            .limit(chunk_size)
+        )
+        if domain is not None:
+            query = query.where(RequestMade.domain == domain)
+        if since is not None:
+            query = query.where(RequestMade.made_at >= since)
+        if until is not None:
+            query = query.where(RequestMade.made_at < until)
+
+        rows = await query
+        if not rows:
+            return
+
+        yield rows
+        last_id = rows[-1]["id"]
+
+
+def _default(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    # asyncpg hands back its own UUID subclass, which orjson won't take
+    if isinstance(value, uuid.UUID):
+        return str(value)
+
+    raise TypeError
+
+
+def _csv_value(value) -> Any:
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        return orjson.dumps(value).decode()
+
+    return value
+
+
+def encode_ndjson(rows: list[dict[str, Any]]) -> bytes:
+    return b"".join(orjson.dumps(row, default=_default) + b"\n" for row in rows)
+
+
+def encode_csv(rows: list[dict[str, Any]], *, header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+
+    for row in rows:
+        writer.writerow([_csv_value(row[field]) for field in EXPORT_FIELDS])
+
+    return buffer.getvalue().encode()
+
+
+async def export(
+    export_format: str,
+    *,
+    domain: str | None = None,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+) -> AsyncIterator[bytes]:
+    """Matching rows encoded as export_format, a chunk at a time.
+
+    Binary bodies are base64 encoded in either format, and headers are
+    a JSON list of [name, value] pairs.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {export_format!r}")
+
+    if export_format == "csv":
+        yield encode_csv([], header=True)
+
+    async for rows in iter_rows(domain=domain, since=since, until=until):
+        if export_format == "csv":
+            yield encode_csv(rows)
+        else:
+            yield encode_ndjson(rows)
@@ -0,0 +1,299 @@
+"""Bulk import of captured requests from JSONL dumps.
+
+Reads the NDJSON written by home.export, or anything shaped like it,
+a batch at a time. Requests whose uuid is already stored are skipped,
+which together with a progress file lets an interrupted import be
+run again from where it stopped.
+"""
+
+from __future__ import annotations
+
+import base64
+import binascii
+import contextlib
+import datetime
+import os
+import tempfile
+import uuid
+from typing import Any, BinaryIO, Callable, Iterator, NamedTuple
+
+import orjson
+from piccolo.engine import engine_finder
+
+from home.blob_store import blob_store
+from home.tables import RequestMade
+from home.tokens import token_index
+
+IMPORT_BATCH_SIZE: int = 5000
+# SQLite caps how many parameters one statement can have
+SQLITE_INSERT_CHUNK: int = 500
+IMPORT_COLUMNS = [
+    column._meta.name
+    for column in RequestMade._meta.columns
+    if column is not RequestMade.id
+]
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+class ImportResult(NamedTuple):
+    read: int
+    inserted: int
+    invalid: int
+
+
+def _text(record: dict, name: str, *, required: bool = False) -> str:
+    value = record.get(name)
+    if value is None:
+        if required:
+            raise InvalidRecord(f"{name} is required")
+
+        return ""
+
+    if not isinstance(value, str):
+        raise InvalidRecord(f"{name} must be a string")
+
+    return value
+
+
+def parse_headers(headers: Any) -> str:
+    """[name, value] pairs as JSON, from pairs or the older {name: value} form"""
+    if isinstance(headers, str):
+        try:
+            headers = orjson.loads(headers)
+        except orjson.JSONDecodeError:
+            raise InvalidRecord("headers is not JSON") from None
+
+    if isinstance(headers, dict):
+        headers = list(headers.items())
+
+    if not isinstance(headers, list) or not all(
+        isinstance(pair, (list, tuple))
+        and len(pair) == 2
+        and all(isinstance(part, str) for part in pair)
+        for pair in headers
+    ):
+        raise InvalidRecord("headers must be [name, value] pairs")
+
+    return orjson.dumps(headers).decode()
+
+
+def _stored_blob(digest: str) -> bool:
+    try:
+        return blob_store.exists(digest)
+    except ValueError:
+        return False
+
+
+def parse_record(record: Any) -> dict[str, Any]:
+    """Validate a decoded line, returning column values ready to insert"""
+    if not isinstance(record, dict):
+        raise InvalidRecord("Each line must be a JSON object")
+
+    try:
+        request_uuid = uuid.UUID(str(record["uuid"])) if "uuid" in record else None
+    except ValueError:
+        raise InvalidRecord("uuid is not a UUID") from None
+
+    made_at = datetime.datetime.now(datetime.timezone.utc)
+    if record.get("made_at"):
+        try:
+            made_at = datetime.datetime.fromisoformat(str(record["made_at"]))
+        except ValueError:
+            raise InvalidRecord("made_at is not an ISO 8601 time") from None
+
+        if made_at.tzinfo is None:
+            made_at = made_at.replace(tzinfo=datetime.timezone.utc)
+
+    headers = parse_headers(record.get("headers") or [])
+
+    try:
+        body_raw = base64.b64decode(record.get("body_raw") or "", validate=True)
+    except (binascii.Error, TypeError):
+        raise InvalidRecord("body_raw is not base64") from None
+
+    body = _text(record, "body")
+    body_hash = _text(record, "body_hash")
+    if body_hash and not _stored_blob(body_hash):
+        # The body stayed in the blob store of whichever instance
+        # captured it, all that can be kept is how big it was
+        body_hash = ""
+
+    body_size = record.get("body_size")
+    if body_size is None:
+        body_size = len(body_raw) or len(body.encode())
+    elif not isinstance(body_size, int):
+        raise InvalidRecord("body_size must be an integer")
+
+    return {
+        "headers": headers,
+        "body": body,
+        "body_raw": body_raw,
+        "body_encoding": _text(record, "body_encoding"),
+        "body_size": body_size,
+        "body_hash": body_hash,
+        "body_content_type": _text(record, "body_content_type"),
+        "body_truncated": bool(record.get("body_truncated", False)),
+        "url": _text(record, "url", required=True),
+        "query_params": _text(record, "query_params"),
+        "made_at": made_at,
+        "type": _text(record, "type", required=True).upper(),
+        # Without one we can't tell if it was imported before
+        "uuid": request_uuid or uuid.uuid4(),
+        "domain": _text(record, "domain", required=True),
+    }
+
+
+def read_batches(
+    file: BinaryIO,
+    batch_size: int,
+    on_invalid: Callable[[int, str], None],
+    first_line: int = 1,
+) -> Iterator[tuple[list[dict[str, Any]], int, int]]:
+    """Yield (rows, lines read, offset after them) for each batch"""
+    rows: list[dict[str, Any]] = []
+    lines = 0
+    for number, line in enumerate(iter(file.readline, b""), start=first_line):
+        lines += 1
+        if line.strip():
+            try:
+                rows.append(parse_record(orjson.loads(line)))
+            except (orjson.JSONDecodeError, InvalidRecord) as e:
+                on_invalid(number, str(e))
+
+        if len(rows) >= batch_size:
+            yield rows, lines, file.tell()
+            rows, lines = [], 0
+
+    if rows or lines:
+        yield rows, lines, file.tell()
+
+
+async def _insert_postgres(connection, rows: list[dict[str, Any]]) -> int:
+    columns = ", ".join(IMPORT_COLUMNS)
+    async with connection.transaction():
+        await connection.execute(
+            "CREATE TEMP TABLE request_import "
+            "(LIKE request_made INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        await connection.copy_records_to_table(
+            "request_import",
+            records=[[row[name] for name in IMPORT_COLUMNS] for row in rows],
+            columns=IMPORT_COLUMNS,
+        )
+        status = await connection.execute(
+            f"INSERT INTO request_made ({columns}) "
+            f"SELECT DISTINCT ON (uuid) {columns} FROM request_import "
+            "WHERE NOT EXISTS "
+            "(SELECT 1 FROM request_made WHERE request_made.uuid = request_import.uuid)"
+        )
+
+    # asyncpg hands back the command tag, such as "INSERT 0 4999"
+    return int(status.split()[-1])
+
+
+async def _insert_generic(rows: list[dict[str, Any]]) -> int:
+    unique: dict[uuid.UUID, dict[str, Any]] = {row["uuid"]: row for row in rows}
+    existing: set[uuid.UUID] = set()
+    uuids = list(unique)
+    for offset in range(0, len(uuids), SQLITE_INSERT_CHUNK):
+        existing.update(
+            await RequestMade.select(RequestMade.uuid)
+            .where(RequestMade.uuid.is_in(uuids[offset : offset + SQLITE_INSERT_CHUNK]))
+            .output(as_list=True)
+        )
+
+    new_rows = [
+        RequestMade(**row) for key, row in unique.items() if key not in existing
+    ]
+    async with RequestMade._meta.db.transaction():
+        for offset in range(0, len(new_rows), SQLITE_INSERT_CHUNK):
+            await RequestMade.insert(*new_rows[offset : offset + SQLITE_INSERT_CHUNK])
+
+    return len(new_rows)
+
+
+def _skip_to(file: BinaryIO, offset: int) -> int:
+    """Read up to offset, returning how many lines that was"""
+    lines = 0
+    while file.tell() < offset:
+        chunk = file.read(min(1024 * 1024, offset - file.tell()))
+        if not chunk:
+            break
+
+        lines += chunk.count(b"\n")
+
+    return lines
+
+
+def _save_offset(path: str, offset: int) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "w") as file:
+        file.write(str(offset))
+
+    os.replace(temp_path, path)
+
+
+async def import_file(
+    path: str,
+    *,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    resume: bool = True,
+    on_invalid: Callable[[int, str], None] = lambda line, error: None,
+    on_progress: Callable[[ImportResult], None] = lambda result: None,
+) -> ImportResult:
+    """Import every valid record in path.
+
+    The byte offset of the last committed batch is kept in
+    path.progress until the import finishes.
+    """
+    progress_path = f"{path}.progress"
+    offset = 0
+    if resume and os.path.exists(progress_path):
+        with open(progress_path) as file:
+            offset = int(file.read().strip() or 0)
+
+    engine = engine_finder()
+    connection = None
+    if engine.engine_type == "postgres":
+        connection = await engine.get_new_connection()
+
+    # Tokens are registered per instance, so match against our own
+    await token_index.reload()
+    read = inserted = invalid = 0
+
+    def count_invalid(line: int, error: str) -> None:
+        nonlocal invalid
+        invalid += 1
+        on_invalid(line, error)
+
+    try:
+        with open(path, "rb") as file:
+            # Counted rather than seeked past, so errors give the line
+            # number in the file and not since the import resumed
+            first_line = _skip_to(file, offset) + 1
+            batches = read_batches(file, batch_size, count_invalid, first_line)
+            for rows, lines, end in batches:
+                for row in rows:
+                    row["token"] = token_index.match(row["domain"], row["url"])
+
+                if rows:
+                    if connection is not None:
+                        inserted += await _insert_postgres(connection, rows)
+                    else:
+                        inserted += await _insert_generic(rows)
+
+                read += lines
+                _save_offset(progress_path, end)
+                on_progress(ImportResult(read, inserted, invalid))
+    finally:
+        if connection is not None:
+            await connection.close()
+
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(progress_path)
+
+    return ImportResult(read, inserted, invalid)
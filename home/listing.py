@@ -0,0 +1,198 @@
+"""Keyset paginated listing of captured requests and DNS queries.
+
+Pages are addressed by id rather than an offset, so fetching
+page 10,000 costs the same as fetching the first.
+"""
+
+from __future__ import annotations
+
+import datetime
+from typing import NamedTuple, Any
+
+import orjson
+from piccolo.columns import Column
+from piccolo.columns.combination import WhereRaw
+
+from home.metrics import DB_QUERY_SECONDS
+from home.search import escape_like, search_filter
+from home.tables import DnsQuery, RequestMade
+
+MAX_PAGE_SIZE: int = 500
+# Columns the listing can return, body_raw is left to the body endpoint
+LISTING_COLUMNS: dict[str, Column] = {
+    "id": RequestMade.id,
+    "uuid": RequestMade.uuid,
+    "type": RequestMade.type,
+    "domain": RequestMade.domain,
+    "token": RequestMade.token,
+    "url": RequestMade.url,
+    "query_params": RequestMade.query_params,
+    "made_at": RequestMade.made_at,
+    "headers": RequestMade.headers,
+    "body": RequestMade.body,
+    "body_encoding": RequestMade.body_encoding,
+    "body_size": RequestMade.body_size,
+    "body_truncated": RequestMade.body_truncated,
+    "body_hash": RequestMade.body_hash,
+    "body_content_type": RequestMade.body_content_type,
+}
+SUMMARY_FIELDS: list[str] = ["id", "uuid", "type", "url", "query_params", "made_at"]
+
+
+class Page(NamedTuple):
+    rows: list[dict[str, Any]]
+    # Pass as before= to get the next page of older requests
+    older: int | None
+    # Pass as after= to get the next page of newer requests
+    newer: int | None
+
+
+def header_filter(name: str, value: str | None = None) -> WhereRaw:
+    """Matches requests sent with a header called name, holding value if given"""
+    name = name.lower()
+    if RequestMade._meta.db.engine_type == "postgres":
+        # Containment narrows things down using request_made_headers_idx,
+        # but can't tell names from values so the match is checked again
+        pair = [name] if value is None else [name, value]
+        sql = (
+            "headers @> {}::jsonb AND EXISTS (SELECT 1 FROM "
+            "jsonb_array_elements(headers) AS pair WHERE pair->>0 = {}"
+        )
+        values = [orjson.dumps([pair]).decode(), name]
+        value_sql = " AND pair->>1 = {}"
+    else:
+        sql = (
+            "EXISTS (SELECT 1 FROM json_each(headers) "
+            "WHERE json_extract(value, '$[0]') = {}"
+        )
+        values = [name]
+        value_sql = " AND json_extract(value, '$[1]') = {}"
+
+    if value is not None:
+        sql += value_sql
+        values.append(value)
+
+    return WhereRaw(sql + ")", *values)
+
+
+def parse_fields(fields: str | None) -> list[str]:
+    """Turn a comma separated projection into known column names"""
+    if not fields:
+        return list(LISTING_COLUMNS)
+
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in LISTING_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+    # The cursors are built from id, so it always comes back
+    return ["id", *[field for field in requested if field != "id"]]
+
+
+async def fetch_page(
+    *,
+    before: int | None = None,
+    after: int | None = None,
+    limit: int = 25,
+    domain: str | None = None,
+    method: str | None = None,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+    url_prefix: str | None = None,
+    search: str | None = None,
+    token: int | None = None,
+    header_name: str | None = None,
+    header_value: str | None = None,
+    fields: list[str] | None = None,
+) -> Page:
+    """Fetch a page of requests, newest first"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    columns = [LISTING_COLUMNS[field] for field in (fields or SUMMARY_FIELDS)]
+    query = RequestMade.select(*columns).output(load_json=True)
+
+    if domain is not None:
+        query = query.where(RequestMade.domain == domain)
+    if token is not None:
+        query = query.where(RequestMade.token == token)
+    if method is not None:
+        query = query.where(RequestMade.type == method.upper())
+    if since is not None:
+        query = query.where(RequestMade.made_at >= since)
+    if until is not None:
+        query = query.where(RequestMade.made_at < until)
+    if url_prefix:
+        query = query.where(
+            WhereRaw("substr(url, 1, {}) = {}", len(url_prefix), url_prefix)
+        )
+    if search:
+        query = query.where(search_filter(search))
+    if header_name:
+        query = query.where(header_filter(header_name, header_value))
+
+    query_name = "search" if search else "listing"
+
+    if after is not None:
+        # Walk forwards from the cursor, then flip back to newest first
+        query = query.where(RequestMade.id > after).order_by(RequestMade.id)
+        with DB_QUERY_SECONDS.time(query=query_name):
+            rows = await query.limit(limit + 1)
+        has_more = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        return Page(
+            rows=rows,
+            older=rows[-1]["id"] if rows else None,
+            newer=rows[0]["id"] if rows and has_more else None,
+        )
+
+    if before is not None:
+        query = query.where(RequestMade.id < before)
+
+    with DB_QUERY_SECONDS.time(query=query_name):
+        rows = await query.order_by(RequestMade.id, ascending=False).limit(limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return Page(
+        rows=rows,
+        older=rows[-1]["id"] if rows and has_more else None,
+        newer=rows[0]["id"] if rows and before is not None else None,
+    )
+
+
+async def fetch_dns_page(
+    *,
+    before: int | None = None,
+    limit: int = 25,
+    zone: str | None = None,
+    host: str | None = None,
+    token: int | None = None,
+) -> Page:
+    """Fetch a page of DNS queries, newest first.
+
+    host limits them to lookups of that name or names under it.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = DnsQuery.select()
+    if host is not None:
+        query = query.where(
+            WhereRaw(
+                "(qname = {} OR qname LIKE {} ESCAPE '\\')",
+                host,
+                f"%.{escape_like(host)}",
+            )
+        )
+    if zone is not None:
+        query = query.where(DnsQuery.zone == zone)
+    if token is not None:
+        query = query.where(DnsQuery.token == token)
+    if before is not None:
+        query = query.where(DnsQuery.id < before)
+
+    with DB_QUERY_SECONDS.time(query="dns_listing"):
+        rows = await query.order_by(DnsQuery.id, ascending=False).limit(limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return Page(
+        rows=rows,
+        older=rows[-1]["id"] if rows and has_more else None,
+        newer=rows[0]["id"] if rows and before is not None else None,
+    )
@@ -0,0 +1,40 @@
+"""Pushes summaries of newly captured requests to open dashboards."""
+
+from __future__ import annotations
+
+import orjson
+
+from home.pubsub import pubsub, REQUESTS_CHANNEL, MAX_NOTIFY_PAYLOAD
+from home.tables import RequestMade
+
+# Keeps a single summary well inside a NOTIFY payload
+SUMMARY_FIELD_LIMIT: int = 1024
+
+
+def summarise(row: RequestMade) -> dict:
+    return {
+        "uuid": str(row.uuid),
+        "type": row.type,
+        "domain": row.domain[:SUMMARY_FIELD_LIMIT],
+        "url": row.url[:SUMMARY_FIELD_LIMIT],
+        "query_params": row.query_params[:SUMMARY_FIELD_LIMIT],
+        "made_at": row.made_at.isoformat(),
+    }
+
+
+async def publish_requests(rows: list[RequestMade]) -> None:
+    """Publish rows in as few messages as fit, oldest first"""
+    batch: list[dict] = []
+    size = 0
+    for row in rows:
+        summary = summarise(row)
+        summary_size = len(orjson.dumps(summary)) + 1
+        if batch and size + summary_size > MAX_NOTIFY_PAYLOAD - 32:
+            await pubsub.publish(REQUESTS_CHANNEL, {"requests": batch})
+            batch, size = [], 0
+
+        batch.append(summary)
+        size += summary_size
+
+    if batch:
+        await pubsub.publish(REQUESTS_CHANNEL, {"requests": batch})
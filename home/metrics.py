@@ -0,0 +1,236 @@
+"""Counters and histograms exposed in the Prometheus text format.
+
+Each worker process keeps its own figures. Label values such as
+domains are chosen by whoever sends the callout, so each metric only
+tracks so many label sets before lumping the rest under "other".
+"""
+
+from __future__ import annotations
+
+import bisect
+import contextlib
+import os
+import time
+from typing import Iterator
+
+from dotenv import load_dotenv
+from litestar.enums import ScopeType
+from litestar.middleware import AbstractMiddleware
+from litestar.types import Message, Receive, Scope, Send
+
+load_dotenv()
+# /b/metrics is disabled unless this is set, scrapers send it as a bearer token
+METRICS_TOKEN: str = os.environ.get("METRICS_TOKEN", "")
+MAX_LABEL_SETS: int = 500
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+SIZE_BUCKETS = (0, 64, 512, 4096, 32768, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    kind: str = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        REGISTRY.append(self)
+
+    def _key(self, values: dict[str, str], known) -> tuple[str, ...]:
+        key = tuple(str(values.get(label, "")) for label in self.labels)
+        if key not in known and len(known) >= MAX_LABEL_SETS:
+            return tuple("other" for _ in self.labels)
+
+        return key
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels, self._values)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        # label values -> (per bucket counts, +Inf count, sum)
+        self._values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels, self._values)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+
+        entry[1] += 1
+        entry[2] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for key, (counts, total, value_sum) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels((*self.labels, "le"), (*key, str(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = _format_labels((*self.labels, "le"), (*key, "+Inf"))
+            lines.append(f"{self.name}_bucket{labels} {total}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {value_sum}")
+            lines.append(f"{self.name}_count{labels} {total}")
+
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+REQUEST_SECONDS = Histogram(
+    "blurp_request_duration_seconds",
+    "Time taken to respond, by route",
+    ("method", "route", "status"),
+)
+CAPTURED = Counter(
+    "blurp_captured_requests_total",
+    "Callouts captured, by method and domain",
+    ("method", "domain"),
+)
+BODY_BYTES = Histogram(
+    "blurp_captured_body_bytes",
+    "Size of captured request bodies, before truncation",
+    buckets=SIZE_BUCKETS,
+)
+DB_QUERY_SECONDS = Histogram(
+    "blurp_db_query_seconds",
+    "Time spent in the hot path queries",
+    ("query",),
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "blurp_db_pool_wait_seconds",
+    "Time spent waiting for a pooled Postgres connection",
+)
+DB_POOL_TIMEOUTS = Counter(
+    "blurp_db_pool_timeouts_total",
+    "Queries given up on because every pooled connection stayed busy",
+)
+WRITE_QUEUE_REJECTED = Counter(
+    "blurp_write_queue_rejected_total",
+    "Queued rows the database refused, set aside rather than retried",
+    ("table",),
+)
+TEMPLATE_RENDER_SECONDS = Histogram(
+    "blurp_template_render_seconds",
+    "Time spent rendering templates",
+    ("template",),
+)
+AUTH_LOOKUP_SECONDS = Histogram(
+    "blurp_auth_lookup_seconds",
+    "Time spent resolving a session to a user",
+    ("source",),
+)
+RATE_LIMITED = Counter(
+    "blurp_rate_limited_total",
+    "Requests over a rate limit, sampled ones were let through anyway",
+    ("policy", "outcome"),
+)
+DNS_QUERIES = Counter(
+    "blurp_dns_queries_total",
+    "DNS queries answered for our zones, by record type",
+    ("qtype",),
+)
+DNS_TCP_REJECTED = Counter(
+    "blurp_dns_tcp_rejected_total",
+    "DNS connections over TCP turned away at DNS_TCP_MAX_CONNECTIONS",
+)
+STREAM_REJECTED = Counter(
+    "blurp_stream_rejected_total",
+    "Connections to the TCP listeners turned away at TCP_MAX_CONNECTIONS",
+    ("protocol",),
+)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware(AbstractMiddleware):
+    """Records how long every request takes, by route"""
+
+    scopes = {ScopeType.HTTP}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=scope.get("path_template", "unknown"),
+                status=str(status),
+            )
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import os
+import time
 
 import commons
 from dotenv import load_dotenv
@@ -15,10 +16,16 @@ from piccolo.apps.user.tables import BaseUser
 from piccolo_api.session_auth.tables import SessionsBase
 
 from home.exception_handlers import RedirectForAuth
+from home.metrics import AUTH_LOOKUP_SECONDS
+from home.pubsub import pubsub, SESSIONS_CHANNEL
+from home.util.cache import TTLCache
 from home.util.flash import alert
 
 load_dotenv()
 REQUIRE_AUTH: bool = commons.value_to_bool(os.environ.get("REQUIRE_AUTH"))
+# Zero for either disables caching of session lookups
+AUTH_CACHE_TTL: float = float(os.environ.get("AUTH_CACHE_TTL", 60))
+AUTH_CACHE_SIZE: int = int(os.environ.get("AUTH_CACHE_SIZE", 1024))
 
 
 class EnsureAuth(AbstractAuthenticationMiddleware):
@@ -30,6 +37,34 @@ class EnsureAuth(AbstractAuthenticationMiddleware):
     active_only = True
     increase_expiry = None
     requires_auth = REQUIRE_AUTH
+    # Session token -> user, saves two queries per authenticated request
+    user_cache: TTLCache[str, BaseUser] = TTLCache(
+        max_size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL
+    )
+    # Tokens which resolved to nobody, kept apart so a flood of
+    # made up cookies can't push real sessions out of user_cache
+    invalid_tokens: TTLCache[str, bool] = TTLCache(
+        max_size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL
+    )
+
+    @classmethod
+    def forget_session(cls, token: str) -> None:
+        cls.user_cache.delete(token)
+
+    @classmethod
+    def forget_user(cls, user_id: int) -> None:
+        """Drop every cached session belonging to user_id"""
+        cls.user_cache.delete_where(lambda user: user.id == user_id)
+
+    @classmethod
+    async def invalidate_user(cls, user_id: int) -> None:
+        """Forget user_id's cached sessions in every worker"""
+        cls.forget_user(user_id)
+        await pubsub.publish(SESSIONS_CHANNEL, {"user_id": user_id})
+
+    @classmethod
+    def on_message(cls, message: dict) -> None:
+        cls.forget_user(message["user_id"])
 
     @classmethod
     async def get_user_from_connection(
@@ -47,9 +82,24 @@ class EnsureAuth(AbstractAuthenticationMiddleware):
 
             return None
 
-        user_id = await cls.session_table.get_user_id(
-            token, increase_expiry=cls.increase_expiry
-        )
+        start = time.perf_counter()
+        user = cls.user_cache.get(token)
+        if user is not None:
+            AUTH_LOOKUP_SECONDS.observe(time.perf_counter() - start, source="cache")
+            return user
+
+        if cls.invalid_tokens.get(token):
+            user_id = None
+            AUTH_LOOKUP_SECONDS.observe(time.perf_counter() - start, source="cache")
+        else:
+            user_id = await cls.session_table.get_user_id(
+                token, increase_expiry=cls.increase_expiry
+            )
+            if not user_id:
+                cls.invalid_tokens.set(token, True)
+                AUTH_LOOKUP_SECONDS.observe(
+                    time.perf_counter() - start, source="database"
+                )
 
         if not user_id:
             if fail_on_not_set:
@@ -58,12 +108,18 @@ class EnsureAuth(AbstractAuthenticationMiddleware):
 
             return None
 
-        return (
+        user = (
             await cls.auth_table.objects()
             .where(cls.auth_table._meta.primary_key == user_id)
             .first()
             .run()
         )
+        AUTH_LOOKUP_SECONDS.observe(time.perf_counter() - start, source="database")
+        if user is not None and not cls.increase_expiry:
+            # Extending the expiry needs get_user_id to run every time
+            cls.user_cache.set(token, user)
+
+        return user
 
     async def authenticate_request(
         self, connection: ASGIConnection
@@ -94,3 +150,9 @@ class EnsureAuth(AbstractAuthenticationMiddleware):
             raise NotAuthorizedException("Active users only")
 
         return AuthenticationResult(user=piccolo_user, auth=None)
+
+
+class RequireUser(EnsureAuth):
+    """EnsureAuth which always requires a login, regardless of REQUIRE_AUTH"""
+
+    requires_auth = True
@@ -0,0 +1,100 @@
+"""Rendered copies of the first page of the home listing.
+
+Under a spray of callouts the home page would otherwise be queried
+and rendered again for every hit. Pages are rendered with a
+placeholder in place of the CSP nonce, which is swapped for a fresh
+one each time a copy is served.
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Any
+
+import commons
+from dotenv import load_dotenv
+from litestar import Request, Response, MediaType
+from litestar.status_codes import HTTP_200_OK
+
+from home.tables import RequestMade
+from home.util import get_csp, TTLCache
+
+load_dotenv()
+LISTING_CACHE_ENABLED: bool = commons.value_to_bool(
+    os.environ.get("LISTING_CACHE_ENABLED", "true")
+)
+# Inserts invalidate pages as they happen, this only bounds staleness
+# should an invalidation be missed
+LISTING_CACHE_TTL: float = float(os.environ.get("LISTING_CACHE_TTL", 60))
+# Hosts are chosen by whoever sends the callout, so keep this bounded
+LISTING_CACHE_SIZE: int = 1024
+
+NONCE_PLACEHOLDER = "__blurp_csp_nonce__"
+# The sidebar differs between these
+VIEWERS = ("anonymous", "user", "admin")
+
+
+def viewer(request: Request) -> str:
+    user = request.scope.get("user")
+    if user is None:
+        return "anonymous"
+
+    return "admin" if user.admin else "user"
+
+
+class PageCache:
+    def __init__(self, *, max_size: int, ttl: float):
+        # (domain, viewer) -> html
+        self._pages: TTLCache[tuple[str, str], str] = TTLCache(
+            max_size=max_size, ttl=ttl
+        )
+        # Bumped on every invalidation, so a render which raced
+        # with an insert isn't stored once it finishes
+        self.generation: int = 0
+
+    def key(self, request: Request, domain: str | None) -> tuple[str, str]:
+        return domain or "", viewer(request)
+
+    def cacheable(self, request: Request) -> bool:
+        # Flashed messages are shown once and then popped
+        return LISTING_CACHE_ENABLED and not request.scope.get("session", {}).get(
+            "_messages"
+        )
+
+    def get(self, key: tuple[str, str]) -> str | None:
+        return self._pages.get(key)
+
+    def set(self, key: tuple[str, str], html: str, generation: int) -> None:
+        if generation == self.generation:
+            self._pages.set(key, html)
+
+    def invalidate(self, domains: set[str] | None = None) -> None:
+        """Forget pages listing any of domains, or every page if None"""
+        self.generation += 1
+        if domains is None:
+            self._pages.clear()
+            return
+
+        for domain in ("", *domains):
+            for kind in VIEWERS:
+                self._pages.delete((domain, kind))
+
+    async def on_insert(self, rows: list[RequestMade]) -> None:
+        self.invalidate({row.domain for row in rows})
+
+    def on_message(self, message: dict[str, Any]) -> None:
+        self.invalidate({summary["domain"] for summary in message["requests"]})
+
+
+def respond(html: str) -> Response:
+    """Serve a cached page under a freshly generated nonce"""
+    csp, nonce = get_csp()
+    return Response(
+        content=html.replace(NONCE_PLACEHOLDER, nonce),
+        media_type=MediaType.HTML,
+        headers={"content-security-policy": csp},
+        status_code=HTTP_200_OK,
+    )
+
+
+listing_cache = PageCache(max_size=LISTING_CACHE_SIZE, ttl=LISTING_CACHE_TTL)
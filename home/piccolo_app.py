@@ -7,6 +7,8 @@ import os
 
 from piccolo.conf.apps import AppConfig, table_finder
 
+from home.commands import check_plans, export_requests, import_requests
+
 
 CURRENT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 
@@ -17,6 +19,6 @@ APP_CONFIG = AppConfig(
         CURRENT_DIRECTORY, "piccolo_migrations"
     ),
     table_classes=table_finder(modules=["home.tables"], exclude_imported=True),
-    migration_dependencies=[],
-    commands=[],
+    migration_dependencies=["piccolo.apps.user.piccolo_app"],
+    commands=[check_plans, export_requests, import_requests],
 )
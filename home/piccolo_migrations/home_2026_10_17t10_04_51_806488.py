@@ -0,0 +1,104 @@
+from piccolo.apps.migrations.auto.migration_manager import MigrationManager
+from piccolo.columns.column_types import BigInt
+from piccolo.columns.column_types import Boolean
+from piccolo.columns.column_types import Bytea
+from piccolo.columns.column_types import Varchar
+from piccolo.columns.indexes import IndexMethod
+
+
+ID = "2026-10-17T10:04:51:806488"
+VERSION = "1.24.2"
+DESCRIPTION = "Binary safe, size capped request bodies"
+
+
+async def forwards():
+    manager = MigrationManager(
+        migration_id=ID, app_name="home", description=DESCRIPTION
+    )
+
+    manager.add_column(
+        table_class_name="RequestMade",
+        tablename="request_made",
+        column_name="body_encoding",
+        db_column_name="body_encoding",
+        column_class_name="Varchar",
+        column_class=Varchar,
+        params={
+            "length": 32,
+            "default": "",
+            "null": False,
+            "primary_key": False,
+            "unique": False,
+            "index": False,
+            "index_method": IndexMethod.btree,
+            "choices": None,
+            "db_column_name": None,
+            "secret": False,
+        },
+        schema=None,
+    )
+
+    manager.add_column(
+        table_class_name="RequestMade",
+        tablename="request_made",
+        column_name="body_raw",
+        db_column_name="body_raw",
+        column_class_name="Bytea",
+        column_class=Bytea,
+        params={
+            "default": b"",
+            "null": False,
+            "primary_key": False,
+            "unique": False,
+            "index": False,
+            "index_method": IndexMethod.btree,
+            "choices": None,
+            "db_column_name": None,
+            "secret": False,
+        },
+        schema=None,
+    )
+
+    manager.add_column(
+        table_class_name="RequestMade",
+        tablename="request_made",
+        column_name="body_size",
+        db_column_name="body_size",
+        column_class_name="BigInt",
+        column_class=BigInt,
+        params={
+            "default": 0,
+            "null": False,
+            "primary_key": False,
+            "unique": False,
+            "index": False,
+            "index_method": IndexMethod.btree,
+            "choices": None,
+            "db_column_name": None,
+            "secret": False,
+        },
+        schema=None,
+    )
+
+    manager.add_column(
+        table_class_name="RequestMade",
+        tablename="request_made",
+        column_name="body_truncated",
+        db_column_name="body_truncated",
+        column_class_name="Boolean",
+        column_class=Boolean,
+        params={
+            "default": False,
+            "null": False,
+            "primary_key": False,
+            "unique": False,
+            "index": False,
+            "index_method": IndexMethod.btree,
+            "choices": None,
+            "db_column_name": None,
+            "secret": False,
+        },
+        schema=None,
+    )
+
+    return manager
@@ -0,0 +1,43 @@
+from piccolo.apps.migrations.auto.migration_manager import MigrationManager
+from piccolo.engine import engine_finder
+
+ID = "2026-10-17T10:07:12:214530"
+VERSION = "1.24.2"
+DESCRIPTION = "Indexes for the listing and admin access paths"
+
+# Piccolo can't describe composite or descending indexes,
+# so these are managed by hand rather than on the columns
+INDEXES = [
+    ("request_made_domain_id_idx", "domain, id DESC"),
+    ("request_made_made_at_idx", "made_at"),
+]
+
+
+async def forwards():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    manager = MigrationManager(
+        migration_id=ID,
+        app_name="home",
+        description=DESCRIPTION,
+        wrap_in_transaction=False,
+    )
+
+    async def create_indexes():
+        engine = engine_finder()
+        concurrently = "CONCURRENTLY " if engine.engine_type == "postgres" else ""
+        for name, columns in INDEXES:
+            await engine.run_ddl(
+                f"CREATE INDEX {concurrently}IF NOT EXISTS {name} "
+                f"ON request_made ({columns})"
+            )
+
+    async def drop_indexes():
+        engine = engine_finder()
+        concurrently = "CONCURRENTLY " if engine.engine_type == "postgres" else ""
+        for name, _ in INDEXES:
+            await engine.run_ddl(f"DROP INDEX {concurrently}IF EXISTS {name}")
+
+    manager.add_raw(create_indexes)
+    manager.add_raw_backwards(drop_indexes)
+
+    return manager
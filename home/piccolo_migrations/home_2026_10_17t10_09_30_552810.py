@@ -0,0 +1,75 @@
+from piccolo.apps.migrations.auto.migration_manager import MigrationManager
+from piccolo.engine import engine_finder
+
+ID = "2026-10-17T10:09:30:552810"
+VERSION = "1.24.2"
+DESCRIPTION = "Partition request_made by made_at on Postgres"
+
+# Piccolo has no notion of partitioned tables, so this is all done by
+# hand. SQLite has no partitioning, retention there falls back to DELETE.
+INDEXES = [
+    ("request_made_uuid", "uuid"),
+    ("request_made_body_hash", "body_hash"),
+    ("request_made_domain_id_idx", "domain, id DESC"),
+    ("request_made_made_at_idx", "made_at"),
+]
+
+
+async def _swap_table(engine, partitioned: bool):
+    statements = [
+        "ALTER TABLE request_made RENAME TO request_made_previous",
+        # The id sequence is owned by the old table and would
+        # be dropped with it unless we take it over first
+        "ALTER SEQUENCE request_made_id_seq OWNED BY NONE",
+    ]
+    if partitioned:
+        statements += [
+            "CREATE TABLE request_made "
+            "(LIKE request_made_previous INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (made_at)",
+            # Everything captured before this month goes into one
+            # partition which retention can drop once it is old enough
+            "CREATE TABLE request_made_p_legacy PARTITION OF request_made "
+            "FOR VALUES FROM (MINVALUE) TO (date_trunc('month', now()))",
+            "CREATE TABLE request_made_p_default PARTITION OF request_made DEFAULT",
+        ]
+    else:
+        statements += [
+            "CREATE TABLE request_made "
+            "(LIKE request_made_previous INCLUDING DEFAULTS)",
+        ]
+
+    statements += [
+        "INSERT INTO request_made SELECT * FROM request_made_previous",
+        "DROP TABLE request_made_previous",
+        "ALTER SEQUENCE request_made_id_seq OWNED BY request_made.id",
+        # The partition key has to be part of the primary key
+        "ALTER TABLE request_made ADD PRIMARY KEY "
+        + ("(id, made_at)" if partitioned else "(id)"),
+    ]
+    statements += [
+        f"CREATE INDEX {name} ON request_made ({columns})" for name, columns in INDEXES
+    ]
+    for statement in statements:
+        await engine.run_ddl(statement)
+
+
+async def forwards():
+    manager = MigrationManager(
+        migration_id=ID, app_name="home", description=DESCRIPTION
+    )
+
+    async def partition():
+        engine = engine_finder()
+        if engine.engine_type == "postgres":
+            await _swap_table(engine, partitioned=True)
+
+    async def unpartition():
+        engine = engine_finder()
+        if engine.engine_type == "postgres":
+            await _swap_table(engine, partitioned=False)
+
+    manager.add_raw(partition)
+    manager.add_raw_backwards(unpartition)
+
+    return manager
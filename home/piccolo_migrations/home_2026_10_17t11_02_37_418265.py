@@ -0,0 +1,78 @@
+from piccolo.apps.migrations.auto.migration_manager import MigrationManager
+from piccolo.engine import engine_finder
+
+ID = "2026-10-17T11:02:37:418265"
+VERSION = "1.24.2"
+DESCRIPTION = "Substring search over urls, headers and bodies"
+
+# Kept in step with home.search, which has to query the same expression
+SEARCH_COLUMNS = ("url", "query_params", "headers", "body")
+SEARCH_DOCUMENT = "(" + " || ' ' || ".join(SEARCH_COLUMNS) + ")"
+SEARCH_TABLE = "request_search"
+
+
+def _sqlite_values(prefix: str) -> str:
+    return ", ".join(f"{prefix}.{column}" for column in SEARCH_COLUMNS)
+
+
+async def forwards():
+    manager = MigrationManager(
+        migration_id=ID, app_name="home", description=DESCRIPTION
+    )
+
+    async def create_search():
+        engine = engine_finder()
+        if engine.engine_type == "postgres":
+            # Partitioned tables can't be indexed concurrently, the
+            # index is created on every partition in turn instead
+            statements = [
+                "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+                "CREATE INDEX IF NOT EXISTS request_made_search_idx "
+                f"ON request_made USING GIN ({SEARCH_DOCUMENT} gin_trgm_ops)",
+            ]
+        else:
+            columns = ", ".join(SEARCH_COLUMNS)
+            statements = [
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+                f"{columns}, content='request_made', content_rowid='id', "
+                "tokenize='trigram')",
+                "CREATE TRIGGER IF NOT EXISTS request_search_insert "
+                "AFTER INSERT ON request_made BEGIN "
+                f"INSERT INTO {SEARCH_TABLE} (rowid, {columns}) "
+                f"VALUES (new.id, {_sqlite_values('new')}); END",
+                "CREATE TRIGGER IF NOT EXISTS request_search_delete "
+                "AFTER DELETE ON request_made BEGIN "
+                f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, {columns}) "
+                f"VALUES ('delete', old.id, {_sqlite_values('old')}); END",
+                "CREATE TRIGGER IF NOT EXISTS request_search_update "
+                "AFTER UPDATE ON request_made BEGIN "
+                f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, {columns}) "
+                f"VALUES ('delete', old.id, {_sqlite_values('old')}); "
+                f"INSERT INTO {SEARCH_TABLE} (rowid, {columns}) "
+                f"VALUES (new.id, {_sqlite_values('new')}); END",
+                # Index everything captured before now
+                f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('rebuild')",
+            ]
+
+        for statement in statements:
+            await engine.run_ddl(statement)
+
+    async def drop_search():
+        engine = engine_finder()
+        if engine.engine_type == "postgres":
+            statements = ["DROP INDEX IF EXISTS request_made_search_idx"]
+        else:
+            statements = [
+                "DROP TRIGGER IF EXISTS request_search_insert",
+                "DROP TRIGGER IF EXISTS request_search_delete",
+                "DROP TRIGGER IF EXISTS request_search_update",
+                f"DROP TABLE IF EXISTS {SEARCH_TABLE}",
+            ]
+
+        for statement in statements:
+            await engine.run_ddl(statement)
+
+    manager.add_raw(create_search)
+    manager.add_raw_backwards(drop_search)
+
+    return manager
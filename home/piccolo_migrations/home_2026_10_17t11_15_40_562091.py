@@ -0,0 +1,37 @@
+from piccolo.apps.migrations.auto.migration_manager import MigrationManager
+from piccolo.engine import engine_finder
+
+ID = "2026-10-17T11:15:40:562091"
+VERSION = "1.24.2"
+DESCRIPTION = "Index for per token listings"
+
+# Raw steps run before a migration's columns are added, so this
+# can't live alongside the token column itself
+INDEXES = [
+    ("request_made_token_id_idx", "token, id DESC"),
+]
+
+
+async def forwards():
+    manager = MigrationManager(
+        migration_id=ID, app_name="home", description=DESCRIPTION
+    )
+
+    async def create_indexes():
+        # request_made is partitioned on Postgres by now, and partitioned
+        # tables can't be indexed concurrently
+        engine = engine_finder()
+        for name, columns in INDEXES:
+            await engine.run_ddl(
+                f"CREATE INDEX IF NOT EXISTS {name} ON request_made ({columns})"
+            )
+
+    async def drop_indexes():
+        engine = engine_finder()
+        for name, _ in INDEXES:
+            await engine.run_ddl(f"DROP INDEX IF EXISTS {name}")
+
+    manager.add_raw(create_indexes)
+    manager.add_raw_backwards(drop_indexes)
+
+    return manager
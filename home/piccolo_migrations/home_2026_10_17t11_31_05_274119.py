@@ -0,0 +1,121 @@
+from piccolo.apps.migrations.auto.migration_manager import MigrationManager
+from piccolo.columns.column_types import JSONB
+from piccolo.columns.column_types import Text
+from piccolo.engine import engine_finder
+
+ID = "2026-10-17T11:31:05:274119"
+VERSION = "1.24.2"
+DESCRIPTION = "Store headers as ordered name and value pairs"
+
+# The search index covers headers, so has to go while the type changes.
+# This is the expression it was built on while headers was text.
+TEXT_SEARCH_DOCUMENT = "(url || ' ' || query_params || ' ' || headers || ' ' || body)"
+
+# Turns the old {"name": "value"} text into [["name", "value"]], keeping
+# the order they were written in. Anything unreadable becomes no headers.
+POSTGRES_TO_PAIRS = """
+CREATE OR REPLACE FUNCTION pg_temp.header_pairs(headers text) RETURNS jsonb AS $$
+BEGIN
+    RETURN coalesce(
+        (
+            SELECT jsonb_agg(jsonb_build_array(key, value) ORDER BY position)
+            FROM json_each_text(headers::json)
+                WITH ORDINALITY AS pair(key, value, position)
+        ),
+        '[]'::jsonb
+    );
+EXCEPTION WHEN others THEN
+    RETURN '[]'::jsonb;
+END
+$$ LANGUAGE plpgsql
+"""
+POSTGRES_TO_OBJECT = """
+CREATE OR REPLACE FUNCTION pg_temp.header_object(headers jsonb) RETURNS text AS $$
+    SELECT coalesce(json_object_agg(pair->>0, pair->>1 ORDER BY position), '{}')::text
+    FROM jsonb_array_elements(headers) WITH ORDINALITY AS pairs(pair, position)
+$$ LANGUAGE sql
+"""
+SQLITE_TO_PAIRS = """
+UPDATE request_made SET headers = CASE
+    WHEN json_valid(headers) AND json_type(headers) = 'object' THEN (
+        SELECT json_group_array(json_array(key, value))
+        FROM json_each(request_made.headers)
+    )
+    ELSE '[]'
+END
+"""
+SQLITE_TO_OBJECT = """
+UPDATE request_made SET headers = CASE
+    WHEN json_valid(headers) AND json_type(headers) = 'array' THEN (
+        SELECT json_group_object(
+            json_extract(value, '$[0]'), json_extract(value, '$[1]')
+        )
+        FROM json_each(request_made.headers)
+    )
+    ELSE '{}'
+END
+"""
+
+
+async def forwards():
+    manager = MigrationManager(
+        migration_id=ID, app_name="home", description=DESCRIPTION
+    )
+    engine = engine_finder()
+
+    async def to_pairs():
+        if engine.engine_type != "postgres":
+            await engine.run_ddl(SQLITE_TO_PAIRS)
+            return
+
+        # Converting in place here means the type change below has
+        # nothing left to do, rather than failing to cast text to jsonb
+        for statement in [
+            "DROP INDEX IF EXISTS request_made_search_idx",
+            POSTGRES_TO_PAIRS,
+            "ALTER TABLE request_made ALTER COLUMN headers DROP DEFAULT",
+            "ALTER TABLE request_made ALTER COLUMN headers TYPE jsonb "
+            "USING pg_temp.header_pairs(headers)",
+        ]:
+            await engine.run_ddl(statement)
+
+    async def to_object():
+        if engine.engine_type != "postgres":
+            await engine.run_ddl(SQLITE_TO_OBJECT)
+            return
+
+        for statement in [
+            POSTGRES_TO_OBJECT,
+            "ALTER TABLE request_made ALTER COLUMN headers DROP DEFAULT",
+            "ALTER TABLE request_made ALTER COLUMN headers TYPE text "
+            "USING pg_temp.header_object(headers)",
+            "CREATE INDEX IF NOT EXISTS request_made_search_idx "
+            f"ON request_made USING GIN ({TEXT_SEARCH_DOCUMENT} gin_trgm_ops)",
+        ]:
+            await engine.run_ddl(statement)
+
+    manager.add_raw(to_pairs)
+    manager.add_raw_backwards(to_object)
+
+    # SQLite can't ALTER COLUMN, and keeps both types as text anyway, so
+    # the raw functions above are the whole change there. Auto migration
+    # snapshots are built by calling forwards() too, which means they only
+    # see headers as JSONB when taken against Postgres, so generate new
+    # migrations with POSTGRES_HOST set. Against SQLite they pick up a
+    # spurious alter of headers, which should be deleted.
+    if engine.engine_type != "postgres":
+        return manager
+
+    manager.alter_column(
+        table_class_name="RequestMade",
+        tablename="request_made",
+        column_name="headers",
+        db_column_name="headers",
+        params={"default": "[]"},
+        old_params={"default": ""},
+        column_class=JSONB,
+        old_column_class=Text,
+        schema=None,
+    )
+
+    return manager
@@ -0,0 +1,44 @@
+from piccolo.apps.migrations.auto.migration_manager import MigrationManager
+from piccolo.engine import engine_finder
+
+ID = "2026-10-17T11:31:52:806140"
+VERSION = "1.24.2"
+DESCRIPTION = "Index headers, and search them as jsonb"
+
+# Kept in step with home.search, jsonb has to be cast to join it up
+SEARCH_DOCUMENT = "(url || ' ' || query_params || ' ' || headers::text || ' ' || body)"
+INDEXES = [
+    # Serves headers @> '[["name", "value"]]'
+    ("request_made_headers_idx", "USING GIN (headers jsonb_path_ops)"),
+    ("request_made_search_idx", f"USING GIN ({SEARCH_DOCUMENT} gin_trgm_ops)"),
+]
+
+
+async def forwards():
+    manager = MigrationManager(
+        migration_id=ID, app_name="home", description=DESCRIPTION
+    )
+
+    # SQLite has no GIN indexes, and its search table is unaffected
+    async def create_indexes():
+        engine = engine_finder()
+        if engine.engine_type != "postgres":
+            return
+
+        for name, definition in INDEXES:
+            await engine.run_ddl(
+                f"CREATE INDEX IF NOT EXISTS {name} ON request_made {definition}"
+            )
+
+    async def drop_indexes():
+        engine = engine_finder()
+        if engine.engine_type != "postgres":
+            return
+
+        for name, _ in INDEXES:
+            await engine.run_ddl(f"DROP INDEX IF EXISTS {name}")
+
+    manager.add_raw(create_indexes)
+    manager.add_raw_backwards(drop_indexes)
+
+    return manager
@@ -0,0 +1,217 @@
+"""Publish and subscribe fan out for live updates.
+
+The in memory backend only reaches subscribers in this process.
+The Postgres backend relays messages through LISTEN/NOTIFY, so
+every worker connected to the same database sees them. Its LISTEN
+connection is watched, and replaced whenever it drops.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+from typing import Any, AsyncIterator, Callable
+
+import orjson
+from dotenv import load_dotenv
+from piccolo.engine import engine_finder
+from piccolo.querystring import QueryString
+
+from home.deployment import MULTI_WORKER
+
+load_dotenv()
+log = logging.getLogger(__name__)
+# One of: memory, postgres
+PUBSUB_BACKEND: str = os.environ.get(
+    "PUBSUB_BACKEND",
+    "postgres" if MULTI_WORKER and os.environ.get("POSTGRES_HOST") else "memory",
+).lower()
+SUBSCRIBER_QUEUE_SIZE: int = 100
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_NOTIFY_PAYLOAD: int = 7999
+REQUESTS_CHANNEL = "blurp_requests"
+SESSIONS_CHANNEL = "blurp_sessions"
+TOKENS_CHANNEL = "blurp_tokens"
+# How often an otherwise quiet LISTEN connection is checked on
+LISTEN_CHECK_INTERVAL: float = 30
+LISTEN_CHECK_TIMEOUT: float = 5
+# Reconnect attempts back off up to this many seconds apart
+RECONNECT_MAX_DELAY: float = 30
+
+
+class PubSub:
+    def __init__(self):
+        self._subscribers: dict[str, set[asyncio.Queue]] = {}
+        self._handlers: dict[str, list[Callable[[dict[str, Any]], None]]] = {}
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, channel: str, message: dict[str, Any]) -> None:
+        self._deliver(channel, message)
+
+    def add_handler(
+        self, channel: str, handler: Callable[[dict[str, Any]], None]
+    ) -> None:
+        """Call handler with every message on channel, for as long as we run"""
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def _deliver(self, channel: str, message: dict[str, Any]) -> None:
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(message)
+            except Exception:
+                log.exception("Handler %r for %s failed", handler, channel)
+
+        for queue in self._subscribers.get(channel, ()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # A slow reader only misses out on their own updates
+                pass
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, channel: str) -> AsyncIterator[asyncio.Queue]:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers.setdefault(channel, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers[channel].discard(queue)
+
+
+class PostgresPubSub(PubSub):
+    def __init__(self, channels: list[str]):
+        super().__init__()
+        self.channels = channels
+        self._connection = None
+        self._lost = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+
+        await self._connect()
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            await connection.close()
+
+    async def _connect(self) -> None:
+        # LISTEN needs a connection of its own, pooled ones get reset
+        connection = await engine_finder().get_new_connection()
+        try:
+            for channel in self.channels:
+                await connection.add_listener(channel, self._on_notify)
+        except BaseException:
+            connection.terminate()
+            raise
+
+        connection.add_termination_listener(self._on_terminate)
+        self._lost.clear()
+        self._connection = connection
+
+    def _on_terminate(self, connection) -> None:
+        if connection is self._connection:
+            self._lost.set()
+
+    async def _alive(self) -> bool:
+        try:
+            await asyncio.wait_for(
+                self._connection.execute("SELECT 1"), LISTEN_CHECK_TIMEOUT
+            )
+        except Exception:
+            return False
+
+        return True
+
+    async def _watch(self) -> None:
+        """Replace the LISTEN connection whenever it drops"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._lost.wait(), LISTEN_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                # A dead network often closes nothing, so go and look
+                if await self._alive():
+                    continue
+
+            lost_at = loop.time()
+            log.warning("Lost the LISTEN connection, reconnecting")
+            connection, self._connection = self._connection, None
+            if connection is not None:
+                connection.terminate()
+
+            delay = 1.0
+            while True:
+                try:
+                    await self._connect()
+                    break
+                except Exception as e:
+                    log.warning("Failed to reconnect (%s), retrying in %ss", e, delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+            log.warning(
+                "LISTEN connection restored, messages from the last %.1fs were missed",
+                loop.time() - lost_at,
+            )
+
+    async def publish(self, channel: str, message: dict[str, Any]) -> None:
+        payload = orjson.dumps(message).decode()
+        if len(payload.encode()) > MAX_NOTIFY_PAYLOAD:
+            log.warning("Dropping a %s message too large to NOTIFY", channel)
+            return
+
+        # Delivered back to us, and every other worker, via _on_notify
+        await engine_finder().run_querystring(
+            QueryString("SELECT pg_notify({}, {})", channel, payload)
+        )
+
+    def _on_notify(self, connection, pid, channel: str, payload: str) -> None:
+        try:
+            self._deliver(channel, orjson.loads(payload))
+        except orjson.JSONDecodeError:
+            log.warning("Ignoring malformed notification on %s", channel)
+
+
+def create_pubsub() -> PubSub:
+    if PUBSUB_BACKEND == "postgres":
+        return PostgresPubSub(
+            channels=[REQUESTS_CHANNEL, SESSIONS_CHANNEL, TOKENS_CHANNEL]
+        )
+
+    if MULTI_WORKER:
+        log.warning(
+            "PUBSUB_BACKEND=memory with several workers, the live feed and "
+            "cache invalidation only reach the worker that saw the change"
+        )
+
+    return PubSub()
+
+
+pubsub = create_pubsub()
+
+
+async def start_pubsub():
+    await pubsub.start()
+
+
+async def stop_pubsub():
+    await pubsub.stop()
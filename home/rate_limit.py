@@ -0,0 +1,213 @@
+"""Token bucket rate limiting with separate capture and UI policies.
+
+Callouts are limited per source address and, far more loosely, per
+Host, everything else per source address only. Bucket state lives either in this process or
+in the database, the latter letting several workers share one limit.
+"""
+
+from __future__ import annotations
+
+import logging
+import math
+import os
+import time
+from collections import Counter
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+from litestar.enums import ScopeType
+from litestar.exceptions import TooManyRequestsException
+from litestar.middleware import AbstractMiddleware
+from litestar.types import Receive, Scope, Send
+from piccolo.engine import engine_finder
+
+from home.deployment import MULTI_WORKER
+from home.metrics import RATE_LIMITED
+from home.tables import RateLimitBucket
+from home.util import TTLCache
+
+load_dotenv()
+log = logging.getLogger(__name__)
+# One of: memory, database
+RATE_LIMIT_STORE: str = os.environ.get(
+    "RATE_LIMIT_STORE", "database" if MULTI_WORKER else "memory"
+).lower()
+RATE_LIMIT_CAPTURE_RATE: float = float(os.environ.get("RATE_LIMIT_CAPTURE_RATE", 50))
+RATE_LIMIT_CAPTURE_BURST: float = float(os.environ.get("RATE_LIMIT_CAPTURE_BURST", 500))
+# Shared by every source calling out to one host, so set well above
+# what any single address gets
+RATE_LIMIT_HOST_RATE: float = float(os.environ.get("RATE_LIMIT_HOST_RATE", 500))
+RATE_LIMIT_HOST_BURST: float = float(os.environ.get("RATE_LIMIT_HOST_BURST", 5000))
+RATE_LIMIT_UI_RATE: float = float(os.environ.get("RATE_LIMIT_UI_RATE", 5))
+RATE_LIMIT_UI_BURST: float = float(os.environ.get("RATE_LIMIT_UI_BURST", 20))
+# Every nth callout over the limit is captured anyway, zero disables
+RATE_LIMIT_SAMPLE_EVERY: int = int(os.environ.get("RATE_LIMIT_SAMPLE_EVERY", 100))
+
+# Buckets untouched for this long are full again and can be forgotten
+BUCKET_IDLE_TIMEOUT: float = 3600
+MAX_MEMORY_BUCKETS: int = 100_000
+MAX_KEY_LENGTH: int = 255
+DROPPED_LOG_INTERVAL: float = 60
+
+
+class Policy(NamedTuple):
+    name: str
+    # Tokens added per second
+    rate: float
+    # The most tokens a bucket holds
+    burst: float
+
+
+CAPTURE_POLICY = Policy("capture", RATE_LIMIT_CAPTURE_RATE, RATE_LIMIT_CAPTURE_BURST)
+HOST_POLICY = Policy("host", RATE_LIMIT_HOST_RATE, RATE_LIMIT_HOST_BURST)
+UI_POLICY = Policy("ui", RATE_LIMIT_UI_RATE, RATE_LIMIT_UI_BURST)
+
+
+class MemoryBucketStore:
+    def __init__(self):
+        # key -> (tokens, updated_at)
+        self._buckets: TTLCache[str, tuple[float, float]] = TTLCache(
+            max_size=MAX_MEMORY_BUCKETS, ttl=BUCKET_IDLE_TIMEOUT
+        )
+
+    async def take(self, key: str, policy: Policy, now: float) -> bool:
+        tokens, updated_at = self._buckets.get(key) or (policy.burst, now)
+        tokens = min(policy.burst, tokens + (now - updated_at) * policy.rate)
+        if tokens < 1:
+            return False
+
+        self._buckets.set(key, (tokens - 1, now))
+        return True
+
+    async def prune(self, before: float) -> None:
+        # TTLCache already forgets idle buckets
+        pass
+
+
+class DatabaseBucketStore:
+    """Buckets shared by every worker, at the cost of an upsert each
+    time one is taken from, before the request is handled"""
+
+    async def take(self, key: str, policy: Policy, now: float) -> bool:
+        # Refill and take in one statement, so concurrent workers can't
+        # both spend the last token. No row comes back when it's empty.
+        least = "LEAST" if engine_finder().engine_type == "postgres" else "MIN"
+        refilled = (
+            f"{least}({{}}, rate_limit_bucket.tokens + "
+            "({} - rate_limit_bucket.updated_at) * {})"
+        )
+        response = await RateLimitBucket.raw(
+            "INSERT INTO rate_limit_bucket (key, tokens, updated_at) "
+            "VALUES ({}, {}, {}) ON CONFLICT (key) DO UPDATE "
+            f"SET tokens = {refilled} - 1, updated_at = {{}} "
+            f"WHERE {refilled} >= 1 RETURNING tokens",
+            key,
+            policy.burst - 1,
+            now,
+            policy.burst,
+            now,
+            policy.rate,
+            now,
+            policy.burst,
+            now,
+            policy.rate,
+        )
+        return bool(response)
+
+    async def prune(self, before: float) -> None:
+        await RateLimitBucket.delete().where(RateLimitBucket.updated_at < before)
+
+
+def create_store() -> MemoryBucketStore | DatabaseBucketStore:
+    if RATE_LIMIT_STORE == "database":
+        return DatabaseBucketStore()
+
+    return MemoryBucketStore()
+
+
+class RateLimiter:
+    def __init__(self, store: MemoryBucketStore | DatabaseBucketStore):
+        self.store = store
+        # Callouts turned away per host since the last log line
+        self.dropped: Counter[str] = Counter()
+        self._dropped_total: int = 0
+        self._logged_at: float = time.monotonic()
+
+    async def allow(self, limits: list[tuple[Policy, str]]) -> bool:
+        """Take from the bucket for each policy and key in turn.
+
+        Stops at the first empty one, so a source already over its own
+        limit can't go on running down the buckets after it.
+        """
+        now = time.time()
+        for policy, key in limits:
+            key = f"{policy.name}:{key}"[:MAX_KEY_LENGTH]
+            if not await self.store.take(key, policy, now):
+                return False
+
+        return True
+
+    def record_dropped(self, host: str) -> bool:
+        """Count a callout over the limit, returning True if it should
+        be captured anyway as a sample"""
+        self.dropped[host] += 1
+        self._dropped_total += 1
+        if time.monotonic() - self._logged_at > DROPPED_LOG_INTERVAL:
+            for dropped_host, count in self.dropped.most_common(10):
+                log.warning("Rate limited %s callouts to %s", count, dropped_host)
+
+            self.dropped.clear()
+            self._logged_at = time.monotonic()
+
+        return (
+            RATE_LIMIT_SAMPLE_EVERY > 0
+            and self._dropped_total % RATE_LIMIT_SAMPLE_EVERY == 0
+        )
+
+    async def prune(self) -> None:
+        await self.store.prune(time.time() - BUCKET_IDLE_TIMEOUT)
+
+
+rate_limiter = RateLimiter(create_store())
+
+
+def source_address(scope: Scope) -> str:
+    # Forwarding headers are left to uvicorn's --proxy-headers, which
+    # only believes them from FORWARDED_ALLOW_IPS. Reading them here
+    # would let any caller pick its own bucket.
+    client = scope.get("client")
+    return client[0] if client else "anonymous"
+
+
+def too_many_requests(policy: Policy) -> TooManyRequestsException:
+    retry_after = math.ceil(1 / policy.rate) if policy.rate > 0 else 60
+    return TooManyRequestsException(headers={"retry-after": str(retry_after)})
+
+
+class RateLimitMiddleware(AbstractMiddleware):
+    """Applies CAPTURE_POLICY and HOST_POLICY to handlers with opt
+    rate_limit="capture" and UI_POLICY to everything else"""
+
+    scopes = {ScopeType.HTTP}
+    exclude = ["/b/admin", "/b/docs"]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        address = source_address(scope)
+        if scope["route_handler"].opt.get("rate_limit") == "capture":
+            host = dict(scope["headers"]).get(b"host", b"").decode("latin-1")
+            allowed = await rate_limiter.allow(
+                [(CAPTURE_POLICY, f"ip:{address}"), (HOST_POLICY, host)]
+            )
+            if not allowed:
+                sampled = rate_limiter.record_dropped(host)
+                RATE_LIMITED.inc(
+                    policy="capture", outcome="sampled" if sampled else "rejected"
+                )
+                if not sampled:
+                    raise too_many_requests(CAPTURE_POLICY)
+
+        elif not await rate_limiter.allow([(UI_POLICY, f"ip:{address}")]):
+            RATE_LIMITED.inc(policy="ui", outcome="rejected")
+            raise too_many_requests(UI_POLICY)
+
+        await self.app(scope, receive, send)
@@ -0,0 +1,328 @@
+"""Background pruning of old captured requests and DNS queries.
+
+On Postgres request_made is partitioned by made_at, so expiring old
+data is a matter of dropping whole partitions. Everywhere else rows
+are deleted in batches.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+import io
+import logging
+import os
+import re
+import time
+
+from dotenv import load_dotenv
+from piccolo.engine import engine_finder
+
+from home.blob_store import blob_store
+from home.rate_limit import rate_limiter
+from home.tables import DnsQuery, RequestMade
+from home.util.locks import try_hold_lock
+from home.write_queue import request_queue
+
+load_dotenv()
+log = logging.getLogger(__name__)
+# Zero disables the respective limit
+RETENTION_MAX_AGE_DAYS: float = float(os.environ.get("RETENTION_MAX_AGE_DAYS", 0))
+RETENTION_MAX_ROWS_PER_DOMAIN: int = int(
+    os.environ.get("RETENTION_MAX_ROWS_PER_DOMAIN", 0)
+)
+RETENTION_INTERVAL: float = float(os.environ.get("RETENTION_INTERVAL", 3600))
+# One of: day, month
+RETENTION_PARTITION_INTERVAL: str = os.environ.get(
+    "RETENTION_PARTITION_INTERVAL", "month"
+).lower()
+RETENTION_PARTITIONS_AHEAD: int = int(os.environ.get("RETENTION_PARTITIONS_AHEAD", 2))
+
+DELETE_BATCH_SIZE: int = 10_000
+# Blobs younger than this may belong to a row still in the write queue
+BLOB_GRACE_PERIOD: float = 3600
+DEFAULT_PARTITION = "request_made_p_default"
+# Identifies the advisory lock only one worker holds at a time
+RETENTION_LOCK_ID: int = 0x626C757270
+RETENTION_LOCK_PATH: str = ".retention.lock"
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def period_start(moment: datetime.datetime) -> datetime.datetime:
+    moment = moment.astimezone(datetime.timezone.utc)
+    if RETENTION_PARTITION_INTERVAL == "day":
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_period(start: datetime.datetime) -> datetime.datetime:
+    if RETENTION_PARTITION_INTERVAL == "day":
+        return start + datetime.timedelta(days=1)
+
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+
+    return start.replace(month=start.month + 1)
+
+
+async def is_partitioned() -> bool:
+    if engine_finder().engine_type != "postgres":
+        return False
+
+    response = await RequestMade.raw(
+        "SELECT relkind::text AS relkind FROM pg_class WHERE relname = {}",
+        RequestMade._meta.tablename,
+    )
+    return bool(response) and response[0]["relkind"] == "p"
+
+
+async def list_partitions() -> dict[str, datetime.datetime | None]:
+    """Partition names mapped to their exclusive upper bound"""
+    response = await RequestMade.raw(
+        "SELECT child.relname AS name, "
+        "pg_get_expr(child.relpartbound, child.oid) AS bound "
+        "FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = {}",
+        RequestMade._meta.tablename,
+    )
+    partitions = {}
+    for row in response:
+        match = _UPPER_BOUND.search(row["bound"])
+        partitions[row["name"]] = (
+            datetime.datetime.fromisoformat(match.group(1)) if match else None
+        )
+
+    return partitions
+
+
+async def ensure_partitions() -> None:
+    """Create partitions for the current period and a few ahead of it"""
+    engine = engine_finder()
+    existing = await list_partitions()
+    start = period_start(datetime.datetime.now(datetime.timezone.utc))
+    for _ in range(RETENTION_PARTITIONS_AHEAD + 1):
+        end = next_period(start)
+        name = f"request_made_p{start:%Y%m%d}"
+        if name not in existing:
+            bounds = f"FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            misplaced = await RequestMade.raw(
+                f"SELECT 1 FROM {DEFAULT_PARTITION} "
+                "WHERE made_at >= {} AND made_at < {} LIMIT 1",
+                start,
+                end,
+            )
+            if not misplaced:
+                await engine.run_ddl(
+                    f"CREATE TABLE {name} PARTITION OF request_made FOR VALUES {bounds}"
+                )
+            else:
+                # Postgres refuses to create a partition while the default
+                # one holds rows for its range, so move them across
+                async with engine.transaction():
+                    await engine.run_ddl(
+                        f"ALTER TABLE request_made DETACH PARTITION {DEFAULT_PARTITION}"
+                    )
+                    await engine.run_ddl(
+                        f"CREATE TABLE {name} PARTITION OF request_made FOR VALUES {bounds}"
+                    )
+                    await RequestMade.raw(
+                        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+                        "WHERE made_at >= {} AND made_at < {} RETURNING *) "
+                        f"INSERT INTO {name} SELECT * FROM moved",
+                        start,
+                        end,
+                    )
+                    await engine.run_ddl(
+                        f"ALTER TABLE request_made ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"
+                    )
+
+            log.info("Created partition %s", name)
+
+        start = end
+
+
+async def drop_expired_partitions(cutoff: datetime.datetime) -> None:
+    engine = engine_finder()
+    for name, upper_bound in (await list_partitions()).items():
+        if upper_bound is not None and upper_bound <= cutoff:
+            await engine.run_ddl(f"DROP TABLE {name}")
+            log.info("Dropped expired partition %s", name)
+
+
+async def delete_older_than(
+    cutoff: datetime.datetime, table: type[RequestMade | DnsQuery] = RequestMade
+) -> int:
+    deleted = 0
+    while True:
+        ids = (
+            await table.select(table.id)
+            .where(table.made_at < cutoff)
+            .limit(DELETE_BATCH_SIZE)
+            .output(as_list=True)
+        )
+        if not ids:
+            return deleted
+
+        await table.delete().where(table.id.is_in(ids))
+        deleted += len(ids)
+
+
+async def delete_excess_per_domain(max_rows: int) -> int:
+    deleted = 0
+    while True:
+        response = await RequestMade.raw(
+            "SELECT id FROM (SELECT id, row_number() OVER "
+            "(PARTITION BY domain ORDER BY id DESC) AS position "
+            "FROM request_made) AS ranked WHERE position > {} LIMIT {}",
+            max_rows,
+            DELETE_BATCH_SIZE,
+        )
+        ids = [row["id"] for row in response]
+        if not ids:
+            return deleted
+
+        await RequestMade.delete().where(RequestMade.id.is_in(ids))
+        deleted += len(ids)
+
+
+async def sweep_blobs() -> int:
+    """Remove blobs no remaining row refers to"""
+    if request_queue.has_spilled_rows:
+        # Spilled rows can wait far longer than the grace period,
+        # and their blobs only become referenced once replayed
+        log.info("Not sweeping blobs while spilled requests wait to be replayed")
+        return 0
+
+    removed = 0
+    digests = await asyncio.to_thread(
+        blob_store.list_older_than, time.time() - BLOB_GRACE_PERIOD
+    )
+    for offset in range(0, len(digests), 500):
+        chunk = digests[offset : offset + 500]
+        referenced = set(
+            await RequestMade.select(RequestMade.body_hash)
+            .where(RequestMade.body_hash.is_in(chunk))
+            .distinct()
+            .output(as_list=True)
+        )
+        for digest in chunk:
+            if digest not in referenced:
+                await asyncio.to_thread(blob_store.remove, digest)
+                removed += 1
+
+    return removed
+
+
+async def run_retention() -> None:
+    """Run one pass of partition upkeep and pruning"""
+    partitioned = await is_partitioned()
+    if partitioned:
+        await ensure_partitions()
+
+    pruned = False
+    if RETENTION_MAX_AGE_DAYS:
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            days=RETENTION_MAX_AGE_DAYS
+        )
+        if partitioned:
+            await drop_expired_partitions(cutoff)
+
+        # Catches whatever is left in the default partition on Postgres
+        await delete_older_than(cutoff)
+        await delete_older_than(cutoff, DnsQuery)
+        pruned = True
+
+    if RETENTION_MAX_ROWS_PER_DOMAIN:
+        await delete_excess_per_domain(RETENTION_MAX_ROWS_PER_DOMAIN)
+        pruned = True
+
+    if pruned:
+        await sweep_blobs()
+
+    await rate_limiter.prune()
+
+
+class RetentionTask:
+    """Runs retention in whichever worker holds the retention lock.
+
+    On Postgres the lock is an advisory lock on a connection kept for
+    as long as we lead, elsewhere it's a lock file. Either is released
+    if the worker dies, letting another one take over.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+        self._lock = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        await self._release()
+
+    async def _acquire(self) -> bool:
+        if self._lock is not None:
+            return True
+
+        engine = engine_finder()
+        if engine.engine_type != "postgres":
+            self._lock = try_hold_lock(RETENTION_LOCK_PATH)
+            return self._lock is not None
+
+        connection = await engine.get_new_connection()
+        if await connection.fetchval(
+            "SELECT pg_try_advisory_lock($1)", RETENTION_LOCK_ID
+        ):
+            self._lock = connection
+            return True
+
+        await connection.close()
+        return False
+
+    async def _release(self) -> None:
+        lock, self._lock = self._lock, None
+        if lock is None:
+            return
+
+        if isinstance(lock, io.IOBase):
+            lock.close()
+        else:
+            await lock.close()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if await self._acquire():
+                    await run_retention()
+            except Exception:
+                log.exception("Retention pass failed")
+                # The lock connection may be what broke
+                await self._release()
+
+            await asyncio.sleep(self.interval)
+
+
+retention_task = RetentionTask(RETENTION_INTERVAL)
+
+
+async def start_retention():
+    await retention_task.start()
+
+
+async def stop_retention():
+    await retention_task.stop()
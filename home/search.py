@@ -0,0 +1,56 @@
+"""Substring search over captured URLs, query params, headers and bodies.
+
+Postgres answers from a trigram index over the four columns joined
+together, SQLite from an FTS5 table using the trigram tokenizer which
+triggers keep in step with request_made. Trigrams need at least three
+characters, shorter terms are refused rather than scanning every row.
+"""
+
+from __future__ import annotations
+
+from piccolo.columns.combination import WhereRaw
+
+from home.tables import RequestMade
+
+MIN_TERM_LENGTH: int = 3
+# Must match the expression request_made_search_idx was built on,
+# or Postgres won't use it. headers is jsonb there, so gets cast.
+SEARCH_DOCUMENT = "(url || ' ' || query_params || ' ' || headers::text || ' ' || body)"
+SEARCH_INDEX = "request_made_search_idx"
+# The SQLite FTS5 table
+SEARCH_TABLE = "request_search"
+
+
+def validate_term(term: str) -> str:
+    term = term.strip()
+    if len(term) < MIN_TERM_LENGTH:
+        raise ValueError(
+            f"Search terms must be at least {MIN_TERM_LENGTH} characters long"
+        )
+
+    return term
+
+
+def escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_filter(term: str) -> WhereRaw:
+    """Matches requests containing term anywhere, ignoring case"""
+    if RequestMade._meta.db.engine_type == "postgres":
+        # Matched on its own first, so it can only be answered from
+        # SEARCH_INDEX. Left alongside ORDER BY id LIMIT n, the planner
+        # often walks the primary key backwards instead, checking every
+        # row against a term which is rare or nowhere at all.
+        return WhereRaw(
+            f"id = ANY(ARRAY(SELECT id FROM request_made "
+            f"WHERE {SEARCH_DOCUMENT} ILIKE {{}}))",
+            f"%{escape_like(term)}%",
+        )
+
+    # Quoted so FTS5 treats it as a literal phrase rather than a query
+    phrase = '"' + term.replace('"', '""') + '"'
+    return WhereRaw(
+        f"id IN (SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH {{}})",
+        phrase,
+    )
@@ -0,0 +1,327 @@
+"""Catch all TCP listeners for callouts which aren't HTTP.
+
+SMTP, FTP, gopher style SSRF and plain sockets never reach the web
+app, so extra ports can be opened which record whatever is sent to
+them as a RequestMade. A connection only ever holds TCP_READ_BYTES
+of what it sent and lives for at most TCP_READ_TIMEOUT, and no more
+than TCP_MAX_CONNECTIONS are served at once, so a flood of slow
+clients can't run us out of memory.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, TypeVar
+
+import orjson
+from dotenv import load_dotenv
+
+from home import capture, metrics
+from home.rate_limit import CAPTURE_POLICY, rate_limiter
+from home.tables import RequestMade
+from home.tokens import normalise_host, token_index
+from home.write_queue import request_queue
+
+load_dotenv()
+log = logging.getLogger(__name__)
+# Comma separated ports, each optionally followed by /smtp, think 25/smtp,9000
+TCP_LISTENERS: str = os.environ.get("TCP_LISTENERS", "")
+TCP_HOST: str = os.environ.get("TCP_HOST", "0.0.0.0")
+TCP_READ_BYTES: int = int(os.environ.get("TCP_READ_BYTES", 64 * 1024))
+TCP_READ_TIMEOUT: float = float(os.environ.get("TCP_READ_TIMEOUT", 10))
+TCP_MAX_CONNECTIONS: int = int(os.environ.get("TCP_MAX_CONNECTIONS", 256))
+# Captures with nothing better to go on are recorded against this
+DEFAULT_DOMAIN: str = normalise_host(os.environ.get("SERVING_DOMAIN", "").split(",")[0])
+SMTP_HOSTNAME: str = os.environ.get("SMTP_HOSTNAME", DEFAULT_DOMAIN or "localhost")
+
+PROTOCOLS: tuple[str, ...] = ("tcp", "smtp")
+# Also the longest SMTP line we'll read
+MAX_READ_CHUNK: int = 64 * 1024
+
+T = TypeVar("T")
+
+
+def parse_listeners(spec: str) -> list[tuple[int, str]]:
+    """Turn TCP_LISTENERS into (port, protocol) pairs"""
+    listeners = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+
+        port, _, protocol = entry.partition("/")
+        protocol = protocol.strip().lower() or "tcp"
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"Unknown protocol {protocol!r} for port {port}")
+
+        listeners.append((int(port), protocol))
+
+    return listeners
+
+
+class Session:
+    """What one connection sent, up to limit bytes of it"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.data = bytearray()
+        self.size: int = 0
+        # Shown as headers, think the SMTP envelope
+        self.details: list[tuple[str, str]] = []
+        self.domain: str = ""
+
+    @property
+    def full(self) -> bool:
+        # Reading a byte past the limit is how we know it was cut short
+        return self.size > self.limit
+
+    @property
+    def wanted(self) -> int:
+        return self.limit + 1 - self.size
+
+    def add(self, chunk: bytes) -> None:
+        self.data += chunk[: self.limit - len(self.data)]
+        self.size += len(chunk)
+
+    def body(self) -> capture.CapturedBody:
+        data = bytes(self.data)
+        truncated = self.size > len(data)
+        return capture.CapturedBody(
+            data=data,
+            size=self.size,
+            truncated=truncated,
+            encoding=capture.detect_encoding(data, truncated),
+        )
+
+
+def _smtp_argument(line: bytes) -> str:
+    """The address in MAIL FROM:<a@b> or RCPT TO:<a@b>"""
+    _, _, argument = capture.escape_nul(line.decode("latin-1")).partition(":")
+    return argument.strip().split(" ")[0].strip("<>")
+
+
+class StreamListeners:
+    """Serves every TCP_LISTENERS port, sharing one connection cap"""
+
+    def __init__(
+        self,
+        listeners: list[tuple[int, str]],
+        host: str,
+        *,
+        read_bytes: int,
+        read_timeout: float,
+        max_connections: int,
+    ):
+        self.listeners = listeners
+        self.host = host
+        self.read_bytes = read_bytes
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self._servers: list[asyncio.Server] = []
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def active(self) -> int:
+        return len(self._tasks)
+
+    async def start(self) -> None:
+        if self._servers:
+            return
+
+        for port, protocol in self.listeners:
+            server = await asyncio.start_server(
+                lambda reader, writer, port=port, protocol=protocol: self._handle(
+                    reader, writer, port, protocol
+                ),
+                self.host,
+                port,
+                # Bounds how much each connection buffers before we read it
+                limit=min(self.read_bytes, MAX_READ_CHUNK),
+                reuse_port=True,
+            )
+            self._servers.append(server)
+            log.info("Capturing %s connections on port %s", protocol, port)
+
+    async def stop(self) -> None:
+        servers, self._servers = self._servers, []
+        for server in servers:
+            server.close()
+
+        for task in list(self._tasks):
+            task.cancel()
+
+        for server in servers:
+            await server.wait_closed()
+
+    async def _handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        port: int,
+        protocol: str,
+    ) -> None:
+        if self.active >= self.max_connections:
+            metrics.STREAM_REJECTED.inc(protocol=protocol)
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._capture(reader, writer, port, protocol)
+        except Exception:
+            log.exception("Failed to capture a %s connection on %s", protocol, port)
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _capture(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        port: int,
+        protocol: str,
+    ) -> None:
+        peer = writer.get_extra_info("peername") or ("anonymous", 0)
+        if not await rate_limiter.allow([(CAPTURE_POLICY, f"ip:{peer[0]}")]):
+            sampled = rate_limiter.record_dropped(f"{protocol}:{port}")
+            metrics.RATE_LIMITED.inc(
+                policy="capture", outcome="sampled" if sampled else "rejected"
+            )
+            if not sampled:
+                return
+
+        session = Session(self.read_bytes)
+        session.details.append(("peer", f"{peer[0]}:{peer[1]}"))
+        deadline = asyncio.get_running_loop().time() + self.read_timeout
+        try:
+            if protocol == "smtp":
+                await self._speak_smtp(reader, writer, session, deadline)
+            else:
+                await self._read_raw(reader, session, deadline)
+        except (asyncio.TimeoutError, ConnectionError):
+            # Whatever arrived before they went quiet is still worth keeping
+            pass
+
+        await self._record(session, port, protocol)
+
+    async def _before(self, deadline: float, awaitable: Awaitable[T]) -> T:
+        timeout = deadline - asyncio.get_running_loop().time()
+        return await asyncio.wait_for(awaitable, max(timeout, 0))
+
+    async def _read_raw(
+        self, reader: asyncio.StreamReader, session: Session, deadline: float
+    ) -> None:
+        while not session.full:
+            chunk = await self._before(
+                deadline, reader.read(min(session.wanted, MAX_READ_CHUNK))
+            )
+            if not chunk:
+                return
+
+            session.add(chunk)
+
+    async def _read_line(
+        self, reader: asyncio.StreamReader, session: Session, deadline: float
+    ) -> bytes:
+        """The next line, or nothing once the client has gone"""
+        try:
+            line = await self._before(deadline, reader.readuntil(b"\n"))
+        except asyncio.IncompleteReadError as e:
+            session.add(e.partial)
+            return b""
+        except asyncio.LimitOverrunError:
+            # Far longer than any real command, so not worth reading on
+            return b""
+
+        session.add(line)
+        return line
+
+    async def _speak_smtp(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        session: Session,
+        deadline: float,
+    ) -> None:
+        """Just enough SMTP for a client to hand over a message"""
+
+        async def reply(text: str) -> None:
+            writer.write(f"{text}\r\n".encode())
+            await self._before(deadline, writer.drain())
+
+        await reply(f"220 {SMTP_HOSTNAME} ESMTP")
+        while not session.full:
+            line = await self._read_line(reader, session, deadline)
+            if not line:
+                return
+
+            command = line[:4].upper()
+            if command in (b"HELO", b"EHLO"):
+                helo = capture.escape_nul(line[5:].decode("latin-1"))
+                session.details.append(("helo", helo.strip()))
+                await reply(f"250 {SMTP_HOSTNAME}")
+            elif command == b"MAIL":
+                session.details.append(("mail-from", _smtp_argument(line)))
+                await reply("250 OK")
+            elif command == b"RCPT":
+                recipient = _smtp_argument(line)
+                session.details.append(("rcpt-to", recipient))
+                if not session.domain and "@" in recipient:
+                    session.domain = normalise_host(recipient.rsplit("@", 1)[1])
+                await reply("250 OK")
+            elif command == b"DATA":
+                await reply("354 End data with <CR><LF>.<CR><LF>")
+                while not session.full:
+                    line = await self._read_line(reader, session, deadline)
+                    if not line:
+                        return
+
+                    if line.rstrip(b"\r\n") == b".":
+                        break
+
+                await reply("250 OK")
+            elif command == b"QUIT":
+                await reply("221 Bye")
+                return
+            elif command in (b"RSET", b"NOOP"):
+                await reply("250 OK")
+            else:
+                # Includes STARTTLS, so clients carry on in the clear
+                await reply("502 Command not implemented")
+
+    async def _record(self, session: Session, port: int, protocol: str) -> None:
+        domain = session.domain or DEFAULT_DOMAIN
+        body = session.body()
+        metrics.CAPTURED.inc(method=protocol.upper(), domain=domain)
+        metrics.BODY_BYTES.observe(body.size)
+        await request_queue.put(
+            RequestMade(
+                headers=orjson.dumps(session.details).decode("utf-8"),
+                **await capture.body_columns(body),
+                url=f"{protocol}://{domain}:{port}",
+                query_params="",
+                type=protocol.upper(),
+                domain=domain,
+                token=token_index.match(domain, ""),
+            )
+        )
+
+
+stream_listeners = StreamListeners(
+    parse_listeners(TCP_LISTENERS),
+    TCP_HOST,
+    read_bytes=TCP_READ_BYTES,
+    read_timeout=TCP_READ_TIMEOUT,
+    max_connections=TCP_MAX_CONNECTIONS,
+)
+
+
+async def start_stream_listeners():
+    await stream_listeners.start()
+
+
+async def stop_stream_listeners():
+    await stream_listeners.stop()
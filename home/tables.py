@@ -1,17 +1,99 @@
 import datetime
 
 
+from piccolo.apps.user.tables import BaseUser
 from piccolo.table import Table
-from piccolo.columns import Text, Timestamptz, UUID, Serial
+from piccolo.columns import (
+    ForeignKey,
+    OnDelete,
+    Text,
+    Timestamptz,
+    UUID,
+    Serial,
+    Bytea,
+    Varchar,
+    BigInt,
+    Boolean,
+    JSONB,
+    DoublePrecision,
+)
+
+
+class CallbackToken(Table):
+    label = Varchar(length=255, help_text="What this token is for, think an engagement")
+    domain = Varchar(
+        length=255,
+        help_text="The host callouts are sent to, subdomains included. "
+        "Leave blank to match any host",
+    )
+    path_prefix = Varchar(
+        length=255,
+        help_text="Only match urls under this path, think /t/abc123. "
+        "Leave blank to match any path",
+    )
+    owner = ForeignKey(
+        BaseUser,
+        null=True,
+        on_delete=OnDelete.set_null,
+        help_text="Who registered this token",
+    )
+    created_at = Timestamptz(help_text="When the token was registered")
 
 
 class RequestMade(Table):
     id: Serial
-    headers: str = Text(help_text="Headers as json string")
-    body: str = Text(help_text="The body of the request")
+    headers = JSONB(
+        default="[]",
+        help_text="Headers as [name, value] pairs, in the order they were sent",
+    )
+    body: str = Text(help_text="The body of the request when it is text")
+    body_raw: bytes = Bytea(help_text="The body of the request when it is not text")
+    body_encoding: str = Varchar(
+        length=32, help_text="What the body looked like, think utf-8 or gzip"
+    )
+    body_size: int = BigInt(help_text="How many bytes the body was")
+    body_hash: str = Varchar(
+        length=64,
+        index=True,
+        help_text="The sha256 of a body kept in the blob store instead of inline",
+    )
+    body_content_type: str = Text(help_text="The content type the body was sent with")
+    body_truncated: bool = Boolean(help_text="If the stored body was cut short")
     url: str = Text(help_text="The url a request was made to")
     query_params: str = Text(help_text="The query params in the url")
     made_at: datetime.datetime = Timestamptz(help_text="When the request was made")
     type: str = Text(help_text="Type of request made, think GET")
     uuid = UUID(help_text="A UUID instead of enumerable id", index=True)
     domain = Text(help_text="The domain this request was made to")
+    token = ForeignKey(
+        CallbackToken,
+        null=True,
+        on_delete=OnDelete.set_null,
+        help_text="The registered token this request matched, if any",
+    )
+
+
+class RateLimitBucket(Table):
+    key = Varchar(
+        length=255, unique=True, help_text="The policy and source this bucket limits"
+    )
+    tokens = DoublePrecision(help_text="Requests left before being limited")
+    updated_at = DoublePrecision(
+        help_text="Unix time the bucket was last refilled", index=True
+    )
+
+
+class DnsQuery(Table):
+    qname = Text(help_text="The name that was looked up")
+    qtype = Varchar(length=16, help_text="The record type asked for, think A or TXT")
+    source = Varchar(length=64, help_text="The address the query came from")
+    protocol = Varchar(length=3, help_text="udp or tcp")
+    made_at = Timestamptz(help_text="When the query was made", index=True)
+    uuid = UUID(help_text="A UUID instead of enumerable id", index=True)
+    zone = Text(help_text="The zone this query was answered from")
+    token = ForeignKey(
+        CallbackToken,
+        null=True,
+        on_delete=OnDelete.set_null,
+        help_text="The registered token this query matched, if any",
+    )
@@ -0,0 +1,185 @@
+"""Matching callouts to the callback tokens they were sent to.
+
+Every registered token is held in memory keyed by host and path
+prefix, so matching a callout costs a few dict lookups rather than a
+query. Once a change made through the admin has been saved it is
+published on TOKENS_CHANNEL, and every worker reloads its copy when
+it arrives. Every worker also checks for changes made anywhere else,
+or messages it missed, each TOKEN_REFRESH_INTERVAL.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from typing import Any
+
+from dotenv import load_dotenv
+
+from home.pubsub import pubsub, TOKENS_CHANNEL
+from home.tables import CallbackToken
+
+load_dotenv()
+log = logging.getLogger(__name__)
+TOKEN_REFRESH_INTERVAL: float = float(os.environ.get("TOKEN_REFRESH_INTERVAL", 30))
+# The admin calls hooks before it saves, so we watch for the write to land
+TOKEN_SAVE_POLL_INTERVAL: float = 0.1
+# A change that hasn't shown up by now failed, or the refresh will find it
+TOKEN_SAVE_TIMEOUT: float = 10
+
+
+def normalise_host(host: str) -> str:
+    """Lower case and without any port"""
+    host = host.strip().lower().rstrip(".")
+    if host.startswith("["):
+        return host.split("]")[0] + "]"
+
+    return host.rsplit(":", 1)[0] if host.count(":") == 1 else host
+
+
+def normalise_prefix(prefix: str) -> str:
+    """With a leading slash and without a trailing one, / becomes blank"""
+    prefix = prefix.strip().strip("/")
+    return f"/{prefix}" if prefix else ""
+
+
+def _host_candidates(host: str) -> list[str]:
+    """host, then each parent domain, then blank for tokens on any host"""
+    labels = host.split(".") if host else []
+    return [".".join(labels[i:]) for i in range(len(labels))] + [""]
+
+
+def _path_candidates(path: str) -> list[str]:
+    """path, then each parent path, then blank for tokens on any path"""
+    segments = [segment for segment in path.split("/") if segment]
+    return ["/" + "/".join(segments[:i]) for i in range(len(segments), 0, -1)] + [""]
+
+
+def _fingerprint(rows: list[dict[str, Any]]) -> frozenset[tuple[int, str, str]]:
+    return frozenset((row["id"], row["domain"], row["path_prefix"]) for row in rows)
+
+
+class TokenIndex:
+    """The registered tokens, by (host, path prefix).
+
+    A token matches its host and any subdomain of it, and its path
+    prefix and anything below it. Where several match, the most
+    specific host wins, then the longest path.
+    """
+
+    def __init__(self):
+        self._tokens: dict[tuple[str, str], int] = {}
+        self._hosts: set[str] = set()
+        # The rows the index was last built from
+        self._rows: frozenset[tuple[int, str, str]] = frozenset()
+        self._tasks: set[asyncio.Task] = set()
+        self._refresh_task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def build(self, rows: list[dict[str, Any]]) -> None:
+        tokens = {}
+        for row in sorted(rows, key=lambda row: row["id"]):
+            key = (normalise_host(row["domain"]), normalise_prefix(row["path_prefix"]))
+            # The oldest registration keeps a duplicate
+            tokens.setdefault(key, row["id"])
+
+        self._tokens = tokens
+        self._hosts = {host for host, _ in tokens}
+        self._rows = _fingerprint(rows)
+
+    async def reload(self) -> bool:
+        """Rebuild from the database, returning whether anything changed"""
+        rows = await CallbackToken.select(
+            CallbackToken.id, CallbackToken.domain, CallbackToken.path_prefix
+        )
+        if _fingerprint(rows) == self._rows:
+            return False
+
+        self.build(rows)
+        return True
+
+    def match(self, host: str, path: str) -> int | None:
+        """The id of the token a callout to host and path belongs to"""
+        if not self._tokens:
+            return None
+
+        for candidate_host in _host_candidates(normalise_host(host)):
+            if candidate_host not in self._hosts:
+                continue
+
+            for candidate_path in _path_candidates(path):
+                token_id = self._tokens.get((candidate_host, candidate_path))
+                if token_id is not None:
+                    return token_id
+
+        return None
+
+    def _spawn(self, coroutine) -> None:
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _publish_once_saved(self) -> None:
+        """Tell every worker to reload once our copy goes out of date.
+
+        A save which fails never changes anything, so is never published.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + TOKEN_SAVE_TIMEOUT
+        try:
+            while loop.time() < deadline:
+                await asyncio.sleep(TOKEN_SAVE_POLL_INTERVAL)
+                if await self.reload():
+                    await pubsub.publish(TOKENS_CHANNEL, {})
+                    return
+        except Exception:
+            log.exception("Failed to publish a callback token change")
+
+    async def _reload_logged(self) -> None:
+        try:
+            await self.reload()
+        except Exception:
+            log.exception("Failed to reload callback tokens")
+
+    async def _refresh(self) -> None:
+        while True:
+            await asyncio.sleep(TOKEN_REFRESH_INTERVAL)
+            await self._reload_logged()
+
+    async def start(self) -> None:
+        await self._reload_logged()
+        if self._refresh_task is None and TOKEN_REFRESH_INTERVAL > 0:
+            self._refresh_task = asyncio.create_task(self._refresh())
+
+    async def stop(self) -> None:
+        if self._refresh_task is None:
+            return
+
+        task, self._refresh_task = self._refresh_task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def changed(self, **kwargs) -> Any:
+        """An admin hook, tells every worker to reload once the change is saved"""
+        self._spawn(self._publish_once_saved())
+        return kwargs.get("row", kwargs.get("values"))
+
+    def on_message(self, message: dict) -> None:
+        self._spawn(self._reload_logged())
+
+
+token_index = TokenIndex()
+
+
+async def start_token_index():
+    await token_index.start()
+
+
+async def stop_token_index():
+    await token_index.stop()
@@ -1,4 +1,6 @@
 from .headers import get_csp
 from .flash import flash
+from .rendering import render_template, TimedTemplate
+from .cache import TTLCache
 
-__all__ = ["get_csp", "flash"]
+__all__ = ["get_csp", "flash", "render_template", "TimedTemplate", "TTLCache"]
@@ -0,0 +1,44 @@
+"""Advisory file locks shared between worker processes.
+
+These are no-ops where fcntl is unavailable, which is fine
+since only a single worker is supported there.
+"""
+
+from __future__ import annotations
+
+import contextlib
+from typing import IO, Iterator
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+def try_hold_lock(path: str) -> IO | None:
+    """Take an exclusive lock on path without waiting.
+
+    The lock is held until the returned file is closed,
+    or None is returned if another process holds it.
+    """
+    file = open(path, "a+")
+    if fcntl is None:
+        return file
+
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        file.close()
+        return None
+
+    return file
+
+
+@contextlib.contextmanager
+def file_lock(path: str, *, shared: bool = False) -> Iterator[None]:
+    """Hold a lock on path for the duration of the block"""
+    with open(path, "a+") as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+        yield
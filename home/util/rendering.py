@@ -0,0 +1,25 @@
+import jinja2
+from litestar import Request
+from litestar.response import Template
+
+from home.metrics import TEMPLATE_RENDER_SECONDS
+
+
+def render_template(request: Request, template: Template) -> str:
+    """Render a Template response to a string without sending it.
+
+    This mirrors what litestar does when it turns a Template
+    into a response, which lets callers hold onto the output.
+    """
+    context = template.create_template_context(request)
+    return request.app.template_engine.get_template(template.template_name).render(
+        **context
+    )
+
+
+class TimedTemplate(jinja2.Template):
+    """A jinja template which records how long each render takes"""
+
+    def render(self, *args, **kwargs) -> str:
+        with TEMPLATE_RENDER_SECONDS.time(template=self.name or "unknown"):
+            return super().render(*args, **kwargs)
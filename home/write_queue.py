@@ -0,0 +1,474 @@
+"""An in process write behind queue for captured rows.
+
+Rows are collected in memory and written to the database as
+multi-row inserts, either once enough have built up or after
+a short delay. This keeps the database round trip out of the
+capture path.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import datetime
+import logging
+import os
+import sqlite3
+import uuid
+from collections import deque
+from typing import Awaitable, Callable, Literal
+
+import asyncpg
+import commons
+import orjson
+from dotenv import load_dotenv
+from piccolo.columns import Bytea, Timestamptz, UUID
+from piccolo.table import Table
+
+from home.engines import TunedPostgresEngine
+from home.metrics import DB_QUERY_SECONDS, WRITE_QUEUE_REJECTED
+from home.tables import DnsQuery, RequestMade
+from home.util.locks import file_lock, try_hold_lock
+
+load_dotenv()
+log = logging.getLogger(__name__)
+WRITE_QUEUE_ENABLED: bool = commons.value_to_bool(
+    os.environ.get("WRITE_QUEUE_ENABLED", True)
+)
+WRITE_QUEUE_MAX_SIZE: int = int(os.environ.get("WRITE_QUEUE_MAX_SIZE", 10_000))
+WRITE_QUEUE_BATCH_SIZE: int = int(os.environ.get("WRITE_QUEUE_BATCH_SIZE", 500))
+WRITE_QUEUE_FLUSH_INTERVAL: float = float(
+    os.environ.get("WRITE_QUEUE_FLUSH_INTERVAL", 0.5)
+)
+WRITE_QUEUE_OVERFLOW: str = os.environ.get("WRITE_QUEUE_OVERFLOW", "block").lower()
+WRITE_QUEUE_SPILL_PATH: str = os.environ.get(
+    "WRITE_QUEUE_SPILL_PATH", "request_spill.ndjson"
+)
+WRITE_QUEUE_DNS_SPILL_PATH: str = os.environ.get(
+    "WRITE_QUEUE_DNS_SPILL_PATH", "dns_spill.ndjson"
+)
+
+OverflowPolicy = Literal["block", "drop_oldest", "spill"]
+InsertListener = Callable[[list[Table]], Awaitable[None]]
+
+
+def _encode_bytes(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+
+    raise TypeError
+
+
+# What the database raises for a row it will never accept, as opposed
+# to it being unreachable, where the row is worth trying again later
+ROW_ERRORS: tuple[type[Exception], ...] = (
+    sqlite3.IntegrityError,
+    sqlite3.DataError,
+    asyncpg.IntegrityConstraintViolationError,
+    asyncpg.DataError,
+)
+
+
+class BatchInterrupted(Exception):
+    """The database went away part way through writing a batch row by row"""
+
+    def __init__(self, handled: int, written: list[Table]):
+        super().__init__(f"Interrupted after {handled} rows")
+        # Rows from the front of the batch which were written or rejected
+        self.handled = handled
+        self.written = written
+
+
+def _read_offset(path: str) -> int:
+    try:
+        with open(path, "rb") as file:
+            return int(file.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def _write_offset(path: str, offset: int) -> None:
+    # Replaced whole so a crash never leaves half a number behind
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(str(offset).encode())
+
+    os.replace(temp_path, path)
+
+
+class WriteBehindQueue:
+    def __init__(
+        self,
+        table: type[Table],
+        *,
+        max_size: int,
+        batch_size: int,
+        flush_interval: float,
+        overflow: OverflowPolicy,
+        spill_path: str,
+    ):
+        if overflow not in ("block", "drop_oldest", "spill"):
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+
+        self.table = table
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_path = spill_path
+        # Rows the database refused, kept so they can be looked into
+        self.rejected_path = f"{spill_path}.rejected"
+        self.dropped: int = 0
+        # Called with every batch once it has been written
+        self.listeners: list[InsertListener] = []
+
+        self._rows: deque[Table] = deque()
+        self._has_space = asyncio.Condition()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @property
+    def has_spilled_rows(self) -> bool:
+        """Whether rows are waiting on disk, to be replayed or mid replay"""
+        return os.path.exists(self.spill_path) or os.path.exists(
+            f"{self.spill_path}.replay"
+        )
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background flusher and write out everything left"""
+        if self._task is None:
+            return
+
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        try:
+            await self.flush()
+        except Exception:
+            log.exception("Failed to drain %s rows on shutdown", len(self._rows))
+            self._spill(list(self._rows))
+            self._rows.clear()
+
+    async def put(self, row: Table) -> None:
+        if not self.running:
+            # Nothing will flush us, so write it through
+            await self._notify(await self._write([row]))
+            return
+
+        if self.overflow == "block" and len(self._rows) >= self.max_size:
+            async with self._has_space:
+                await self._has_space.wait_for(lambda: len(self._rows) < self.max_size)
+
+        self.put_nowait(row)
+
+    def put_nowait(self, row: Table) -> bool:
+        """Queue row without waiting, for callers that can never block.
+
+        A full queue spills or drops the oldest row as usual, but when
+        it would block the new row is dropped instead. Returns whether
+        row was kept.
+        """
+        if len(self._rows) >= self.max_size:
+            if self.overflow == "spill":
+                self._spill([row])
+                return True
+
+            self.dropped += 1
+            if self.overflow == "block":
+                return False
+
+            self._rows.popleft()
+
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+
+        return True
+
+    async def flush(self) -> None:
+        """Write every queued row, and anything spilled to disk, to the database"""
+        async with self._flush_lock:
+            while self._rows:
+                batch = [
+                    self._rows.popleft()
+                    for _ in range(min(self.batch_size, len(self._rows)))
+                ]
+                try:
+                    written = await self._write(batch)
+                except BatchInterrupted as e:
+                    # Put the rest back in order so the next attempt retries them
+                    self._rows.extendleft(reversed(batch[e.handled :]))
+                    await self._notify(e.written)
+                    raise
+                except Exception:
+                    self._rows.extendleft(reversed(batch))
+                    raise
+                finally:
+                    async with self._has_space:
+                        self._has_space.notify_all()
+
+                await self._notify(written)
+
+            await self._replay_spill()
+
+    async def _write(self, batch: list[Table]) -> list[Table]:
+        """Insert batch, returning the rows which were written.
+
+        If the database refuses the batch it is retried a row at a
+        time, and whichever rows it still refuses are set aside in the
+        rejected file, so one bad row can't hold up everything behind it.
+        """
+        try:
+            await self._insert(batch)
+            return batch
+        except ROW_ERRORS:
+            pass
+
+        # Usually a token deleted since the rows were matched to it,
+        # which other workers' indexes don't know about yet
+        if await self._clear_missing_references(batch):
+            try:
+                await self._insert(batch)
+                return batch
+            except ROW_ERRORS:
+                pass
+
+        log.warning(
+            "A batch of %s %s rows was refused, retrying them one at a time",
+            len(batch),
+            self.table._meta.tablename,
+        )
+
+        written = []
+        for handled, row in enumerate(batch):
+            try:
+                await self._insert([row])
+            except ROW_ERRORS as e:
+                self._reject(self._serialize(row), e)
+                continue
+            except Exception as e:
+                raise BatchInterrupted(handled, written) from e
+
+            written.append(row)
+
+        return written
+
+    async def _clear_missing_references(self, batch: list[Table]) -> bool:
+        """Unlink rows from anything deleted since, returning whether any were"""
+        cleared = 0
+        for column in self.table._meta.foreign_key_columns:
+            name = column._meta.name
+            ids = {getattr(row, name) for row in batch} - {None}
+            if not ids:
+                continue
+
+            target = column._foreign_key_meta.resolved_references
+            primary_key = target._meta.primary_key
+            existing = set(
+                await target.select(primary_key)
+                .where(primary_key.is_in(list(ids)))
+                .output(as_list=True)
+            )
+            for row in batch:
+                if getattr(row, name) not in existing | {None}:
+                    setattr(row, name, None)
+                    cleared += 1
+
+        if cleared:
+            log.warning(
+                "Unlinked %s %s rows from rows which no longer exist",
+                cleared,
+                self.table._meta.tablename,
+            )
+
+        return cleared > 0
+
+    def _reject(self, line: bytes, error: Exception) -> None:
+        log.error(
+            "The database refused a %s row, keeping it in %s: %s",
+            self.table._meta.tablename,
+            self.rejected_path,
+            error,
+        )
+        WRITE_QUEUE_REJECTED.inc(table=self.table._meta.tablename)
+        with file_lock(f"{self.spill_path}.lock", shared=True):
+            with open(self.rejected_path, "ab", buffering=0) as file:
+                file.write(line.rstrip(b"\n") + b"\n")
+
+    async def _insert(self, batch: list[Table]) -> None:
+        engine = self.table._meta.db
+        with DB_QUERY_SECONDS.time(query=f"insert_{self.table._meta.tablename}"):
+            if isinstance(engine, TunedPostgresEngine):
+                await engine.insert_rows(self.table, batch)
+            else:
+                await self.table.insert(*batch)
+
+    async def _notify(self, batch: list[Table]) -> None:
+        for listener in self.listeners:
+            try:
+                await listener(batch)
+            except Exception:
+                log.exception("Insert listener %r failed", listener)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Failed to flush %s queued rows", len(self._rows))
+
+    def _serialize(self, row: Table) -> bytes:
+        return orjson.dumps(
+            {
+                column._meta.name: getattr(row, column._meta.name)
+                for column in self.table._meta.non_default_columns
+            },
+            default=_encode_bytes,
+        )
+
+    def _deserialize(self, line: bytes) -> Table:
+        data = orjson.loads(line)
+        for column in self.table._meta.non_default_columns:
+            name = column._meta.name
+            if name not in data:
+                continue
+
+            if isinstance(column, Timestamptz):
+                data[name] = datetime.datetime.fromisoformat(data[name])
+            elif isinstance(column, UUID):
+                data[name] = uuid.UUID(data[name])
+            elif isinstance(column, Bytea):
+                data[name] = base64.b64decode(data[name])
+
+        return self.table(**data)
+
+    def _spill(self, rows: list[Table]) -> None:
+        if not rows:
+            return
+
+        # Other workers may be spilling into the same file. Unbuffered
+        # appends write each line in one go so they never interleave.
+        with file_lock(f"{self.spill_path}.lock", shared=True):
+            with open(self.spill_path, "ab", buffering=0) as file:
+                for row in rows:
+                    file.write(self._serialize(row) + b"\n")
+
+    async def _replay_spill(self) -> None:
+        # A leftover replay file means an earlier replay failed part way
+        if not self.has_spilled_rows:
+            return
+
+        # Only one worker replays at a time, the rest leave it be
+        replay_lock = try_hold_lock(f"{self.spill_path}.replay.lock")
+        if replay_lock is None:
+            return
+
+        with replay_lock:
+            await self._replay_spill_locked()
+
+    async def _replay_spill_locked(self) -> None:
+        # Rename first so rows spilled while we replay land in a new file
+        replay_path = f"{self.spill_path}.replay"
+        if not os.path.exists(replay_path):
+            with file_lock(f"{self.spill_path}.lock"):
+                if not os.path.exists(self.spill_path):
+                    return
+
+                os.replace(self.spill_path, replay_path)
+
+        # How far earlier replays got, so committed batches aren't
+        # inserted a second time after a failure part way through
+        offset_path = f"{replay_path}.offset"
+        position = _read_offset(offset_path)
+        with open(replay_path, "rb") as file:
+            file.seek(position)
+            batch: list[Table] = []
+            # Where each row in batch ends in the file
+            ends: list[int] = []
+            for line in file:
+                position += len(line)
+                if line.strip():
+                    try:
+                        batch.append(self._deserialize(line))
+                        ends.append(position)
+                    except (ValueError, TypeError) as e:
+                        self._reject(line, e)
+                if len(batch) >= self.batch_size:
+                    await self._replay_batch(batch, ends, offset_path)
+                    batch, ends = [], []
+
+            if batch:
+                await self._replay_batch(batch, ends, offset_path)
+
+        os.remove(replay_path)
+        try:
+            os.remove(offset_path)
+        except FileNotFoundError:
+            pass
+
+    async def _replay_batch(
+        self, batch: list[Table], ends: list[int], offset_path: str
+    ) -> None:
+        try:
+            written = await self._write(batch)
+        except BatchInterrupted as e:
+            if e.handled:
+                _write_offset(offset_path, ends[e.handled - 1])
+            await self._notify(e.written)
+            raise
+
+        _write_offset(offset_path, ends[-1])
+        await self._notify(written)
+
+
+request_queue = WriteBehindQueue(
+    RequestMade,
+    max_size=WRITE_QUEUE_MAX_SIZE,
+    batch_size=WRITE_QUEUE_BATCH_SIZE,
+    flush_interval=WRITE_QUEUE_FLUSH_INTERVAL,
+    overflow=WRITE_QUEUE_OVERFLOW,  # type: ignore[arg-type]
+    spill_path=WRITE_QUEUE_SPILL_PATH,
+)
+# DNS answers can't wait on the database, so this one always runs
+# while the DNS listener does, whatever WRITE_QUEUE_ENABLED says
+dns_queue = WriteBehindQueue(
+    DnsQuery,
+    max_size=WRITE_QUEUE_MAX_SIZE,
+    batch_size=WRITE_QUEUE_BATCH_SIZE,
+    flush_interval=WRITE_QUEUE_FLUSH_INTERVAL,
+    overflow=WRITE_QUEUE_OVERFLOW,  # type: ignore[arg-type]
+    spill_path=WRITE_QUEUE_DNS_SPILL_PATH,
+)
+
+
+async def start_write_queue():
+    if WRITE_QUEUE_ENABLED:
+        await request_queue.start()
+
+
+async def stop_write_queue():
+    await request_queue.stop()
@@ -1,15 +1,22 @@
 import os
 
 from dotenv import load_dotenv
-from piccolo.engine.postgres import PostgresEngine
 from piccolo.engine.sqlite import SQLiteEngine
 
 from piccolo.conf.apps import AppRegistry
 
+from home.engines import (
+    SQLITE_PATH,
+    SQLITE_READ_CONNECTIONS,
+    SQLITE_TUNED,
+    TunedPostgresEngine,
+    TunedSQLiteEngine,
+)
+
 load_dotenv()
 
 if os.environ.get("POSTGRES_HOST", False):
-    DB = PostgresEngine(
+    DB = TunedPostgresEngine(
         config={
             "database": os.environ["POSTGRES_DB"],
             "user": os.environ["POSTGRES_USER"],
@@ -18,7 +25,9 @@ if os.environ.get("POSTGRES_HOST", False):
             "port": int(os.environ["POSTGRES_PORT"]),
         },
     )
+elif SQLITE_TUNED:
+    DB = TunedSQLiteEngine(path=SQLITE_PATH, read_connections=SQLITE_READ_CONNECTIONS)
 else:
-    DB = SQLiteEngine()
+    DB = SQLiteEngine(path=SQLITE_PATH)
 
 APP_REGISTRY = AppRegistry(apps=["home.piccolo_app", "piccolo_admin.piccolo_app"])
@@ -1,12 +1,16 @@
 from piccolo_conf import *  # noqa
+from home.engines import TunedPostgresEngine
 
 
-DB = PostgresEngine(
+DB = TunedPostgresEngine(
     config={
         "database": "piccolo_project_test",
         "user": "postgres",
         "password": "",
         "host": "localhost",
         "port": 5432,
-    }
+    },
+    # Left to tests.database, so this imports without a database to
+    # connect to and the tests which need one are skipped instead
+    extensions=(),
 )
@@ -0,0 +1,24 @@
+// Prepends newly captured requests to the home page as they arrive
+(function () {
+    "use strict";
+    var list = document.getElementById("requests");
+    if (!list || !window.EventSource) {
+        return;
+    }
+
+    var source = new EventSource("/b/live");
+    source.addEventListener("request", function (event) {
+        var request = JSON.parse(event.data);
+        var item = document.createElement("li");
+        var link = document.createElement("a");
+        link.href = "/b/requests/" + encodeURIComponent(request.uuid);
+        link.textContent = request.label;
+        item.appendChild(link);
+        list.insertBefore(item, list.firstChild);
+
+        // Keep the page the same length as a fresh load
+        while (list.children.length > 25) {
+            list.removeChild(list.lastElementChild);
+        }
+    });
+})();
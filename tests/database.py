@@ -0,0 +1,34 @@
+import asyncio
+import functools
+import unittest
+
+import asyncpg
+from piccolo.engine import engine_finder
+
+
+@functools.cache
+def database_available() -> bool:
+    """Whether the test database from piccolo_conf_test can be reached.
+
+    Also creates the extensions tables need there, which the engine
+    is told not to.
+    """
+
+    async def connect():
+        connection = await asyncpg.connect(**engine_finder().config, timeout=2)
+        try:
+            await connection.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp"')
+        finally:
+            await connection.close()
+
+    try:
+        asyncio.run(connect())
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError):
+        return False
+
+    return True
+
+
+requires_database = unittest.skipUnless(
+    database_available(), "The Postgres test database isn't available"
+)
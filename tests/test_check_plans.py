@@ -0,0 +1,57 @@
+import asyncio
+import functools
+import unittest
+from unittest import IsolatedAsyncioTestCase
+
+import asyncpg
+from piccolo.apps.migrations.commands.forwards import run_forwards
+from piccolo.engine import engine_finder
+
+from home.commands.check_plans import find_table_scans
+from tests.database import database_available, requires_database
+
+
+@functools.cache
+def trigram_available() -> bool:
+    """Whether the test database can have the pg_trgm extension search needs"""
+    if not database_available():
+        return False
+
+    async def check():
+        connection = await asyncpg.connect(**engine_finder().config, timeout=2)
+        try:
+            return await connection.fetchval(
+                "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+            )
+        finally:
+            await connection.close()
+
+    return bool(asyncio.run(check()))
+
+
+@requires_database
+@unittest.skipUnless(trigram_available(), "pg_trgm isn't available")
+class TestCheckPlans(IsolatedAsyncioTestCase):
+    """The indexes come from the migrations, so these run them all"""
+
+    async def asyncSetUp(self):
+        for app_name in ("user", "session_auth", "all"):
+            result = await run_forwards(app_name)
+            self.assertTrue(result.success, result.message)
+
+    async def asyncTearDown(self):
+        # Migrations make more than tables, so start again from nothing
+        engine = engine_finder()
+        await engine.run_ddl("DROP SCHEMA public CASCADE")
+        await engine.run_ddl("CREATE SCHEMA public")
+        await engine.run_ddl('CREATE EXTENSION IF NOT EXISTS "uuid-ossp"')
+
+    async def test_hot_queries_use_indexes(self):
+        scans = await find_table_scans()
+        self.assertEqual([name for name, scanned in scans.items() if scanned], [])
+
+    async def test_missing_index_is_caught(self):
+        await engine_finder().run_ddl("DROP INDEX request_made_uuid")
+        scans = await find_table_scans()
+        self.assertTrue(scans["request by uuid"])
+        self.assertFalse(scans["latest requests"])
@@ -0,0 +1,207 @@
+import asyncio
+import socket
+import struct
+
+import pytest
+
+from home import metrics
+from home.dns_listener import (
+    DnsFormatError,
+    DnsListener,
+    DnsResponder,
+    parse_question,
+    FLAG_AA,
+    FLAG_QR,
+    FLAG_RD,
+    FLAG_TC,
+    RCODE_FORMERR,
+    RCODE_NOERROR,
+    RCODE_NOTIMP,
+    RCODE_REFUSED,
+    TYPE_A,
+    TYPE_AAAA,
+)
+
+
+def encode_name(name: bytes) -> bytes:
+    labels = name.split(b".") if name else []
+    return b"".join(bytes([len(label)]) + label for label in labels) + b"\x00"
+
+
+def query(
+    name: bytes = b"abc.blurp.test",
+    qtype: int = TYPE_A,
+    *,
+    flags: int = FLAG_RD,
+    qdcount: int = 1,
+    question: bytes | None = None,
+) -> bytes:
+    if question is None:
+        question = encode_name(name) + struct.pack("!HH", qtype, 1)
+
+    return struct.pack("!HHHHHH", 0x1234, flags, qdcount, 0, 0, 0) + question
+
+
+def header(response: bytes) -> tuple[int, int, int, int]:
+    """The id, flags, question count and answer count of response"""
+    return struct.unpack_from("!HHHH", response)
+
+
+class RecordingResponder(DnsResponder):
+    def __init__(self):
+        super().__init__(["blurp.test"], ["192.0.2.1"], [], ttl=0)
+        self.recorded: list[tuple[str, str]] = []
+
+    def record(self, question, zone, source, protocol):
+        self.recorded.append((question.qname, zone))
+
+
+def test_parse_question():
+    packet = query(b"ABC.Blurp.Test", TYPE_AAAA)
+    question = parse_question(packet)
+    assert question.qname == "abc.blurp.test"
+    assert question.qtype == TYPE_AAAA
+    assert question.qclass == 1
+    assert question.end == len(packet)
+
+
+def test_parse_question_root():
+    assert parse_question(query(b"")).qname == ""
+
+
+@pytest.mark.parametrize(
+    "label, expected",
+    [
+        (b"a\x00b", "a\\x00b"),
+        (b"\x07bell", "\\x07bell"),
+        (b"sp ace", "sp\\x20ace"),
+        (b"dot.ted", "dot\\x2eted"),
+        (b"back\\slash", "back\\x5cslash"),
+        (b"caf\xc3\xa9", "caf\\xc3\\xa9"),
+    ],
+)
+def test_parse_question_escapes_labels(label: bytes, expected: str):
+    question = bytes([len(label)]) + label + encode_name(b"blurp.test")
+    question += struct.pack("!HH", TYPE_A, 1)
+    assert parse_question(query(question=question)).qname == f"{expected}.blurp.test"
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        # Label runs past the end of the packet
+        b"\x05abc",
+        # Name never terminated
+        b"\x03abc",
+        # Type and class cut short
+        encode_name(b"abc.blurp.test") + b"\x00",
+        # Compression pointer
+        b"\x03abc\xc0\x0c" + struct.pack("!HH", TYPE_A, 1),
+        # Extended label type
+        b"\x43abc\x00" + struct.pack("!HH", TYPE_A, 1),
+        # Longer than any name may be
+        encode_name(b".".join([b"a" * 63] * 4)) + struct.pack("!HH", TYPE_A, 1),
+    ],
+)
+def test_parse_question_malformed(question: bytes):
+    with pytest.raises(DnsFormatError):
+        parse_question(query(question=question))
+
+
+def test_respond_answers_zone():
+    responder = RecordingResponder()
+    packet = query(b"x.abc.blurp.test")
+    response = responder.respond(packet, "198.51.100.1", "udp")
+
+    query_id, flags, qdcount, ancount = header(response)
+    assert query_id == 0x1234
+    assert flags == FLAG_QR | FLAG_AA | FLAG_RD | RCODE_NOERROR
+    assert (qdcount, ancount) == (1, 1)
+    # The question is echoed back, then the answer
+    assert response[12 : len(packet)] == packet[12:]
+    assert response.endswith(socket.inet_aton("192.0.2.1"))
+    assert responder.recorded == [("x.abc.blurp.test", "blurp.test")]
+
+
+def test_respond_no_addresses_for_type():
+    responder = RecordingResponder()
+    response = responder.respond(query(qtype=TYPE_AAAA), "198.51.100.1", "udp")
+    assert header(response)[1] & 0xF == RCODE_NOERROR
+    assert header(response)[3] == 0
+    assert len(responder.recorded) == 1
+
+
+@pytest.mark.parametrize("name", [b"blurp.test.evil", b"notblurp.test", b"example.com"])
+def test_respond_refuses_outside_zones(name: bytes):
+    responder = RecordingResponder()
+    response = responder.respond(query(name), "198.51.100.1", "udp")
+    assert header(response)[1] & 0xF == RCODE_REFUSED
+    assert responder.recorded == []
+
+
+def test_respond_ignores_answers():
+    responder = RecordingResponder()
+    assert responder.respond(query(flags=FLAG_QR), "198.51.100.1", "udp") is None
+    assert responder.respond(b"\x12\x34", "198.51.100.1", "udp") is None
+    assert responder.recorded == []
+
+
+@pytest.mark.parametrize("qdcount", [0, 2])
+def test_respond_wrong_question_count(qdcount: int):
+    responder = RecordingResponder()
+    response = responder.respond(query(qdcount=qdcount), "198.51.100.1", "udp")
+    assert header(response)[1] & 0xF == RCODE_FORMERR
+    assert responder.recorded == []
+
+
+def test_respond_compression_pointer():
+    responder = RecordingResponder()
+    packet = query(question=b"\x03abc\xc0\x0c" + struct.pack("!HH", TYPE_A, 1))
+    response = responder.respond(packet, "198.51.100.1", "udp")
+    assert header(response)[1] & 0xF == RCODE_FORMERR
+    assert responder.recorded == []
+
+
+def test_respond_other_opcodes():
+    responder = RecordingResponder()
+    # Opcode 2, a server status request
+    response = responder.respond(query(flags=0x1000), "198.51.100.1", "udp")
+    assert header(response)[1] & 0xF == RCODE_NOTIMP
+
+
+def test_respond_truncates_oversized_answers():
+    responder = RecordingResponder()
+    packet = query()
+    response = responder.respond(packet, "198.51.100.1", "udp", max_size=len(packet))
+    _, flags, _, ancount = header(response)
+    assert flags & FLAG_TC
+    assert ancount == 0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_tcp_connection_cap():
+    async def run():
+        listener = DnsListener(
+            RecordingResponder(), "127.0.0.1", free_port(), max_connections=1
+        )
+        await listener.start()
+        try:
+            _, idle = await asyncio.open_connection(listener.host, listener.port)
+            await asyncio.sleep(0.1)
+            assert listener.active == 1
+
+            reader, _ = await asyncio.open_connection(listener.host, listener.port)
+            # Turned away without being read from
+            assert await asyncio.wait_for(reader.read(), 1) == b""
+            idle.close()
+        finally:
+            await listener.stop()
+
+    rejected = metrics.DNS_TCP_REJECTED._values.get((), 0)
+    asyncio.run(run())
+    assert metrics.DNS_TCP_REJECTED._values.get((), 0) == rejected + 1
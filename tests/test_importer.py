@@ -0,0 +1,166 @@
+import os
+import tempfile
+import uuid
+
+import orjson
+import pytest
+from piccolo.apps.user.tables import BaseUser
+from piccolo.testing.test_case import AsyncTableTest
+
+from home import importer
+from home.blob_store import blob_store
+from home.tables import CallbackToken, RequestMade
+from tests.database import requires_database
+
+
+def make_record(url: str = "/", **kwargs) -> dict:
+    return {
+        "uuid": str(uuid.uuid4()),
+        "url": url,
+        "type": "get",
+        "domain": "blurp.test",
+        "headers": [["host", "blurp.test"]],
+        **kwargs,
+    }
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_parse_record():
+    row = importer.parse_record(make_record(headers={"host": "blurp.test"}))
+    assert row["type"] == "GET"
+    assert row["headers"] == '[["host","blurp.test"]]'
+    assert row["made_at"].tzinfo is not None
+
+
+@pytest.mark.parametrize(
+    "record, error",
+    [
+        ([], "JSON object"),
+        (make_record(uuid="nope"), "uuid"),
+        (make_record(made_at="yesterday"), "made_at"),
+        (make_record(body_raw="!!"), "body_raw"),
+        (make_record(headers=[["a"]]), "headers"),
+        ({"type": "GET", "domain": "blurp.test"}, "url"),
+    ],
+)
+def test_parse_record_invalid(record, error: str):
+    with pytest.raises(importer.InvalidRecord, match=error):
+        importer.parse_record(record)
+
+
+def test_parse_record_blobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(blob_store, "root", str(tmp_path))
+    stored = blob_store._write(b"x" * 100)
+    missing = "0" * 64
+
+    for body_hash, expected in [
+        (stored, stored),
+        (missing, ""),
+        ("../../etc/passwd", ""),
+    ]:
+        row = importer.parse_record(
+            make_record(body_hash=body_hash, body_size=100, body_truncated=True)
+        )
+        assert row["body_hash"] == expected
+        assert row["body_size"] == 100
+        assert row["body_truncated"]
+
+
+@requires_database
+class TestImportFile(AsyncTableTest):
+    tables = [BaseUser, CallbackToken, RequestMade]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "requests.ndjson")
+
+    def write(self, lines: list[bytes]):
+        with open(self.path, "wb") as file:
+            file.write(b"\n".join(lines) + b"\n")
+
+    async def stored_urls(self) -> list[str]:
+        return (
+            await RequestMade.select(RequestMade.url)
+            .order_by(RequestMade.url)
+            .output(as_list=True)
+        )
+
+    async def test_import(self):
+        token = CallbackToken(label="t", domain="blurp.test", path_prefix="/t")
+        await token.save()
+        self.write(
+            [
+                orjson.dumps(make_record("/1")),
+                orjson.dumps(make_record("/t/2")),
+                b"",
+                b"not json",
+            ]
+        )
+
+        result = await importer.import_file(self.path, batch_size=2)
+        self.assertEqual(result, importer.ImportResult(4, 2, 1))
+        rows = await RequestMade.select(RequestMade.url, RequestMade.token).order_by(
+            RequestMade.url
+        )
+        self.assertEqual(
+            rows, [{"url": "/1", "token": None}, {"url": "/t/2", "token": token.id}]
+        )
+        self.assertFalse(os.path.exists(f"{self.path}.progress"))
+
+    async def test_dedupe(self):
+        record = make_record("/1")
+        self.write([orjson.dumps(record), orjson.dumps(record)])
+
+        result = await importer.import_file(self.path)
+        self.assertEqual(result.inserted, 1)
+        # Importing the same file again adds nothing
+        result = await importer.import_file(self.path)
+        self.assertEqual(result.inserted, 0)
+        self.assertEqual(await self.stored_urls(), ["/1"])
+
+    async def test_dedupe_generic(self):
+        record = make_record("/1")
+        rows = [importer.parse_record(record) for _ in range(2)]
+        self.assertEqual(await importer._insert_generic(rows), 1)
+        self.assertEqual(await importer._insert_generic(rows), 0)
+
+    async def test_resume(self):
+        self.write(
+            [orjson.dumps(make_record(f"/{i}")) for i in range(1, 5)]
+            + [b"not json", orjson.dumps(make_record("/5"))]
+        )
+
+        def interrupt(result):
+            raise Interrupted
+
+        with self.assertRaises(Interrupted):
+            await importer.import_file(self.path, batch_size=2, on_progress=interrupt)
+
+        self.assertEqual(await self.stored_urls(), ["/1", "/2"])
+
+        invalid = []
+        result = await importer.import_file(
+            self.path,
+            batch_size=2,
+            on_invalid=lambda line, error: invalid.append(line),
+        )
+        self.assertEqual(result, importer.ImportResult(4, 3, 1))
+        self.assertEqual(await self.stored_urls(), ["/1", "/2", "/3", "/4", "/5"])
+        # Counted from the top of the file, not from where it resumed
+        self.assertEqual(invalid, [5])
+
+    async def test_restart(self):
+        self.write([orjson.dumps(make_record(f"/{i}")) for i in range(1, 4)])
+
+        def interrupt(result):
+            raise Interrupted
+
+        with self.assertRaises(Interrupted):
+            await importer.import_file(self.path, batch_size=2, on_progress=interrupt)
+
+        result = await importer.import_file(self.path, resume=False)
+        self.assertEqual(result, importer.ImportResult(3, 1, 0))
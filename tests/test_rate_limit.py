@@ -0,0 +1,94 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from piccolo.testing.test_case import AsyncTableTest
+
+from home.rate_limit import (
+    DatabaseBucketStore,
+    MemoryBucketStore,
+    Policy,
+    RateLimiter,
+)
+from home.tables import RateLimitBucket
+from tests.database import requires_database
+
+POLICY = Policy("test", rate=2, burst=3)
+
+
+async def take_all(store, key: str, now: float, attempts: int = 10) -> int:
+    """How many of attempts were let through at now"""
+    taken = 0
+    for _ in range(attempts):
+        taken += await store.take(key, POLICY, now)
+
+    return taken
+
+
+class BucketStoreTests:
+    """Run against each store by the subclasses below"""
+
+    store: MemoryBucketStore | DatabaseBucketStore
+
+    async def test_burst(self):
+        self.assertEqual(await take_all(self.store, "a", 1000), 3)
+
+    async def test_refill(self):
+        await take_all(self.store, "a", 1000)
+        # Half a second at two a second is one more token
+        self.assertEqual(await take_all(self.store, "a", 1000.5), 1)
+        # Never more than the burst, however long it has been
+        self.assertEqual(await take_all(self.store, "a", 2000), 3)
+
+    async def test_keys_are_separate(self):
+        await take_all(self.store, "a", 1000)
+        self.assertEqual(await take_all(self.store, "b", 1000), 3)
+
+
+class TestMemoryBucketStore(BucketStoreTests, IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.store = MemoryBucketStore()
+
+
+@requires_database
+class TestDatabaseBucketStore(BucketStoreTests, AsyncTableTest):
+    tables = [RateLimitBucket]
+
+    def setUp(self):
+        self.store = DatabaseBucketStore()
+
+    async def test_prune(self):
+        await take_all(self.store, "a", 1000)
+        await take_all(self.store, "b", 2000)
+        await self.store.prune(before=1500)
+        keys = await RateLimitBucket.select(RateLimitBucket.key).output(as_list=True)
+        self.assertEqual(keys, ["b"])
+
+
+def test_rejection_stops_charging():
+    source = Policy("source", rate=0, burst=1)
+    host = Policy("host", rate=0, burst=10)
+    store = MemoryBucketStore()
+    limiter = RateLimiter(store)
+
+    async def run():
+        first = await limiter.allow([(source, "ip:a"), (host, "blurp.test")])
+        second = await limiter.allow([(source, "ip:a"), (host, "blurp.test")])
+        return first, second
+
+    assert asyncio.run(run()) == (True, False)
+    # Only the allowed request came out of the host's bucket
+    assert store._buckets.get("host:blurp.test")[0] == 9
+
+
+def test_sources_share_host_bucket():
+    source = Policy("source", rate=0, burst=10)
+    host = Policy("host", rate=0, burst=2)
+    limiter = RateLimiter(MemoryBucketStore())
+
+    async def run():
+        return [
+            await limiter.allow([(source, f"ip:{address}"), (host, "blurp.test")])
+            for address in ("a", "b", "c")
+        ]
+
+    assert asyncio.run(run()) == [True, True, False]
@@ -0,0 +1,114 @@
+import pytest
+from piccolo.apps.user.tables import BaseUser
+from piccolo.testing.test_case import AsyncTableTest
+
+from home.tables import CallbackToken
+from home.tokens import TokenIndex, normalise_host, normalise_prefix
+from tests.database import requires_database
+
+
+def build(*tokens: tuple[int, str, str]) -> TokenIndex:
+    index = TokenIndex()
+    index.build(
+        [
+            {"id": token_id, "domain": domain, "path_prefix": path_prefix}
+            for token_id, domain, path_prefix in tokens
+        ]
+    )
+    return index
+
+
+@pytest.mark.parametrize(
+    "host, expected",
+    [
+        ("Blurp.Test", "blurp.test"),
+        ("blurp.test:8080", "blurp.test"),
+        ("blurp.test.", "blurp.test"),
+        ("[::1]:8080", "[::1]"),
+        ("::1", "::1"),
+    ],
+)
+def test_normalise_host(host: str, expected: str):
+    assert normalise_host(host) == expected
+
+
+@pytest.mark.parametrize(
+    "prefix, expected", [("t/abc/", "/t/abc"), ("/", ""), ("", ""), (" /t ", "/t")]
+)
+def test_normalise_prefix(prefix: str, expected: str):
+    assert normalise_prefix(prefix) == expected
+
+
+def test_match_empty():
+    assert TokenIndex().match("blurp.test", "/") is None
+
+
+def test_match_subdomains():
+    index = build((1, "blurp.test", ""))
+    assert index.match("blurp.test", "/") == 1
+    assert index.match("a.b.BLURP.test:443", "/x") == 1
+    assert index.match("notblurp.test", "/") is None
+    assert index.match("blurp.test.evil", "/") is None
+
+
+def test_match_path_prefix():
+    index = build((1, "blurp.test", "/t/abc"))
+    assert index.match("blurp.test", "/t/abc") == 1
+    assert index.match("blurp.test", "/t/abc/deeper") == 1
+    # Prefixes only match whole path segments
+    assert index.match("blurp.test", "/t/abcd") is None
+    assert index.match("blurp.test", "/t") is None
+
+
+def test_most_specific_host_wins():
+    index = build(
+        (1, "", ""),
+        (2, "blurp.test", "/t"),
+        (3, "a.blurp.test", ""),
+    )
+    # Even over a longer path on a less specific host
+    assert index.match("x.a.blurp.test", "/t/1") == 3
+    assert index.match("b.blurp.test", "/t/1") == 2
+    assert index.match("b.blurp.test", "/other") == 1
+    assert index.match("example.com", "/") == 1
+
+
+def test_longest_path_wins():
+    index = build(
+        (1, "blurp.test", ""),
+        (2, "blurp.test", "/t"),
+        (3, "blurp.test", "/t/abc"),
+    )
+    assert index.match("blurp.test", "/t/abc/1") == 3
+    assert index.match("blurp.test", "/t/xyz") == 2
+    assert index.match("blurp.test", "/") == 1
+
+
+def test_oldest_duplicate_wins():
+    index = build((7, "blurp.test", "/t/"), (3, "Blurp.Test", "t"))
+    assert len(index) == 1
+    assert index.match("blurp.test", "/t") == 3
+
+
+@requires_database
+class TestReload(AsyncTableTest):
+    tables = [BaseUser, CallbackToken]
+
+    async def test_reload(self):
+        index = TokenIndex()
+        self.assertFalse(await index.reload())
+
+        token = CallbackToken(label="t", domain="blurp.test", path_prefix="")
+        await token.save()
+        self.assertTrue(await index.reload())
+        self.assertEqual(index.match("blurp.test", "/"), token.id)
+        self.assertFalse(await index.reload())
+
+        token.path_prefix = "/t"
+        await token.save()
+        self.assertTrue(await index.reload())
+        self.assertIsNone(index.match("blurp.test", "/"))
+
+        await token.remove()
+        self.assertTrue(await index.reload())
+        self.assertEqual(len(index), 0)
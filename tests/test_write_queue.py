@@ -0,0 +1,197 @@
+import os
+import tempfile
+
+import pytest
+from piccolo.apps.user.tables import BaseUser
+from piccolo.testing.test_case import AsyncTableTest
+
+from home.tables import CallbackToken, RequestMade
+from home.write_queue import BatchInterrupted, WriteBehindQueue
+from tests.database import requires_database
+
+
+def make_row(url: str = "/", **kwargs) -> RequestMade:
+    return RequestMade(
+        url=url,
+        domain="blurp.test",
+        type="GET",
+        headers="[]",
+        query_params="",
+        body="",
+        **kwargs,
+    )
+
+
+def make_queue(
+    spill_path: str, queue_class: type[WriteBehindQueue] = WriteBehindQueue, **kwargs
+) -> WriteBehindQueue:
+    options = {
+        "max_size": 100,
+        "batch_size": 100,
+        "flush_interval": 60,
+        "overflow": "spill",
+        "spill_path": spill_path,
+    }
+    options.update(kwargs)
+    return queue_class(RequestMade, **options)
+
+
+class FlakyQueue(WriteBehindQueue):
+    """Loses its database connection on the given insert calls"""
+
+    def __init__(self, *args, fail_on: set[int], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_on = fail_on
+        self.inserts = 0
+
+    async def _insert(self, batch):
+        self.inserts += 1
+        if self.inserts in self.fail_on:
+            raise ConnectionRefusedError("The database went away")
+
+        await super()._insert(batch)
+
+
+def test_unknown_overflow_policy(tmp_path):
+    with pytest.raises(ValueError):
+        make_queue(str(tmp_path / "spill"), overflow="wait")
+
+
+def test_overflow_block(tmp_path):
+    queue = make_queue(str(tmp_path / "spill"), max_size=2, overflow="block")
+    assert queue.put_nowait(make_row("/1"))
+    assert queue.put_nowait(make_row("/2"))
+    # Nothing may wait here, so the newest row is the one dropped
+    assert not queue.put_nowait(make_row("/3"))
+    assert [row.url for row in queue._rows] == ["/1", "/2"]
+    assert queue.dropped == 1
+
+
+def test_overflow_drop_oldest(tmp_path):
+    queue = make_queue(str(tmp_path / "spill"), max_size=2, overflow="drop_oldest")
+    for url in ("/1", "/2", "/3"):
+        assert queue.put_nowait(make_row(url))
+
+    assert [row.url for row in queue._rows] == ["/2", "/3"]
+    assert queue.dropped == 1
+
+
+def test_overflow_spill(tmp_path):
+    queue = make_queue(str(tmp_path / "spill"), max_size=2, overflow="spill")
+    for url in ("/1", "/2", "/3", "/4"):
+        assert queue.put_nowait(make_row(url))
+
+    assert [row.url for row in queue._rows] == ["/1", "/2"]
+    assert queue.dropped == 0
+    assert queue.has_spilled_rows
+    with open(queue.spill_path, "rb") as file:
+        spilled = [queue._deserialize(line).url for line in file]
+
+    assert spilled == ["/3", "/4"]
+
+
+@requires_database
+class TestWriteBehindQueue(AsyncTableTest):
+    tables = [BaseUser, CallbackToken, RequestMade]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spill_path = os.path.join(directory.name, "spill.ndjson")
+
+    async def stored_urls(self) -> list[str]:
+        return (
+            await RequestMade.select(RequestMade.url)
+            .order_by(RequestMade.id)
+            .output(as_list=True)
+        )
+
+    def rejected_urls(self, queue: WriteBehindQueue) -> list[str]:
+        with open(queue.rejected_path, "rb") as file:
+            return [queue._deserialize(line).url for line in file]
+
+    async def test_flush(self):
+        queue = make_queue(self.spill_path, batch_size=2)
+        for url in ("/1", "/2", "/3"):
+            queue.put_nowait(make_row(url))
+
+        await queue.flush()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(await self.stored_urls(), ["/1", "/2", "/3"])
+
+    async def test_refused_row_is_set_aside(self):
+        queue = make_queue(self.spill_path)
+        for url in ("/1", "/\x00", "/3"):
+            queue.put_nowait(make_row(url))
+
+        await queue.flush()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(await self.stored_urls(), ["/1", "/3"])
+        self.assertEqual(self.rejected_urls(queue), ["/\x00"])
+
+    async def test_deleted_token_is_unlinked(self):
+        token = CallbackToken(label="gone", domain="blurp.test", path_prefix="")
+        await token.save()
+        await token.remove()
+
+        queue = make_queue(self.spill_path)
+        queue.put_nowait(make_row("/1", token=token.id))
+        await queue.flush()
+        rows = await RequestMade.select(RequestMade.url, RequestMade.token)
+        self.assertEqual(rows, [{"url": "/1", "token": None}])
+        self.assertFalse(os.path.exists(queue.rejected_path))
+
+    async def test_rows_kept_while_database_is_down(self):
+        queue = make_queue(self.spill_path, FlakyQueue, batch_size=2, fail_on={2})
+        for url in ("/1", "/2", "/3", "/4"):
+            queue.put_nowait(make_row(url))
+
+        with self.assertRaises(ConnectionRefusedError):
+            await queue.flush()
+
+        # The failed batch goes back on the front, in order
+        self.assertEqual([row.url for row in queue._rows], ["/3", "/4"])
+        await queue.flush()
+        self.assertEqual(await self.stored_urls(), ["/1", "/2", "/3", "/4"])
+
+    async def test_interrupted_row_by_row_retry(self):
+        # The batch is refused, then the database goes away after
+        # the first of the rows is retried on its own
+        queue = make_queue(self.spill_path, FlakyQueue, fail_on={3})
+        for url in ("/1", "/\x00", "/3"):
+            queue.put_nowait(make_row(url))
+
+        with self.assertRaises(BatchInterrupted):
+            await queue.flush()
+
+        self.assertEqual([row.url for row in queue._rows], ["/\x00", "/3"])
+        await queue.flush()
+        self.assertEqual(await self.stored_urls(), ["/1", "/3"])
+        self.assertEqual(self.rejected_urls(queue), ["/\x00"])
+
+    async def test_spill_is_replayed(self):
+        queue = make_queue(self.spill_path, batch_size=2)
+        queue._spill([make_row("/1"), make_row("/\x00"), make_row("/3")])
+        with open(self.spill_path, "ab") as file:
+            file.write(b"not json\n")
+
+        await queue.flush()
+        self.assertEqual(await self.stored_urls(), ["/1", "/3"])
+        self.assertFalse(queue.has_spilled_rows)
+        with open(queue.rejected_path, "rb") as file:
+            self.assertEqual(len(file.readlines()), 2)
+
+    async def test_failed_replay_resumes(self):
+        queue = make_queue(self.spill_path, FlakyQueue, batch_size=2, fail_on={2})
+        queue._spill([make_row(f"/{i}") for i in range(1, 6)])
+        with self.assertRaises(ConnectionRefusedError):
+            await queue.flush()
+
+        self.assertTrue(queue.has_spilled_rows)
+        # Rows spilled meanwhile wait for the next replay
+        queue._spill([make_row("/6")])
+        await queue.flush()
+        self.assertEqual(await self.stored_urls(), ["/1", "/2", "/3", "/4", "/5"])
+        await queue.flush()
+        self.assertEqual(await self.stored_urls(), ["/1", "/2", "/3", "/4", "/5", "/6"])
+        self.assertFalse(queue.has_spilled_rows)